@@ -21,7 +21,11 @@ function ExamComposition({ exam }) {
           <QuestionMenu examType="exam" exam={exam} />
         </Col>
         <Col xs={12} sm={9} md={9} lg={10}>
-          <ExamQuestion question={exam.currentQuestion} chatChoices={exam.chatChoices} />
+          <ExamQuestion
+            question={exam.currentQuestion}
+            chatChoices={exam.chatChoices}
+            onCancelChat={(actionId) => exam.cancelChatAnswer(actionId)}
+          />
         </Col>
       </Row>
       <TimeoutBox timeoutManager={exam.timeoutManager} />
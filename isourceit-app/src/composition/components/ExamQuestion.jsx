@@ -1,5 +1,6 @@
 /* eslint no-param-reassign: ["error", { "props": false }] */
 import React, { useState } from 'react';
+import PropTypes from 'prop-types';
 import { observer, PropTypes as MPropTypes } from 'mobx-react';
 import {
   Alert, Col, Form, Row,
@@ -7,7 +8,7 @@ import {
 import AnswerInput from './question/AnswerInput';
 import MultiResourcePanel from './question/MultiResourcePanel';
 
-function ExamQuestion({ question, chatChoices }) {
+function ExamQuestion({ question, chatChoices, onCancelChat }) {
   const [chatRscSubmitting, setChatRscSubmitting] = useState(false);
 
   const submitChatAI = ({ prompt, answer, chat }) => {
@@ -56,6 +57,7 @@ function ExamQuestion({ question, chatChoices }) {
                   chats={chatChoices}
                   chatActions={question.chatActions}
                   onSubmitChat={submitChatAI}
+                  onCancelChat={onCancelChat}
                   resources={question.resources}
                   addResource={addResource}
                   removeResource={removeResource}
@@ -84,6 +86,11 @@ function ExamQuestion({ question, chatChoices }) {
 ExamQuestion.propTypes = {
   question: MPropTypes.objectOrObservableObject.isRequired,
   chatChoices: MPropTypes.arrayOrObservableArray.isRequired,
+  onCancelChat: PropTypes.func,
+};
+
+ExamQuestion.defaultProps = {
+  onCancelChat: null,
 };
 
 export default observer(ExamQuestion);
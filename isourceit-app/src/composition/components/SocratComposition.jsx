@@ -19,7 +19,11 @@ function SocratComposition({ exam }) {
         <QuestionMenu examType="socrat" exam={exam} />
       </Col>
       <Col xs={12} sm={9} md={9} lg={10}>
-        <SocratQuestion question={exam.currentQuestion} chatChoices={exam.chatChoices} />
+        <SocratQuestion
+          question={exam.currentQuestion}
+          chatChoices={exam.chatChoices}
+          onCancelChat={(actionId) => exam.cancelChatAnswer(actionId)}
+        />
       </Col>
     </Row>
   );
@@ -1,5 +1,6 @@
 /* eslint no-param-reassign: ["error", { "props": false }] */
 import React, { useEffect, useState } from 'react';
+import PropTypes from 'prop-types';
 import { observer, PropTypes as MPropTypes } from 'mobx-react';
 import {
   Alert, Col, Form, Row,
@@ -7,7 +8,7 @@ import {
 import AnswerInput from './question/AnswerInput';
 import MultiResourcePanel from './question/MultiResourcePanel';
 
-function SocratQuestion({ question, chatChoices }) {
+function SocratQuestion({ question, chatChoices, onCancelChat }) {
   const [chatRscSubmitting, setChatRscSubmitting] = useState(false);
 
   // Init socrat chat interaction if required
@@ -76,6 +77,7 @@ function SocratQuestion({ question, chatChoices }) {
                   chats={chatChoices}
                   chatActions={question.chatActions}
                   onSubmitChat={submitChatAI}
+                  onCancelChat={onCancelChat}
                   resources={question.resources}
                   addResource={addResource}
                   removeResource={removeResource}
@@ -104,6 +106,11 @@ function SocratQuestion({ question, chatChoices }) {
 SocratQuestion.propTypes = {
   question: MPropTypes.objectOrObservableObject.isRequired,
   chatChoices: MPropTypes.arrayOrObservableArray.isRequired,
+  onCancelChat: PropTypes.func,
+};
+
+SocratQuestion.defaultProps = {
+  onCancelChat: null,
 };
 
 export default observer(SocratQuestion);
@@ -6,13 +6,13 @@ import {
   Button, Col, Form, InputGroup, Row,
 } from 'react-bootstrap';
 import { FontAwesomeIcon } from '@fortawesome/react-fontawesome';
-import { faPaperPlane } from '@fortawesome/free-solid-svg-icons';
+import { faPaperPlane, faStop } from '@fortawesome/free-solid-svg-icons';
 import ChatAIMessageBox from './ChatAIMessageBox';
 
 import styleApp from './ChatAIChat.scss';
 
 function ChatAIChat({
-  chatActions, onSubmit, submitting, chatId, className, style,
+  chatActions, onSubmit, onCancel, submitting, chatId, className, style,
 }) {
   const [prompt, setPrompt] = useState('');
 
@@ -24,7 +24,8 @@ function ChatAIChat({
     }
   };
 
-  const pendingAction = !!(chatActions.length && chatActions[chatActions.length - 1].pending);
+  const lastAction = chatActions.length ? chatActions[chatActions.length - 1] : null;
+  const pendingAction = !!lastAction?.pending;
 
   return (
     <div className={className} style={style}>
@@ -45,15 +46,29 @@ function ChatAIChat({
               className="px-1"
               disabled={submitting || pendingAction}
             />
-            <Button
-              variant="outline-secondary"
-              id={`chat-prompt-send-button-${chatId}`}
-              type="button"
-              onClick={submitPrompt}
-              disabled={submitting || pendingAction}
-            >
-              <FontAwesomeIcon icon={faPaperPlane} size="sm" />
-            </Button>
+            {
+              pendingAction && onCancel ? (
+                <Button
+                  variant="outline-secondary"
+                  id={`chat-prompt-cancel-button-${chatId}`}
+                  type="button"
+                  title="Stop the answer"
+                  onClick={() => onCancel(lastAction.id)}
+                >
+                  <FontAwesomeIcon icon={faStop} size="sm" />
+                </Button>
+              ) : (
+                <Button
+                  variant="outline-secondary"
+                  id={`chat-prompt-send-button-${chatId}`}
+                  type="button"
+                  onClick={submitPrompt}
+                  disabled={submitting || pendingAction}
+                >
+                  <FontAwesomeIcon icon={faPaperPlane} size="sm" />
+                </Button>
+              )
+            }
           </InputGroup>
         </Col>
       </Row>
@@ -64,6 +79,7 @@ function ChatAIChat({
 ChatAIChat.propTypes = {
   chatActions: MPropTypes.arrayOrObservableArray.isRequired,
   onSubmit: PropTypes.func.isRequired,
+  onCancel: PropTypes.func,
   submitting: PropTypes.bool,
   chatId: PropTypes.string,
   className: PropTypes.string,
@@ -71,6 +87,7 @@ ChatAIChat.propTypes = {
 };
 
 ChatAIChat.defaultProps = {
+  onCancel: null,
   submitting: false,
   chatId: null,
   className: null,
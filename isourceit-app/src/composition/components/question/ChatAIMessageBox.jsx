@@ -20,8 +20,11 @@ function ChatAIMessageBox({ chatActions, submitting }) {
 
   const chatMessages = chatActions
     .flatMap((act) => (act.answer
-      ? [{ k: `prompt-${act.id}`, v: act.prompt }, { k: `ans-${act.id}`, v: act.answer, a: true }]
+      ? [{ k: `prompt-${act.id}`, v: act.prompt }, {
+        k: `ans-${act.id}`, v: act.truncated ? `${act.answer} […]` : act.answer, a: true,
+      }]
       : [{ k: `prompt-${act.id}`, v: act.prompt }]));
+  const queuePosition = chatActions.length ? chatActions[chatActions.length - 1].queuePosition : null;
 
   return (
     <Row
@@ -50,6 +53,13 @@ function ChatAIMessageBox({ chatActions, submitting }) {
                 <Col xs="auto">
                   <FontAwesomeIcon icon={faSpinner} className={classNames('text-secondary-emphasis')} spinPulse size="xl" />
                 </Col>
+                {
+                  queuePosition && (
+                    <Col xs="auto" className="text-secondary-emphasis">
+                      {`Waiting for the chat: position ${queuePosition} in queue`}
+                    </Col>
+                  )
+                }
               </Row>
             )
           }
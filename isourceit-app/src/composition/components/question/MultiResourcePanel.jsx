@@ -8,7 +8,7 @@ import ChatAIChatCopyPaste from './ChatAIChatCopyPaste';
 import ExternalResourcesPanel from './ExternalResourcesPanel';
 
 function MultiResourcePanel({
-  chats, chatActions, onSubmitChat, resources, addResource,
+  chats, chatActions, onSubmitChat, onCancelChat, resources, addResource,
   removeResource, submitting, className, style,
 }) {
   return (
@@ -33,6 +33,7 @@ function MultiResourcePanel({
                 <ChatAIChat
                   chatActions={chatActions[chat.id]}
                   onSubmit={(data) => onSubmitChat({ ...data, chat })}
+                  onCancel={onCancelChat}
                   submitting={submitting}
                   chatId={chat.id}
                 />
@@ -57,6 +58,7 @@ MultiResourcePanel.propTypes = {
   chats: MPropTypes.arrayOrObservableArray.isRequired,
   chatActions: MPropTypes.objectOrObservableObject.isRequired,
   onSubmitChat: PropTypes.func.isRequired,
+  onCancelChat: PropTypes.func,
   resources: MPropTypes.arrayOrObservableArray.isRequired,
   addResource: PropTypes.func.isRequired,
   removeResource: PropTypes.func.isRequired,
@@ -66,6 +68,7 @@ MultiResourcePanel.propTypes = {
 };
 
 MultiResourcePanel.defaultProps = {
+  onCancelChat: null,
   submitting: false,
   className: null,
   style: null,
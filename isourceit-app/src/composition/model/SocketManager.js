@@ -1,5 +1,8 @@
 import { makeAutoObservable, runInAction } from 'mobx';
 import { io } from 'socket.io-client';
+import ERROR_MANAGER from '../../common/model/ErrorManager';
+
+const ACTION_ACK_TIMEOUT_MS = 10000;
 
 class SocketManager {
   _socket = null;
@@ -16,6 +19,8 @@ class SocketManager {
       answerCallback: false,
       init: false,
       release: false,
+      cancelPrompt: false,
+      sendAction: false,
     });
   }
 
@@ -80,12 +85,42 @@ class SocketManager {
     });
   }
 
+  cancelPrompt(actionId) {
+    // the server ends the answer with what has been received so far
+    if (!this._connected) {
+      console.warn('Cannot cancel prompt: socket not connected');
+      return;
+    }
+    this._socket.emit('cancel', { action_id: actionId });
+  }
+
+  sendAction(actionData) {
+    // the action is answered through the acknowledgement: its result, or an error message shaped as http errors
+    return new Promise((resolve, reject) => {
+      this._socket.timeout(ACTION_ACK_TIMEOUT_MS).emit('action', actionData, (err, result) => {
+        if (err) {
+          ERROR_MANAGER.addError(err.message, 'Erreur de requête');
+          reject(err);
+        } else if (result?.error && result?.code) {
+          const message = `${result.error} (${result.details})`;
+          ERROR_MANAGER.addError(message, 'Erreur de requête');
+          reject(new Error(message));
+        } else {
+          resolve(result);
+        }
+      });
+    });
+  }
+
   release() {
     if (!this._connected) {
       console.warn('Socket not connected');
     }
     this._socket.close();
     this._socket = null;
+    runInAction(() => {
+      this._connected = false;
+    });
   }
 }
 
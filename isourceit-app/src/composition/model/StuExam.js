@@ -36,11 +36,15 @@ class StuExam {
 
   _onSubmit = false;
 
+  _chatCanceller = null;
+
   constructor(jsonData) {
     makeAutoObservable(this, {
       _focusManager: false,
       _timeoutManager: false,
       handleChatAnswer: false,
+      _chatCanceller: false,
+      chatCanceller: false,
     });
     this._focusManager = new FocusManager();
     this._timeoutManager = new TimeoutManager(() => {
@@ -227,6 +231,20 @@ class StuExam {
     });
   }
 
+  get chatCanceller() {
+    return this._chatCanceller;
+  }
+
+  set chatCanceller(cb) {
+    this._chatCanceller = cb;
+  }
+
+  cancelChatAnswer(actionId) {
+    if (this._chatCanceller) {
+      this._chatCanceller(actionId);
+    }
+  }
+
   async handleChatAnswer(answer) {
     // find proper question and chat action, then update answer and/or pending state
     if ((answer.question_idx ?? false) === false || (answer.action_id ?? false) === false) {
@@ -258,6 +276,8 @@ class StuExam {
       return;
     }
     runInAction(() => {
+      // position in the chat queue until the answer starts
+      action.queuePosition = answer.queue_position ?? null;
       if (answer.answer) {
         if (action.answer) {
           action.answer += answer.answer;
@@ -267,6 +287,8 @@ class StuExam {
       }
       if (answer.ended) {
         action.pending = false;
+        // cancelled before the end of the answer
+        action.truncated = !!answer.truncated;
       }
     });
   }
@@ -112,6 +112,8 @@ class StuExamQuestion {
         prompt: action.prompt,
         answer,
         pending: !action.achieved,
+        truncated: false,
+        queuePosition: null,
         timestamp: dateTimeStringToDate(action.timestamp),
       });
     });
@@ -171,6 +173,10 @@ class StuExamQuestion {
     Object.values(chatActions).flatMap((actTab) => actTab).forEach((act) => {
       // eslint-disable-next-line no-param-reassign
       act.timestamp = dateTimeStringToDate(act.timestamp);
+      // eslint-disable-next-line no-param-reassign
+      act.queuePosition = null;
+      // eslint-disable-next-line no-param-reassign
+      act.truncated = !!act.truncated;
     });
     return chatActions;
   }
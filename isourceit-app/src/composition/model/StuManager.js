@@ -2,6 +2,7 @@ import { makeAutoObservable, runInAction } from 'mobx';
 import StuExam from './StuExam';
 import SocketManager from './SocketManager';
 import StuSocrat from './StuSocrat';
+import { setActionSocket } from './netLayer';
 
 class StuManager {
   _exam;
@@ -35,6 +36,8 @@ class StuManager {
 
     this._socketManager = new SocketManager();
     this._socketManager.answerCallback = (answer) => this._exam.handleChatAnswer(answer);
+    this._exam.chatCanceller = (actionId) => this._socketManager.cancelPrompt(actionId);
+    setActionSocket(this._socketManager);
     this._init();
   }
 
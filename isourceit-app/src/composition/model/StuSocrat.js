@@ -28,10 +28,14 @@ class StuSocrat {
 
   _onSubmit = false;
 
+  _chatCanceller = null;
+
   constructor(jsonData) {
     makeAutoObservable(this, {
       _focusManager: false,
       handleChatAnswer: false,
+      _chatCanceller: false,
+      chatCanceller: false,
     });
     this._focusManager = new FocusManager();
     if (jsonData) {
@@ -190,6 +194,20 @@ class StuSocrat {
     });
   }
 
+  get chatCanceller() {
+    return this._chatCanceller;
+  }
+
+  set chatCanceller(cb) {
+    this._chatCanceller = cb;
+  }
+
+  cancelChatAnswer(actionId) {
+    if (this._chatCanceller) {
+      this._chatCanceller(actionId);
+    }
+  }
+
   async handleChatAnswer(answer) {
     // find proper question and chat action, then update answer and/or pending state
     if ((answer.question_idx ?? false) === false || (answer.action_id ?? false) === false) {
@@ -221,6 +239,8 @@ class StuSocrat {
       return;
     }
     runInAction(() => {
+      // position in the chat queue until the answer starts
+      action.queuePosition = answer.queue_position ?? null;
       if (answer.answer) {
         if (action.answer) {
           action.answer += answer.answer;
@@ -230,6 +250,8 @@ class StuSocrat {
       }
       if (answer.ended) {
         action.pending = false;
+        // cancelled before the end of the answer
+        action.truncated = !!answer.truncated;
       }
     });
   }
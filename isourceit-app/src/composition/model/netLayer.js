@@ -1,5 +1,21 @@
 import { ROOT_AX, ROOT_URL } from '../../RESTInfo';
 
+let actionSocket = null;
+
+export function setActionSocket(socketManager) {
+  actionSocket = socketManager;
+}
+
+function postAction(actionData) {
+  // actions are sent over the websocket when connected, http otherwise.
+  // Start and submission are always sent over http, as they may update the session cookie
+  if (actionSocket?.connected) {
+    return actionSocket.sendAction(actionData);
+  }
+  return ROOT_AX.post(`${ROOT_URL}/composition/actions`, actionData)
+    .then((res) => res.data);
+}
+
 export function getExamDetails({ examId }) {
   return ROOT_AX.get(`${ROOT_URL}/composition/exams/${examId}`)
     .then((res) => res.data);
@@ -18,42 +34,39 @@ export function startExam() {
 }
 
 export function changeQuestion({ questionId, nextQuestionId }) {
-  return ROOT_AX.post(`${ROOT_URL}/composition/actions`, {
+  return postAction({
     action_type: 'ChangedQuestion',
     question_idx: questionId,
     next_question_idx: nextQuestionId,
-  })
-    .then((res) => res.data);
+  });
 }
 
 export function lostFocus({
   questionId, timestamp, returnTimestamp, durationSeconds, pageHidden,
 }) {
-  return ROOT_AX.post(`${ROOT_URL}/composition/actions`, {
+  return postAction({
     action_type: 'LostFocus',
     question_idx: questionId,
     timestamp: timestamp ? timestamp.toISOString() : null,
     return_timestamp: returnTimestamp,
     duration_seconds: durationSeconds,
     page_hidden: pageHidden,
-  })
-    .then((res) => res.data);
+  });
 }
 
 export function writeInitialAnswerQuestion({ questionId, text, timestamp = null }) {
-  return ROOT_AX.post(`${ROOT_URL}/composition/actions`, {
+  return postAction({
     action_type: 'WriteInitialAnswer',
     question_idx: questionId,
     text,
     timestamp: timestamp ? timestamp.toISOString() : null,
-  })
-    .then((res) => res.data);
+  });
 }
 
 export function askChatAIQuestion({
   questionId, prompt, answer, chatId, chatKey, modelKey, timestamp = null,
 }) {
-  return ROOT_AX.post(`${ROOT_URL}/composition/actions`, {
+  return postAction({
     action_type: 'AskChatAI',
     question_idx: questionId,
     prompt,
@@ -62,22 +75,20 @@ export function askChatAIQuestion({
     chat_key: chatKey,
     model_key: modelKey,
     timestamp: timestamp ? timestamp.toISOString() : null,
-  })
-    .then((res) => res.data);
+  });
 }
 
 export function addExternalResourceQuestion({
   questionId, title, description, rscType, timestamp = null,
 }) {
-  return ROOT_AX.post(`${ROOT_URL}/composition/actions`, {
+  return postAction({
     action_type: 'AddExternalResource',
     question_idx: questionId,
     title,
     description,
     rsc_type: rscType,
     timestamp: timestamp ? timestamp.toISOString() : null,
-  })
-    .then((res) => res.data);
+  });
 }
 
 export function removeExternalResourceQuestion({ actionId }) {
@@ -86,13 +97,12 @@ export function removeExternalResourceQuestion({ actionId }) {
 }
 
 export function writeFinalAnswerQuestion({ questionId, text, timestamp = null }) {
-  return ROOT_AX.post(`${ROOT_URL}/composition/actions`, {
+  return postAction({
     action_type: 'WriteFinalAnswer',
     question_idx: questionId,
     text,
     timestamp: timestamp ? timestamp.toISOString() : null,
-  })
-    .then((res) => res.data);
+  });
 }
 
 export function submitExam() {
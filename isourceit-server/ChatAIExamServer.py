@@ -8,18 +8,26 @@ import logging
 from argparse import ArgumentParser
 from typing import Tuple
 from datetime import timedelta
-from flask import Flask, request
+from flask import Flask, request, json as flask_json
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
+from redis import Redis
+from werkzeug.exceptions import Unauthorized, Conflict, BadRequest
 from werkzeug.middleware.proxy_fix import ProxyFix
+from utils.KeyedTurnQueue import KeyedTurnQueue
 from utils.loggingUtils import configure_logging
 from mongoDAO.MongoDAO import MongoDAO
-from sessions.MongoSession import AutoCleanMongoSession
+from mongoModel.StudentAction import START_EXAM_TYPE, SUBMIT_EXAM_TYPE
+from sessions.MongoSession import MongoSessionInterface
+from sessions.RedisSession import RedisSessionInterface
+from sessions.StatelessStudentSession import StatelessStudentSessionInterface
 from services.ChatAIManager import ChatAIManager
-from sessions.sessionManagement import session_is_student, has_logged_session, update_session_ws_sid
+from sessions.sessionManagement import session_is_student, has_logged_session, update_session_ws_sid, \
+    session_is_stateless, get_student_ws_room
+from services import studentActionService
 from services.mailService import MailService
 
-from controllers.errorHandler import error_handler
+from controllers.errorHandler import error_handler, build_error_message
 from controllers.securityController import security_controller
 from controllers.userController import user_controller
 from controllers.studentActionController import student_action_controller
@@ -67,8 +75,10 @@ def create_server_apps(config_file_path: str, static_folder_path: str,
         socket_io_allowed_origin = ("http://localhost:3000", "http://127.0.0.1:3000")
 
     # Flask-SocketIO initialisation
+    # flask json encoder is used to serialize websocket messages as HTTP responses (eg.: datetime)
     socketio = SocketIO(app, message_queue=app.config.get('REDIS_URL', 'redis://'),
-                        cors_allowed_origins=socket_io_allowed_origin, cors_credentials=True, manage_session=False)
+                        cors_allowed_origins=socket_io_allowed_origin, cors_credentials=True, manage_session=False,
+                        json=flask_json)
 
     # MONGO Access setup
     app.logger.info("Open MongoDAO")
@@ -78,8 +88,25 @@ def create_server_apps(config_file_path: str, static_folder_path: str,
     mongo_dao.init_indexes()
 
     # Session setup
-    app.logger.info("Setup Mongo-managed HTTP sessions")
-    app.session_interface = AutoCleanMongoSession(mongo_dao.session_col, threshold_cleaner=timedelta(hours=2))
+    session_store = app.config.get('SESSION_STORE', 'mongo')
+    if session_store == 'redis':
+        app.logger.info("Setup Redis-managed HTTP sessions")
+        redis_client = Redis.from_url(app.config.get('SESSION_REDIS_URL', app.config.get('REDIS_URL', 'redis://')))
+        app.session_interface = RedisSessionInterface(redis_client)
+    else:
+        if session_store != 'mongo':
+            LOG.error("Configuration error detected: unknown session store %s, use mongo instead", session_store)
+        app.logger.info("Setup Mongo-managed HTTP sessions")
+        app.session_interface = MongoSessionInterface(
+            mongo_dao.session_col,
+            partial_update=app.config.get('SESSION_MONGO_PARTIAL_UPDATE', False),
+            refresh_interval=app.config.get('SESSION_REFRESH_INTERVAL', timedelta(minutes=5)),
+            cache_size=app.config.get('SESSION_MONGO_CACHE_SIZE', 0))
+    if app.config.get('SESSION_STUDENT_STATELESS', False):
+        app.logger.info("Setup stateless student sessions held by signed cookies")
+        app.session_interface = StatelessStudentSessionInterface(
+            app.session_interface,
+            refresh_interval=app.config.get('SESSION_REFRESH_INTERVAL', timedelta(minutes=5)))
 
     # validate token communication configuration and issue error is misconfig
     if app.config.get('TICKET_COM_SEND_MAIL', False) is False \
@@ -126,12 +153,46 @@ def create_server_apps(config_file_path: str, static_folder_path: str,
             LOG.warning("Websocket connection refused {}".format(str(e)))
             return False
         else:
-            update_session_ws_sid(request.sid)
+            # the student room is used to reach a student holding a stateless session, that cannot record the ws id
+            join_room(get_student_ws_room())
+            if not session_is_stateless():
+                update_session_ws_sid(request.sid)
             emit('info', {'message': 'Welcome'})
 
+    # actions of a websocket connection are handled one at a time, in the order they are received
+    ws_action_turns = KeyedTurnQueue()
+
+    @socketio.on('action')
+    def handle_ws_action(action_data):
+        try:
+            if not has_logged_session() or not session_is_student():
+                raise Unauthorized("Authentication with proper role required")
+            if session_is_stateless() and isinstance(action_data, dict) \
+                    and action_data.get('action_type') in (START_EXAM_TYPE, SUBMIT_EXAM_TYPE):
+                # a stateless session cannot be updated through the websocket: the action must be sent over HTTP
+                raise Conflict("Action must be sent over HTTP")
+            return ws_action_turns.run(request.sid, studentActionService.handle_action, action_data)
+        except Exception as e:
+            return build_error_message(e)
+
+    @socketio.on('cancel')
+    def handle_ws_cancel(cancel_data):
+        try:
+            if not has_logged_session() or not session_is_student():
+                raise Unauthorized("Authentication with proper role required")
+            if not isinstance(cancel_data, dict) or not cancel_data.get('action_id'):
+                raise BadRequest("Missing action id")
+            return studentActionService.cancel_chat_prompt(cancel_data['action_id'])
+        except Exception as e:
+            return build_error_message(e)
+
     @socketio.on('disconnect')
     def test_disconnect():
-        pass
+        try:
+            # nobody will receive the answers sent to this websocket (a stateless session addresses the student room)
+            chat_ai_mgr.cancel_user_prompts(request.sid)
+        finally:
+            ws_action_turns.forget(request.sid)
 
     return app, socketio, chat_ai_mgr
 
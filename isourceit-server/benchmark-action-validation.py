@@ -0,0 +1,47 @@
+import timeit
+from argparse import ArgumentParser
+from datetime import datetime
+
+import pydantic
+
+from mongoModel.StudentAction import STUDENT_ACTION_TYPE_MAPPING, LOST_FOCUS_TYPE, CHANGED_QUESTION_TYPE, \
+    WROTE_INITIAL_ANSWER_TYPE, ASK_CHAT_AI_TYPE
+from mongoModel.modelValidators import validate_model
+
+
+def setup_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Measure the per-action validation cost, with a pydantic model built "
+                                        "per validation and with the precompiled validator registry")
+    parser.add_argument('-n', '--number', help='Number of validations per action type (default: 2000)',
+                        metavar='<number>', type=int, default=2000)
+    return parser
+
+
+def build_action_samples():
+    base = dict(timestamp=datetime.utcnow(), exam_id='64a2f0c1e4b0a1b2c3d4e5f6', question_idx=0,
+                student_username='student@my-school.com')
+    return {
+        LOST_FOCUS_TYPE: dict(base, action_type=LOST_FOCUS_TYPE, return_timestamp=datetime.utcnow(),
+                              duration_seconds=12, page_hidden=True),
+        CHANGED_QUESTION_TYPE: dict(base, action_type=CHANGED_QUESTION_TYPE, next_question_idx=1),
+        WROTE_INITIAL_ANSWER_TYPE: dict(base, action_type=WROTE_INITIAL_ANSWER_TYPE, text='My initial answer'),
+        ASK_CHAT_AI_TYPE: dict(base, action_type=ASK_CHAT_AI_TYPE, prompt='What is a monad?', chat_id='chat-1',
+                               chat_key='openai', model_key='gpt-3.5-turbo'),
+    }
+
+
+def validate_with_model_per_call(action_class, action_data):
+    return pydantic.create_model_from_typeddict(action_class)(**action_data).dict()
+
+
+if __name__ == '__main__':
+    arg_parser = setup_argument_parser()
+    args = arg_parser.parse_args()
+    print("{:<22} {:>16} {:>16} {:>8}".format('action type', 'per call (µs)', 'registry (µs)', 'speedup'))
+    for action_type, action_data in build_action_samples().items():
+        action_class = STUDENT_ACTION_TYPE_MAPPING[action_type]
+        before = timeit.timeit(lambda: validate_with_model_per_call(action_class, action_data),
+                               number=args.number) / args.number * 1e6
+        after = timeit.timeit(lambda: validate_model(action_class, action_data),
+                              number=args.number) / args.number * 1e6
+        print("{:<22} {:>16.1f} {:>16.1f} {:>7.1f}x".format(action_type, before, after, before / after))
@@ -0,0 +1,178 @@
+# Required to have subprocess emitting on server websocket, as the server
+import eventlet
+
+eventlet.monkey_patch()
+
+import os
+import pickle
+from argparse import ArgumentParser
+from datetime import datetime
+from time import monotonic
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from flask import Config
+from redis import Redis
+
+from mongoDAO.MongoDAO import MongoDAO
+from mongoDAO.studentActionRepository import create_student_action
+from mongoModel.StudentAction import AskChatAI, ASK_CHAT_AI_TYPE
+from services.ChatAIManager import ChatAIManager
+from services.chatAI.RedisStreamResponseQueue import RedisStreamResponseQueue
+from services.chatAI.ShardedResponseQueue import ShardedResponseQueue
+
+SOCKETIO_CHANNEL = 'flask-socketio'
+PERCENTILES = (50, 90, 99)
+
+
+def setup_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Drive simulated students through the chat pipeline (prompt scheduling, "
+                                        "OpenAI handler, answer relay) against an OpenAI-compatible server, "
+                                        "eg.: mock-openai-server.py, and report time to first token, end-to-end "
+                                        "latency and relay lag. Uses the mongo database and redis of the "
+                                        "configuration: prefer a dedicated database, the chat model descriptions "
+                                        "are reset as on server start.")
+    parser.add_argument('-c', '--config', help="Configuration file location (default: ./config.py)",
+                        metavar='<configuration file>', type=str, default='./config.py')
+    parser.add_argument('--url', help='OpenAI-compatible API base url (default: http://127.0.0.1:8089/v1)',
+                        type=str, default='http://127.0.0.1:8089/v1')
+    parser.add_argument('-m', '--model', help='Model to request (default: gpt-3.5-turbo)', type=str,
+                        default='gpt-3.5-turbo')
+    parser.add_argument('-n', '--students', help='Number of simulated students (default: 100)', type=int,
+                        default=100)
+    parser.add_argument('-p', '--prompts', help='Number of prompts per student (default: 3)', type=int, default=3)
+    parser.add_argument('--think-time', help='Seconds between the answer and the next prompt of a student '
+                                             '(default: 1)', type=float, default=1)
+    parser.add_argument('--ramp-up', help='Seconds over which students start (default: 5)', type=float, default=5)
+    parser.add_argument('--timeout', help='Seconds to wait for an answer (default: 120)', type=float, default=120)
+    return parser
+
+
+class PipelineProbe:
+    """
+    Time the prompts through the pipeline: sent to the chat manager, put on the response queue by the handler, and
+    emitted to the student by the relay (read from the socketio message queue).
+    """
+
+    def __init__(self):
+        self.sent: Dict[str, float] = dict()
+        self.first_emitted: Dict[str, float] = dict()
+        self.end_queued: Dict[str, float] = dict()
+        self.end_emitted: Dict[str, float] = dict()
+        self._answered: Dict[str, eventlet.Event] = dict()
+
+    def instrument(self, queue_class) -> None:
+        # record when the handler puts the end of an answer on the response queue
+        put = queue_class.put
+
+        def timed_put(queue, response: Dict, *args, **kwargs):
+            if response.get('ended') is True and response.get('action_id') in self.sent:
+                self.end_queued[response['action_id']] = monotonic()
+            return put(queue, response, *args, **kwargs)
+
+        queue_class.put = timed_put
+
+    def prompt_sent(self, action_id: str) -> eventlet.Event:
+        self.sent[action_id] = monotonic()
+        answered = eventlet.Event()
+        self._answered[action_id] = answered
+        return answered
+
+    def listen(self, redis_url: str) -> None:
+        pubsub = Redis.from_url(redis_url).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(SOCKETIO_CHANNEL)
+        for message in pubsub.listen():
+            now = monotonic()
+            try:
+                emit = pickle.loads(message['data'])
+            except Exception:
+                continue
+            if emit.get('method') != 'emit' or emit.get('event') != 'answer':
+                continue
+            response = emit.get('data') or dict()
+            action_id = response.get('action_id')
+            if action_id not in self._answered:
+                continue
+            if response.get('answer') and action_id not in self.first_emitted:
+                self.first_emitted[action_id] = now
+            if response.get('ended') is True:
+                self.end_emitted[action_id] = now
+                self._answered.pop(action_id).send(True)
+
+
+def percentiles(durations: List[float]) -> List[Optional[float]]:
+    if not durations:
+        return [None] * (len(PERCENTILES) + 1)
+    durations = sorted(durations)
+    return [durations[min(len(durations) - 1, int(len(durations) * p / 100))] for p in PERCENTILES] + [durations[-1]]
+
+
+def print_report(probe: PipelineProbe, elapsed: float, nb_timeouts: int) -> None:
+    nb_answered = len(probe.end_emitted)
+    print("{} prompts sent, {} answered, {} timed out in {:.1f}s ({:.1f} answers/s)".format(
+        len(probe.sent), nb_answered, nb_timeouts, elapsed, nb_answered / elapsed if elapsed > 0 else 0))
+    print("{:<24} {:>10} {:>10} {:>10} {:>10}".format('(ms)', *['p{}'.format(p) for p in PERCENTILES], 'max'))
+    measures = (
+        ('time to first token', [probe.first_emitted[a] - probe.sent[a] for a in probe.first_emitted]),
+        ('end-to-end latency', [probe.end_emitted[a] - probe.sent[a] for a in probe.end_emitted]),
+        ('relay lag (answer end)', [probe.end_emitted[a] - probe.end_queued[a] for a in probe.end_emitted
+                                    if a in probe.end_queued]),
+    )
+    for title, durations in measures:
+        print("{:<24} {:>10} {:>10} {:>10} {:>10}".format(title, *['-' if d is None else '{:.0f}'.format(d * 1000)
+                                                                   for d in percentiles(durations)]))
+
+
+def simulate_student(args, mongo_dao: MongoDAO, chat_ai_mgr: ChatAIManager, probe: PipelineProbe, exam_id: str,
+                     student_idx: int, timeouts: List[str]) -> None:
+    username = 'bench-student-{}'.format(student_idx)
+    user_sid = 'bench-sid-{}'.format(student_idx)
+    for prompt_idx in range(args.prompts):
+        action = AskChatAI(action_type=ASK_CHAT_AI_TYPE, timestamp=datetime.utcnow(), exam_id=exam_id,
+                           student_username=username, question_idx=0, chat_id='OPENAI.{}'.format(args.model),
+                           chat_key='OPENAI', model_key=args.model,
+                           prompt='Question {} of {}: what should I look at first?'.format(prompt_idx, username))
+        action_id = create_student_action(mongo_dao, action)
+        action.pop('_id', None)
+        answered = probe.prompt_sent(action_id)
+        chat_ai_mgr.process_prompt(action_id, action, user_sid, private_key='bench-key')
+        if answered.wait(args.timeout) is None:
+            timeouts.append(action_id)
+            return
+        eventlet.sleep(args.think_time)
+
+
+def main(args):
+    config = Config(os.getcwd())
+    config.from_pyfile(args.config)
+    config['CHATAI_OPENAI_ENABLED'] = True
+    config['CHATAI_OPENAI_BASE_URL'] = args.url
+    config.setdefault('LOG_LEVEL', 'WARNING')
+    mongo_dao = MongoDAO(MongoDAO.compute_dao_options_from_app(config))
+    mongo_dao.open()
+
+    probe = PipelineProbe()
+    probe.instrument(ShardedResponseQueue)
+    probe.instrument(RedisStreamResponseQueue)
+    eventlet.spawn(probe.listen, config.get('REDIS_URL', 'redis://'))
+    chat_ai_mgr = ChatAIManager(dict(config))
+    chat_ai_mgr.start()
+
+    exam_id = str(ObjectId())
+    timeouts: List[str] = []
+    start = monotonic()
+    pool = eventlet.GreenPool(args.students)
+    for student_idx in range(args.students):
+        pool.spawn(simulate_student, args, mongo_dao, chat_ai_mgr, probe, exam_id, student_idx, timeouts)
+        eventlet.sleep(args.ramp_up / args.students)
+    pool.waitall()
+    print_report(probe, monotonic() - start, len(timeouts))
+
+    mongo_dao.student_action_col.delete_many({'exam_id': exam_id})
+    mongo_dao.close()
+
+
+if __name__ == '__main__':
+    arg_parser = setup_argument_parser()
+    args = arg_parser.parse_args()
+    main(args)
@@ -15,6 +15,20 @@ SESSION_COOKIE_HTTPONLY = True  # default True
 SESSION_COOKIE_SECURE = False  # default False
 SESSION_PERMANENT = True  # default True
 PERMANENT_SESSION_LIFETIME = timedelta(hours=2)  # default None (the cookie has a browser session lifetime)
+# Session store: 'mongo' (default) or 'redis'. With redis, session expiration relies on native key TTL
+SESSION_STORE = 'mongo'
+# SESSION_REDIS_URL = 'redis://redis:6379'  # default REDIS_URL
+# Mongo store only: skip writing unchanged sessions and update changed keys only (default False)
+# SESSION_MONGO_PARTIAL_UPDATE = False
+# Mongo store with partial update only: minimal interval between expiration and cookie refreshes (default 5 minutes)
+# SESSION_REFRESH_INTERVAL = timedelta(minutes=5)
+# Mongo store only: number of sessions kept unserialized in memory, reused while their version is unchanged.
+# The cache is kept by each server process. 0 to disable (default 0)
+# SESSION_MONGO_CACHE_SIZE = 1000
+# Keep student composition sessions in a signed cookie, rotated on change, instead of the session store.
+# Teacher and admin sessions stay in the store. As the websocket connection cannot update such a cookie, answers are
+# sent to a per-student websocket room (default False)
+SESSION_STUDENT_STATELESS = False
 
 # REDIS CONNECTION CONFIGURATION (used for websocket and asynchronous processing
 REDIS_URL = 'redis://redis:6379'  # default redis://
@@ -73,6 +87,10 @@ MAIL_ASCII_ATTACHMENTS = False  # default False
 # Temporary folder to generate archives of pdf
 PDF_TEMP_DIR = './temppdf'  # default /tmp
 
+# STUDENT ACTIONS CONFIGURATION
+# Maximum number of actions accepted by a single batch request (default 100)
+COMPOSITION_ACTION_BATCH_MAX_SIZE = 100
+
 # SOCRAT CONFIGURATION
 DEFAULT_SOCRAT_INIT_PROMPT = """You should act as professor who follows the socratic approach for teaching.
 I will give you a question and a final answer. 
@@ -83,14 +101,84 @@ Change the questions based on the answer of the students."""
 DEFAULT_SOCRAT_CHAT_TEMPERATURE = 0.2
 
 # CHAT AI INTEGRATION
+# Answer relay: number of worker processes relaying chat answers. Answers of a prompt are always relayed by the same
+# worker. A stopped worker is restarted by a monitor checking workers every interval (in seconds). (default 1 and 5)
+# CHATAI_RELAY_WORKERS = 1
+# CHATAI_RELAY_MONITOR_SECONDS = 5
+# Answer relay: transport of the chat AI responses to the relay workers. 'process': in-memory queues of the server
+# process. 'redis-stream': redis streams (consumer group), so that handlers and relays of any server replica share
+# responses (CHATAI_RELAY_WORKERS must then be the same on every replica). Each stream is relayed by a single worker at
+# a time, holding a lease: when it expires (in seconds), another worker takes over the unacknowledged responses.
+# Streams are trimmed to about max len entries. (default 'process', 30 seconds and 10000 entries)
+# CHATAI_RESPONSE_QUEUE = 'process'
+# CHATAI_RESPONSE_STREAM_LEASE_SECONDS = 30
+# CHATAI_RESPONSE_STREAM_MAX_LEN = 10000
+# Answer relay, 'process' transport only: each worker queue holds at most max size responses. When full, handlers
+# wait for at most the put timeout (in seconds), then drop the answer chunk, counted in the relay metrics: the rest
+# of the answer is dropped too and the answer is saved as truncated. Prompt ends are never dropped.
+# (default 10000 responses and 1 second)
+# CHATAI_RELAY_QUEUE_MAX_SIZE = 10000
+# CHATAI_RELAY_QUEUE_PUT_TIMEOUT_SECONDS = 1
+# Answer relay: streamed answer chunks of a prompt are relayed (saved and sent to the student) at once when the
+# window (in milliseconds) since the first buffered chunk elapsed, or when enough characters have been buffered.
+# A window of 0 relays every chunk. (default 50 ms and 200 characters)
+# CHATAI_RELAY_COALESCE_WINDOW_MS = 50
+# CHATAI_RELAY_COALESCE_MAX_CHARS = 200
+# Answers are saved once achieved. Meanwhile, they are checkpointed in database every interval (in seconds), and
+# partial answers are kept in redis for composition reloads. (default 5 seconds)
+# CHATAI_RELAY_CHECKPOINT_SECONDS = 5
 
 # Dalai Integration
 # if CHATAI_DALAI_URL not set, this integration is disabled
-# Access to the dalai webservice
+# Access to the dalai webservice, or a list of dalai webservices to balance prompts between them
 # CHATAI_DALAI_URL = 'http://dalai-server:3000'
+# CHATAI_DALAI_URL = ['http://dalai-server-1:3000', 'http://dalai-server-2:3000']
+# Each prompt goes to the least loaded connected dalai webservice. Unreachable webservices are retried every
+# CHATAI_DALAI_HEALTH_CHECK_SECONDS. The prompts of a conversation stay on the same webservice while it has at most
+# CHATAI_DALAI_AFFINITY_SLACK more prompts in progress than the least loaded one, -1 to disable (default 10 and 1)
+# CHATAI_DALAI_HEALTH_CHECK_SECONDS = 10
+# CHATAI_DALAI_AFFINITY_SLACK = 1
+# As dalai answers one prompt at a time, each webservice answers at most CHATAI_DALAI_MODEL_CONCURRENCY prompts of a
+# model at once. Other prompts wait in a queue, students being notified of their position (default 1)
+# CHATAI_DALAI_MODEL_CONCURRENCY = 1
 
 # OpenAI Integration
 # if CHATAI_OPENAI_ENABLED is set to True, OpenAI will be available
 # CHATAI_OPENAI_ENABLED = True
+# CHATAI_OPENAI_BASE_URL define the OpenAI-compatible API to request, eg.: the mock server of mock-openai-server.py
+# (default https://api.openai.com/v1)
+# CHATAI_OPENAI_BASE_URL = 'https://api.openai.com/v1'
 # CHATAI_OPENAI_POOL_SIZE define the number of threads to handle OpenAI chat requests (default 4)
 # CHATAI_OPENAI_POOL_SIZE = 4
+# CHATAI_OPENAI_ENGINE define how OpenAI answers are streamed: 'thread' streams each answer in a pool thread.
+# 'asyncio' streams them all from a single event loop thread, at most CHATAI_OPENAI_ASYNC_MAX_STREAMS at once, the pool
+# threads only preparing requests (default 'thread' and 200)
+# CHATAI_OPENAI_ENGINE = 'thread'
+# CHATAI_OPENAI_ASYNC_MAX_STREAMS = 200
+# OpenAI connections are kept alive by API key, with at most CHATAI_OPENAI_HTTP_POOL_SIZE connections per key, and
+# closed after CHATAI_OPENAI_HTTP_IDLE_TIMEOUT seconds unused (default the number of streams of the engine, and 300)
+# CHATAI_OPENAI_HTTP_POOL_SIZE = 200
+# CHATAI_OPENAI_HTTP_IDLE_TIMEOUT = 300
+# CHATAI_OPENAI_TRANSCRIPT_CACHE_SIZE define the number of conversations kept in memory to build OpenAI requests
+# without reading the whole conversation from database. Transcripts of conversations continued by another server
+# process are dropped through redis. 0 to disable (default 1000)
+# CHATAI_OPENAI_TRANSCRIPT_CACHE_SIZE = 1000
+# CHATAI_CONTEXT_TOKEN_BUDGET define the approximate number of tokens of the conversation sent with a prompt, unless
+# set by the exam or socrat questionnaire. Older messages are omitted beyond it, except the opening socratic prompt.
+# 0 to send the whole conversation (default 3000)
+# CHATAI_CONTEXT_TOKEN_BUDGET = 3000
+# if CHATAI_OPENING_TURN_CACHE is set to True, the OpenAI answers to the opening hidden prompt of socratic
+# questionnaires, identical for every student of a question, are cached in redis for CHATAI_OPENING_TURN_CACHE_TTL
+# seconds and replayed to the next students. Authors may warm the cache before the questionnaire starts
+# (default False and 86400)
+# CHATAI_OPENING_TURN_CACHE = False
+# CHATAI_OPENING_TURN_CACHE_TTL = 86400
+# Prompts to remote chat services are scheduled: exams in turn, and students of an exam in turn, with at most
+# CHATAI_SCHEDULER_EXAM_CONCURRENCY prompts in progress per exam, and CHATAI_SCHEDULER_KEY_CONCURRENCY per API key
+# (lowered according to the rate limits of the service). Rate limited (429) or failed (5xx) prompts are retried up to
+# CHATAI_SCHEDULER_MAX_RETRIES times, with an exponential backoff starting at CHATAI_SCHEDULER_BACKOFF_SECONDS
+# (default 20, 50, 3 and 1 second)
+# CHATAI_SCHEDULER_EXAM_CONCURRENCY = 20
+# CHATAI_SCHEDULER_KEY_CONCURRENCY = 50
+# CHATAI_SCHEDULER_MAX_RETRIES = 3
+# CHATAI_SCHEDULER_BACKOFF_SECONDS = 1
@@ -21,3 +21,27 @@ def get_chat_available():
 @secured_endpoint(TEACHER_ROLE, ADMIN_ROLE)
 def get_default_socrat_init_prompt():
     return current_app.config.get('DEFAULT_SOCRAT_INIT_PROMPT')
+
+
+@app_controller.route("/api/rest/admin/app-settings/chat-relay-metrics", methods=['GET'])
+@secured_endpoint(ADMIN_ROLE)
+def get_chat_relay_metrics():
+    # load chat manager and return its answer relay workers metrics
+    chat_ai_mgr = ChatAIManager()
+    return chat_ai_mgr.relay_metrics
+
+
+@app_controller.route("/api/rest/admin/app-settings/chat-handler-metrics", methods=['GET'])
+@secured_endpoint(ADMIN_ROLE)
+def get_chat_handler_metrics():
+    # load chat manager and return the metrics of its chat handlers
+    chat_ai_mgr = ChatAIManager()
+    return chat_ai_mgr.handler_metrics
+
+
+@app_controller.route("/api/rest/admin/app-settings/chat-scheduler-metrics", methods=['GET'])
+@secured_endpoint(ADMIN_ROLE)
+def get_chat_scheduler_metrics():
+    # load chat manager and return the queues metrics of its prompt scheduler
+    chat_ai_mgr = ChatAIManager()
+    return chat_ai_mgr.scheduler_metrics
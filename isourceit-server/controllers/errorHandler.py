@@ -7,7 +7,7 @@ from pymongo.errors import DuplicateKeyError
 from werkzeug.exceptions import InternalServerError, HTTPException, NotFound
 from flask import current_app
 
-__all__ = ['error_handler']
+__all__ = ['error_handler', 'build_error_message']
 
 error_handler = Blueprint('error', __name__)
 
@@ -45,3 +45,20 @@ def handle_other_http_exception(e: HTTPException):
 def handle_other_exception(e: Exception):
     current_app.logger.warning("Unmanaged error: %s.", str(e))
     return ErrorMessage(error="Unmanaged error", details=str(e), type=type(e).__name__, code=500), 500
+
+
+def build_error_message(e: Exception) -> ErrorMessage:
+    """
+    Build the error message of an exception, as the error handlers do, for answers not sent through an HTTP response
+    (eg.: websocket acknowledgements)
+    """
+    if isinstance(e, (pydantic.ValidationError, werkzeug.exceptions.BadRequest, InvalidId)):
+        return ErrorMessage(error='bad request', details=str(e), code=400)
+    if isinstance(e, NotFound):
+        return ErrorMessage(error='resource not found', details=str(e), code=404)
+    if isinstance(e, DuplicateKeyError):
+        return ErrorMessage(error='duplicate exception', details=str(e), code=409)
+    if isinstance(e, HTTPException):
+        return ErrorMessage(error=e.description, details=str(e), code=e.code)
+    current_app.logger.warning("Unmanaged error: %s.", str(e))
+    return ErrorMessage(error="Unmanaged error", details=str(e), type=type(e).__name__, code=500)
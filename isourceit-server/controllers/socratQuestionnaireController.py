@@ -43,6 +43,12 @@ def generate_students_auth_urls(socrat_id: str):
     return securityService.initiate_all_student_composition_access(socrat_id, 'socrat')
 
 
+@socrat_controller.route("/api/rest/admin/socrats/<socrat_id>/opening-turns", methods=['POST'])
+@secured_endpoint(TEACHER_ROLE, ADMIN_ROLE)
+def warm_socrat_opening_turns(socrat_id: str):
+    return socratQuestionnaireService.warm_socrat_opening_turns(socrat_id)
+
+
 @socrat_controller.route("/api/rest/composition/socrats/<socrat_id>", methods=['GET'])
 @secured_endpoint(STUDENT_ROLE)
 def get_composition_socrat(socrat_id: str):
@@ -16,6 +16,13 @@ def send_action():
     return studentActionService.handle_action(data)
 
 
+@student_action_controller.route("/api/rest/composition/actions/batch", methods=['POST'])
+@secured_endpoint(STUDENT_ROLE)
+def send_actions_batch():
+    data = request.get_json(force=False)
+    return studentActionService.handle_actions_batch(data)
+
+
 @student_action_controller.route("/api/rest/composition/actions/external-resources/<action_id>", methods=['DELETE'])
 @secured_endpoint(STUDENT_ROLE)
 def delete_resource(action_id: str):
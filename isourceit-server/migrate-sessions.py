@@ -0,0 +1,37 @@
+import types
+from argparse import ArgumentParser
+from mongoDAO.MongoDAO import MongoDAO
+from sessions.MongoSession import MongoSessionInterface
+
+
+def setup_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Migrate the Mongo sessions stored in a legacy format (pickled data) to "
+                                        "native fields. To run once, after upgrading from a legacy version")
+    parser.add_argument('-c', '--config', help="Configuration file location (default: ./config.py)",
+                        metavar='<configuration file>', type=str, default='./config.py')
+    return parser
+
+
+def read_config_file(config_path: str):
+    d = types.ModuleType("config")
+    d.__file__ = config_path
+    try:
+        with open(config_path, mode="rb") as config_file:
+            exec(compile(config_file.read(), config_path, "exec"), d.__dict__)
+        configuration = dict()
+        for key in dir(d):
+            if key.isupper():
+                configuration[key] = getattr(d, key)
+        return configuration
+    except OSError as e:
+        e.strerror = f"Unable to load configuration file ({e.strerror})"
+        raise
+
+
+if __name__ == '__main__':
+    arg_parser = setup_argument_parser()
+    args = arg_parser.parse_args()
+    config = read_config_file(args.config)
+    with MongoDAO(MongoDAO.compute_dao_options_from_app(config)) as mongo_dao:
+        nb_migrated_sessions = MongoSessionInterface(mongo_dao.session_col).migrate_legacy_sessions()
+        print("{} sessions migrated to native fields".format(nb_migrated_sessions))
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import random
+import time
+from argparse import ArgumentParser
+from itertools import cycle
+from typing import Dict, Iterator, List, Optional
+
+from aiohttp import web
+
+DEFAULT_ANSWER = "Let us think about it step by step. What do you already know about the question? " \
+                 "Which part of the scenario seems the most important to you, and why?"
+
+
+def setup_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="OpenAI-compatible chat completion mock server, streaming answers without "
+                                        "requesting OpenAI (set CHATAI_OPENAI_BASE_URL to http://<host>:<port>/v1)")
+    parser.add_argument('--host', help='Listening host (default: 127.0.0.1)', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Listening port (default: 8089)', type=int, default=8089)
+    parser.add_argument('--ttft', help='Time to first token, in milliseconds (default: 300)', type=float,
+                        default=300)
+    parser.add_argument('--ttft-jitter', help='Uniform jitter of the time to first token, in milliseconds '
+                                              '(default: 100)', type=float, default=100)
+    parser.add_argument('--token-rate', help='Streamed tokens per second (default: 50)', type=float, default=50)
+    parser.add_argument('--answer-tokens', help='Number of tokens of the generated answers (default: 100)',
+                        type=int, default=100)
+    parser.add_argument('--rate-429', help='Ratio of requests rejected with a 429 status (default: 0)', type=float,
+                        default=0)
+    parser.add_argument('--rate-5xx', help='Ratio of requests failed with a 503 status (default: 0)', type=float,
+                        default=0)
+    parser.add_argument('--retry-after', help='Retry-after header of the 429 responses, in seconds (default: 1)',
+                        type=float, default=1)
+    parser.add_argument('-r', '--replay', help='File of recorded streams to replay, one JSON list of event data per '
+                                               'line (see test-openai-chatbot.py --record)', type=str, required=False)
+    return parser
+
+
+def load_recorded_streams(file_path: str) -> List[List[str]]:
+    with open(file_path) as record_file:
+        return [json.loads(line) for line in record_file if line.strip()]
+
+
+def generate_events(model: str, nb_tokens: int) -> Iterator[str]:
+    """
+    Generate the event data of an answer stream, as sent by OpenAI
+    """
+    completion_id = 'chatcmpl-mock{}'.format(random.getrandbits(48))
+    created = int(time.time())
+
+    def chunk(delta: Dict, finish_reason: Optional[str] = None) -> str:
+        return json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                           'model': model, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})
+
+    yield chunk({'role': 'assistant'})
+    words = DEFAULT_ANSWER.split(' ')
+    for token_idx in range(nb_tokens):
+        yield chunk({'content': (' ' if token_idx > 0 else '') + words[token_idx % len(words)]})
+    yield chunk({}, 'stop')
+    yield '[DONE]'
+
+
+class MockOpenAIServer:
+    """
+    Chat completion endpoint streaming generated or recorded answers, after a time to first token and at a token
+    rate, and rejecting a ratio of requests with 429 or 503 statuses.
+    """
+
+    def __init__(self, args):
+        self._args = args
+        self._recorded_streams: Optional[Iterator[List[str]]] = None
+        if args.replay:
+            recorded_streams = load_recorded_streams(args.replay)
+            if not recorded_streams:
+                raise Exception('No recorded stream to replay in {}'.format(args.replay))
+            self._recorded_streams = cycle(recorded_streams)
+        self._stats = dict(requests=0, streams=0, in_flight=0, rejected_429=0, failed_5xx=0)
+
+    def _next_events(self, model: str) -> List[str]:
+        if self._recorded_streams is not None:
+            return next(self._recorded_streams)
+        return list(generate_events(model, self._args.answer_tokens))
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self._stats['requests'] += 1
+        body = await request.json()
+        draw = random.random()
+        if draw < self._args.rate_429:
+            self._stats['rejected_429'] += 1
+            return web.json_response({'error': {'message': 'Rate limit reached', 'type': 'requests'}}, status=429,
+                                     headers={'retry-after': str(self._args.retry_after),
+                                              'x-ratelimit-remaining-requests': '0'})
+        if draw < self._args.rate_429 + self._args.rate_5xx:
+            self._stats['failed_5xx'] += 1
+            return web.json_response({'error': {'message': 'Service unavailable', 'type': 'server_error'}},
+                                     status=503)
+        events = self._next_events(body.get('model', 'gpt-3.5-turbo'))
+        ttft = max(0.0, self._args.ttft + random.uniform(-1, 1) * self._args.ttft_jitter) / 1000
+        self._stats['in_flight'] += 1
+        try:
+            await asyncio.sleep(ttft)
+            if not body.get('stream'):
+                return web.json_response(self._complete(events))
+            self._stats['streams'] += 1
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            token_interval = 1 / self._args.token_rate if self._args.token_rate > 0 else 0
+            for event_idx, event_data in enumerate(events):
+                if event_idx > 1 and token_interval:
+                    await asyncio.sleep(token_interval)
+                await response.write('data: {}\n\n'.format(event_data).encode())
+            await response.write_eof()
+            return response
+        finally:
+            self._stats['in_flight'] -= 1
+
+    @staticmethod
+    def _complete(events: List[str]) -> Dict:
+        # non-streamed completion of the events
+        content = []
+        finish_reason = None
+        for event_data in events:
+            if event_data == '[DONE]':
+                break
+            choice = json.loads(event_data)['choices'][0]
+            content.append(choice['delta'].get('content', ''))
+            finish_reason = choice.get('finish_reason') or finish_reason
+        return {'object': 'chat.completion', 'choices': [{'index': 0, 'finish_reason': finish_reason,
+                                                          'message': {'role': 'assistant',
+                                                                      'content': ''.join(content)}}]}
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self._stats)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+
+if __name__ == '__main__':
+    arg_parser = setup_argument_parser()
+    args = arg_parser.parse_args()
+    print("Mock OpenAI server listening on http://{}:{}/v1".format(args.host, args.port))
+    web.run_app(MockOpenAIServer(args).create_app(), host=args.host, port=args.port, print=None)
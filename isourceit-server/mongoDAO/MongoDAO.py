@@ -8,6 +8,7 @@ from pymongo.collection import Collection
 from pymongo.database import Database
 
 from mongoModel.ChatAIDescription import ChatAIDescription
+from mongoModel.CompositionState import CompositionState
 from mongoModel.Exam import Exam
 from mongoModel.ReportArchive import ReportArchive
 from mongoModel.SocratQuestionnaire import SocratQuestionnaire
@@ -24,6 +25,7 @@ USER_COL = 'users'
 CHAT_AI_DESC_COL = 'chatAIDescriptions'
 SESSION_COL = 'flaskSessions'
 REPORT_ARCHIVE_COL = 'reportArchives'
+COMPOSITION_STATE_COL = 'compositionStates'
 
 LOG = logging.getLogger(__name__)
 
@@ -90,6 +92,12 @@ class MongoDAO(metaclass=Singleton):
             raise Exception('No available database')
         return self.__db[REPORT_ARCHIVE_COL]
 
+    @property
+    def composition_state_col(self) -> Collection[CompositionState]:
+        if self.__db is None:
+            raise Exception('No available database')
+        return self.__db[COMPOSITION_STATE_COL]
+
     @property
     def session_col(self) -> Collection:
         if self.__db is None:
@@ -139,6 +147,12 @@ class MongoDAO(metaclass=Singleton):
         self.student_action_col.create_index([('student_username', pymongo.ASCENDING), ('exam_id', pymongo.ASCENDING)])
         self.user_col.create_index('username', unique=True)
         self.report_archive_col.create_index('exam_id', unique=True)
+        self.session_col.create_index('exam_id', sparse=True)
+        self.composition_state_col.create_index([('exam_id', pymongo.ASCENDING),
+                                                 ('student_username', pymongo.ASCENDING)], unique=True)
+        self.composition_state_col.create_index('questions.chat_turns.id')
+        # expired sessions are removed by mongo
+        self.session_col.create_index('expiration', expireAfterSeconds=0)
 
     @staticmethod
     def compute_dao_options_from_app(app_config: Dict):
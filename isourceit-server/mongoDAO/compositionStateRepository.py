@@ -0,0 +1,120 @@
+from datetime import datetime
+from typing import Optional, Mapping
+
+from pymongo.errors import DuplicateKeyError
+
+from mongoDAO.MongoDAO import MongoDAO
+from mongoModel.CompositionState import CompositionState
+
+__all__ = ['find_composition_state', 'create_composition_state', 'replace_composition_state',
+           'delete_composition_state', 'start_composition_state', 'update_composition_state',
+           'set_composition_chat_turn_answer', 'remove_composition_resource']
+
+
+def find_composition_state(dao: MongoDAO, exam_id: str, username: str) -> Optional[CompositionState]:
+    if not exam_id or not username:
+        raise Exception('Exam id and username required to find composition state')
+    return dao.composition_state_col.find_one({
+        'exam_id': exam_id,
+        'student_username': username
+    })
+
+
+def create_composition_state(dao: MongoDAO, state: CompositionState) -> bool:
+    """
+    Create a composition state, unless one already exists for the exam and student
+    :return: True if the state has been created
+    """
+    if not state:
+        raise Exception('Composition state required to create composition state')
+    try:
+        dao.composition_state_col.insert_one(state)
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def replace_composition_state(dao: MongoDAO, state: CompositionState) -> None:
+    if not state:
+        raise Exception('Composition state required to replace composition state')
+    dao.composition_state_col.replace_one({
+        'exam_id': state['exam_id'],
+        'student_username': state['student_username']
+    }, state)
+
+
+def delete_composition_state(dao: MongoDAO, exam_id: str, username: str, applied_after: datetime = None) -> None:
+    """
+    Delete a composition state
+    :param applied_after: if given, delete the state only if an action later than this timestamp has been applied
+    """
+    if not exam_id or not username:
+        raise Exception('Exam id and username required to delete composition state')
+    state_filter = {
+        'exam_id': exam_id,
+        'student_username': username
+    }
+    if applied_after is not None:
+        state_filter['last_action_timestamp'] = {'$gt': applied_after}
+    dao.composition_state_col.delete_one(state_filter)
+
+
+def start_composition_state(dao: MongoDAO, state: CompositionState) -> None:
+    if not state:
+        raise Exception('Composition state required to start composition state')
+    dao.composition_state_col.update_one({
+        'exam_id': state['exam_id'],
+        'student_username': state['student_username']
+    }, {
+        '$setOnInsert': state
+    }, upsert=True)
+
+
+def update_composition_state(dao: MongoDAO, exam_id: str, username: str, update: Mapping,
+                             timestamp: datetime = None) -> bool:
+    """
+    Apply an update to an existing composition state. A missing state is not created: it will be built from the
+    student actions when needed
+    :param timestamp: if given, the timestamp of the applied action: the state is updated only if no later action has
+    been applied
+    :return: True if a state has been updated
+    """
+    if not exam_id or not username:
+        raise Exception('Exam id and username required to update composition state')
+    state_filter = {
+        'exam_id': exam_id,
+        'student_username': username
+    }
+    if timestamp is not None:
+        state_filter['last_action_timestamp'] = {'$not': {'$gt': timestamp}}
+        update = dict(update, **{'$max': {'last_action_timestamp': timestamp}})
+    result = dao.composition_state_col.update_one(state_filter, update)
+    return result.matched_count > 0
+
+
+def set_composition_chat_turn_answer(dao: MongoDAO, chat_ai_id: str, answer: Optional[str],
+                                     achieved: bool = True, truncated: bool = False) -> None:
+    if not chat_ai_id:
+        raise Exception('Chat AI id required to set composition chat turn answer')
+    updates = {
+        'questions.$[].chat_turns.$[turn].answer': answer,
+        'questions.$[].chat_turns.$[turn].achieved': achieved
+    }
+    if truncated:
+        updates['questions.$[].chat_turns.$[turn].truncated'] = True
+    dao.composition_state_col.update_one({
+        'questions.chat_turns.id': chat_ai_id
+    }, {
+        '$set': updates
+    }, array_filters=[{'turn.id': chat_ai_id}])
+
+
+def remove_composition_resource(dao: MongoDAO, exam_id: str, username: str, question_idx: int,
+                                resource_id: str) -> None:
+    if not resource_id or question_idx is None:
+        raise Exception('External resource id and question idx required to remove composition resource')
+    update_composition_state(dao, exam_id, username, {
+        '$pull': {
+            'questions.{}.resources'.format(question_idx): {'id': resource_id}
+        }
+    })
@@ -0,0 +1,23 @@
+from datetime import datetime
+from typing import List
+
+from mongoDAO.MongoDAO import MongoDAO
+
+__all__ = ['find_active_ws_sids_for_exam']
+
+
+def find_active_ws_sids_for_exam(dao: MongoDAO, exam_id: str) -> List[str]:
+    if not exam_id:
+        raise Exception('Exam id required to find active websocket ids')
+    result = dao.session_col.find(
+        filter={
+            'exam_id': exam_id,
+            'ws_sid': {'$ne': None},
+            'expiration': {'$gt': datetime.utcnow()}
+        },
+        projection={
+            '_id': 0,
+            'ws_sid': 1
+        }
+    )
+    return [session['ws_sid'] for session in result]
@@ -8,7 +8,7 @@ from mongoDAO.MongoDAO import MongoDAO
 from mongoModel.StudentAction import StudentAction, ASK_CHAT_AI_TYPE, EXTERNAL_RESOURCE_TYPE, \
     STUDENT_ACTION_TYPE_MAPPING, START_EXAM_TYPE, SUBMIT_EXAM_TYPE
 
-__all__ = ['create_student_action', 'add_chat_ai_answer', 'mark_external_resource_removed',
+__all__ = ['create_student_action', 'create_student_actions', 'add_chat_ai_answer', 'mark_external_resource_removed',
            'get_actions_for_student_for_exam', 'update_chat_ai_answer', 'set_chat_ai_achieved',
            'find_last_chat_ai_model_interactions']
 
@@ -20,19 +20,31 @@ def create_student_action(dao: MongoDAO, student_action: StudentAction) -> str:
     return str(result.inserted_id)
 
 
-def add_chat_ai_answer(dao: MongoDAO, chat_ai_id: str, answer: str, achieved: bool = True) -> None:
+def create_student_actions(dao: MongoDAO, student_actions: List[StudentAction]) -> List[str]:
+    if not student_actions:
+        return []
+    result = dao.student_action_col.insert_many(student_actions, ordered=True)
+    return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+
+def add_chat_ai_answer(dao: MongoDAO, chat_ai_id: str, answer: str, achieved: bool = True,
+                       truncated: bool = False) -> None:
     if not chat_ai_id:
         raise Exception('Chat AI id required to add chat ai answer')
+    updates = {
+        'answer': answer,
+        'achieved': achieved
+    }
+    if truncated:
+        updates['truncated'] = True
     result = dao.student_action_col.update_one({
         '_id': ObjectId(chat_ai_id),
         'action_type': ASK_CHAT_AI_TYPE
     }, {
-        '$set': {
-            'answer': answer,
-            'achieved': achieved
-        }
+        '$set': updates
     })
-    if result.modified_count == 0:
+    # an unchanged answer (eg.: idle checkpoint) matches without being modified
+    if result.matched_count == 0:
         raise Exception('Chat AI Id not found or action type mismatch.')
 
 
@@ -58,18 +70,22 @@ def update_chat_ai_answer(dao: MongoDAO, chat_ai_id: str, answer: str, achieved:
         raise Exception('Chat AI Id not found or action type mismatch.')
 
 
-def set_chat_ai_achieved(dao: MongoDAO, chat_ai_id: str, achieved: bool) -> None:
+def set_chat_ai_achieved(dao: MongoDAO, chat_ai_id: str, achieved: bool, truncated: bool = False) -> None:
     if not chat_ai_id:
         raise Exception('Chat AI id required to add chat ai answer')
+    updates = {
+        'achieved': achieved
+    }
+    if truncated:
+        updates['truncated'] = True
     result = dao.student_action_col.update_one({
         '_id': ObjectId(chat_ai_id),
         'action_type': ASK_CHAT_AI_TYPE
     }, {
-        '$set': {
-            'achieved': achieved
-        }
+        '$set': updates
     })
-    if result.modified_count == 0:
+    # an already achieved answer matches without being modified
+    if result.matched_count == 0:
         raise Exception('Chat AI Id not found or action type mismatch.')
 
 
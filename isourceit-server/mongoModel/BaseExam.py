@@ -18,5 +18,6 @@ class BaseExam(TypedDict):
     owner_username: pydantic.StrictStr
     authors: List[Dict[pydantic.StrictStr, Any]]  # {username, firstname, lastname...}
     students: List[Dict[pydantic.StrictStr, Any]]  # {username, firstname, lastname...}
+    chat_context_token_budget: NotRequired[pydantic.StrictInt]  # approximate tokens of chat requests, 0 unlimited
 
     student_generation_auth_url: NotRequired[str]  # {not in bd}
@@ -0,0 +1,43 @@
+from datetime import datetime
+from typing import TypedDict, NotRequired, List, Optional
+
+from bson import ObjectId
+
+__all__ = ['CompositionChatTurn', 'CompositionResource', 'CompositionQuestionState', 'CompositionState']
+
+
+class CompositionChatTurn(TypedDict):
+    id: str  # id of the AskChatAI action
+    chat_id: str
+    prompt: Optional[str]
+    answer: Optional[str]
+    achieved: bool
+    truncated: NotRequired[bool]  # answer interrupted by the cancellation of the prompt
+    timestamp: datetime
+
+
+class CompositionResource(TypedDict):
+    id: str  # id of the ExternalResource action
+    title: str
+    description: str
+    rsc_type: Optional[str]
+    timestamp: datetime
+
+
+class CompositionQuestionState(TypedDict):
+    init_answer: Optional[str]
+    final_answer: Optional[str]
+    chat_turns: List[CompositionChatTurn]  # chat ids may contain dots, so they cannot be used as keys
+    resources: List[CompositionResource]
+
+
+class CompositionState(TypedDict):
+    _id: NotRequired[ObjectId]
+    exam_id: str
+    student_username: str
+    started: bool
+    started_timestamp: Optional[datetime]
+    ended: bool
+    current_question_idx: Optional[int]
+    last_action_timestamp: NotRequired[Optional[datetime]]  # timestamp of the latest applied action
+    questions: List[CompositionQuestionState]  # indexed by question idx
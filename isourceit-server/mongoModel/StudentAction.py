@@ -57,6 +57,7 @@ class AskChatAI(StudentAction):
     hidden_prompt: NotRequired[pydantic.StrictStr]
     answer: NotRequired[pydantic.StrictStr]
     achieved: NotRequired[pydantic.StrictBool]
+    truncated: NotRequired[pydantic.StrictBool]
     chat_id: pydantic.StrictStr
     chat_key: pydantic.StrictStr
     model_key: pydantic.StrictStr
@@ -0,0 +1,44 @@
+from typing import Any, Dict, Mapping, Type
+
+import pydantic
+
+from mongoModel.Exam import Exam
+from mongoModel.SocratQuestionnaire import SocratQuestionnaire
+from mongoModel.StudentAction import STUDENT_ACTION_TYPE_MAPPING
+from mongoModel.User import User
+
+__all__ = ['register_model_validator', 'get_model_validator', 'validate_model']
+
+# Pydantic models compiled once per TypedDict model, instead of once per validation
+__MODEL_VALIDATORS: Dict[Any, Type[pydantic.BaseModel]] = dict()
+
+
+def register_model_validator(model_class: Any) -> Type[pydantic.BaseModel]:
+    validator = __MODEL_VALIDATORS.get(model_class)
+    if validator is None:
+        validator = pydantic.create_model_from_typeddict(model_class)
+        __MODEL_VALIDATORS[model_class] = validator
+    return validator
+
+
+def get_model_validator(model_class: Any) -> Type[pydantic.BaseModel]:
+    validator = __MODEL_VALIDATORS.get(model_class)
+    if validator is None:
+        # model not registered at import: compile it now, once
+        validator = register_model_validator(model_class)
+    return validator
+
+
+def validate_model(model_class: Any, data: Mapping) -> Dict:
+    """
+    Validate data against a TypedDict model, using its precompiled pydantic model
+    :param model_class: the TypedDict model
+    :param data: the data to validate
+    :return: the validated data as a dict
+    :raise pydantic.ValidationError: if data do not match the model
+    """
+    return get_model_validator(model_class)(**data).dict()
+
+
+for __model_class in (Exam, SocratQuestionnaire, User, *STUDENT_ACTION_TYPE_MAPPING.values()):
+    register_model_validator(__model_class)
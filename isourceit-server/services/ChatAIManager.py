@@ -1,22 +1,27 @@
 import logging
+from datetime import datetime, timezone
 from multiprocessing import JoinableQueue, Process
+from threading import Thread
+from queue import Empty
 from time import sleep
-from typing import List, Any, Dict
-
-from flask_socketio import SocketIO
+from typing import List, Any, Dict, Optional, Tuple, Union
 
 from mongoDAO.MongoDAO import MongoDAO
-from mongoDAO.chatAIDescriptionRepository import clear_chatai_descriptions, find_all_chatai_descriptions, \
-    add_chatai_description
-from mongoDAO.studentActionRepository import update_chat_ai_answer, set_chat_ai_achieved
-from mongoModel.ChatAIDescription import ChatAIDescription
+from mongoDAO.chatAIDescriptionRepository import clear_chatai_descriptions, find_all_chatai_descriptions
 from mongoModel.Exam import Exam
 from mongoModel.SocratQuestionnaire import SocratQuestionnaire
 from mongoModel.StudentAction import AskChatAI
+from services.chatAI.ChatAnswerRelay import ChatAnswerRelay
 from services.chatAI.ChatAIHandler import ChatAIHandler
+from services.chatAI.ChatCatalog import ChatCatalog
 from services.chatAI.CopyPasteHandler import CopyPasteHandler
 from services.chatAI.DalaiHandler import DalaiHandler
+from services.chatAI.InFlightPrompts import InFlightPrompts
 from services.chatAI.OpenAIHandler import OpenAIHAndler
+from services.chatAI.PartialAnswerStore import PartialAnswerStore
+from services.chatAI.PromptScheduler import PromptScheduler
+from services.chatAI.RedisStreamResponseQueue import RedisStreamResponseQueue, RedisStreamShardConsumer
+from services.chatAI.ShardedResponseQueue import ShardedResponseQueue
 from utils.Singleton import Singleton
 
 __all__ = ['ChatAIManager']
@@ -25,79 +30,123 @@ from utils.loggingUtils import configure_logging
 
 LOG = logging.getLogger(__name__)
 
+PROMPT_TIMEOUT_CHECK_SECONDS = 1
+
 
-def handle_chat_answer(config: Dict, queue: JoinableQueue):
+def handle_chat_answer(config: Dict, queue: Union[JoinableQueue, RedisStreamShardConsumer], worker_idx: int = 0):
     # Since this function will be a new process, we need to re-configure logging, and ask for new connection
-    # (socketio, mongo)
+    # (socketio, mongo, redis)
     configure_logging(config.get('LOG_LEVEL'))
+    LOG.info("Chat answer relay worker %d started", worker_idx)
     try:
-        redis_url = config.get('REDIS_URL', 'redis://')
-        socketio = SocketIO(message_queue=redis_url)
         with MongoDAO(configuration=MongoDAO.compute_dao_options_from_app(config)) as mongo_dao:
+            relay = ChatAnswerRelay.from_config(mongo_dao, config)
             while True:
-                response: Dict = queue.get()
-                queue.task_done()
-
-                request_type = response.get('request_type')
-                if request_type == 'model':
-                    chat_key = response.get('chat_key')
-                    if chat_key is None:
-                        LOG.warning('Receive model answer with chat key')
-                        continue
-                    model_key = response.get('answer')
-                    if model_key is not None:
-                        description = ChatAIDescription(chat_key=chat_key, model_key=model_key)
-                        add_chatai_description(mongo_dao, description)
-                        LOG.info("New Chat AI Model discovered! %s : %s", chat_key, model_key)
-
-                elif request_type == 'prompt':
-                    action_id = response.get('action_id')
-                    user_sid = response.get('user_sid')
-                    if action_id is None or user_sid is None:
-                        LOG.warning('Receive response without chat_key or model_key or action_id or user_sid')
-                        continue
-                    # if answer is present, update action in db
-                    answer = response.get('answer')
-                    achieved = response.get('ended', False)
-                    if answer is not None:
-                        update_chat_ai_answer(mongo_dao, action_id, answer, achieved=achieved)
-                    elif achieved is True:
-                        set_chat_ai_achieved(mongo_dao, action_id, achieved=achieved)
-                    # remove user_sid from response to relay it
-                    response.pop('user_sid')
-                    socketio.emit('answer', response, room=user_sid)
-                else:
-                    LOG.warning('Receive response without allowed request_type: %s.', request_type)
+                # wait for a response, but no longer than the next coalescing window
+                try:
+                    response: Dict = queue.get(timeout=relay.time_to_next_flush())
+                except Empty:
+                    response = None
+                try:
+                    if response is not None:
+                        relay.handle_response(response)
+                    relay.flush_expired()
+                except Exception as e:
+                    LOG.warning("Error while relaying chat answer: %s", repr(e))
+                finally:
+                    # the response is done once relayed only
+                    if response is not None:
+                        queue.task_done()
     except KeyboardInterrupt:
         print("Stop AI answer handling process")
     finally:
         queue.close()
 
 
+def load_chat_catalog() -> List[Tuple[str, str]]:
+    return [(chat_desc['chat_key'], chat_desc['model_key'])
+            for chat_desc in find_all_chatai_descriptions(MongoDAO())]
+
+
 class ChatAIManager(metaclass=Singleton):
     def __init__(self, config: Dict = None):
-        self._answer_queue: JoinableQueue = JoinableQueue()
-        self._answer_process: Process = None
-        self._ai_handlers_by_chat_key: Dict[str, ChatAIHandler] = {}
         self._config: Dict = config
+        self._answer_queue: Union[ShardedResponseQueue, RedisStreamResponseQueue] = \
+            ChatAIManager._create_answer_queue(config)
+        self._answer_processes: List[Optional[Process]] = [None] * self._answer_queue.nb_shards
+        self._answer_process_restarts: List[int] = [0] * self._answer_queue.nb_shards
+        self._answer_monitor: Thread = None
+        # handlers answer through the in flight prompts, which forget ended prompts
+        self._in_flight_prompts = InFlightPrompts(self._answer_queue)
+        self._prompt_timeout_monitor: Thread = None
+        self._ai_handlers_by_chat_key: Dict[str, ChatAIHandler] = {}
+        self._partial_answer_store: PartialAnswerStore = PartialAnswerStore.from_url(
+            config.get('REDIS_URL', 'redis://')) if config is not None else None
+        self._prompt_scheduler: PromptScheduler = PromptScheduler.from_config(config) if config is not None \
+            else PromptScheduler()
+        # available models, kept in memory and updated through redis by every process
+        self._chat_catalog: Optional[ChatCatalog] = ChatCatalog.from_url(
+            config.get('REDIS_URL', 'redis://'), load_chat_catalog) if config is not None else None
         self._configure_handlers()
 
+    @staticmethod
+    def _create_answer_queue(config: Optional[Dict]) -> Union[ShardedResponseQueue, RedisStreamResponseQueue]:
+        if config is None:
+            return ShardedResponseQueue()
+        queue_type = config.get('CHATAI_RESPONSE_QUEUE', 'process')
+        if queue_type == 'redis-stream':
+            return RedisStreamResponseQueue.from_config(config)
+        if queue_type != 'process':
+            raise Exception('Unknown chat response queue type: {}'.format(queue_type))
+        return ShardedResponseQueue.from_config(config)
+
     def _configure_handlers(self):
         if self._config is not None:
             # According to config, instanciate different handler
             if 'CHATAI_DALAI_URL' in self._config:
-                h = DalaiHandler(self._answer_queue, self._config)
+                h = DalaiHandler(self._in_flight_prompts, self._config)
                 self._ai_handlers_by_chat_key[h.chat_key] = h
             if self._config.get('CHATAI_OPENAI_ENABLED', False) is True:
-                h = OpenAIHAndler(self._answer_queue, self._config)
+                h = OpenAIHAndler(self._in_flight_prompts, self._config)
                 self._ai_handlers_by_chat_key[h.chat_key] = h
         # Add copyPast
-        h = CopyPasteHandler(self._answer_queue)
+        h = CopyPasteHandler(self._in_flight_prompts)
         self._ai_handlers_by_chat_key[h.chat_key] = h
 
+    def _start_answer_process(self, worker_idx: int) -> None:
+        process = Process(target=handle_chat_answer,
+                          args=(self._config, self._answer_queue.shard(worker_idx), worker_idx),
+                          name='chat-answer-relay-{}'.format(worker_idx), daemon=True)
+        process.start()
+        self._answer_processes[worker_idx] = process
+
+    def _monitor_answer_processes(self) -> None:
+        check_interval = self._config.get('CHATAI_RELAY_MONITOR_SECONDS', 5) if self._config is not None else 5
+        while True:
+            sleep(check_interval)
+            for worker_idx, process in enumerate(self._answer_processes):
+                if process is not None and not process.is_alive():
+                    LOG.warning("Chat answer relay worker %d stopped (exit code %s), restart it", worker_idx,
+                                process.exitcode)
+                    self._answer_process_restarts[worker_idx] += 1
+                    self._start_answer_process(worker_idx)
+
+    def _monitor_prompt_timeouts(self) -> None:
+        while True:
+            sleep(PROMPT_TIMEOUT_CHECK_SECONDS)
+            for action_id in self._in_flight_prompts.find_expired():
+                self.cancel_prompt(action_id)
+            self._in_flight_prompts.forget_stale()
+
     def start(self):
-        self._answer_process = Process(target=handle_chat_answer, args=(self._config, self._answer_queue))
-        self._answer_process.start()
+        for worker_idx in range(self._answer_queue.nb_shards):
+            self._start_answer_process(worker_idx)
+        self._answer_monitor = Thread(target=self._monitor_answer_processes, name='chat-answer-relay-monitor',
+                                      daemon=True)
+        self._answer_monitor.start()
+        self._prompt_timeout_monitor = Thread(target=self._monitor_prompt_timeouts, name='chat-prompt-timeout-monitor',
+                                              daemon=True)
+        self._prompt_timeout_monitor.start()
         # Create connect all handler
         LOG.info("connect to all AI handler")
         for handler in self._ai_handlers_by_chat_key.values():
@@ -117,10 +166,13 @@ class ChatAIManager(metaclass=Singleton):
             LOG.warning("Warning: not all chat AI handler connected")
             for key, handler in self._ai_handlers_by_chat_key.items():
                 LOG.debug("- {}: {}".format(key, handler.connected))
-        # clear model desc in db
+        # clear model desc in db, then in the catalog of every process, listening before models are discovered
         LOG.debug("Clear chat AI model description in database")
         mongo_dao = MongoDAO()
         clear_chatai_descriptions(mongo_dao)
+        if self._chat_catalog is not None:
+            self._chat_catalog.start()
+            self._chat_catalog.clear()
 
         # for all connected handler, ask their model
         LOG.debug("Ask handler their models")
@@ -129,11 +181,13 @@ class ChatAIManager(metaclass=Singleton):
             handler.request_available_models(request_identifiers=request_identifiers)
         LOG.info("Chat AI Service ready")
 
+    def _chat_models(self) -> List[Tuple[str, str]]:
+        if self._chat_catalog is None:
+            return load_chat_catalog()
+        return self._chat_catalog.models
+
     def _generate_available_chats(self) -> Dict:
-        mongo_dao = MongoDAO()
-        for chat_desc in find_all_chatai_descriptions(mongo_dao):
-            chat_key = chat_desc['chat_key']
-            model_key = chat_desc['model_key']
+        for chat_key, model_key in self._chat_models():
             handler = self._ai_handlers_by_chat_key.get(chat_key)
             if handler is None:
                 LOG.warning("Got model associated to a chat key without any handler")
@@ -150,6 +204,30 @@ class ChatAIManager(metaclass=Singleton):
                 'privateKeyRequired': handler.private_key_required
             }
 
+    @property
+    def relay_metrics(self) -> List[Dict]:
+        return [{
+            'worker': worker_idx,
+            'alive': process is not None and process.is_alive(),
+            'pid': process.pid if process is not None else None,
+            'restarts': self._answer_process_restarts[worker_idx],
+            'queue_depth': self._answer_queue.depth(worker_idx),
+            'queue_overflows': self._answer_queue.overflows(worker_idx)
+        } for worker_idx, process in enumerate(self._answer_processes)]
+
+    @property
+    def handler_metrics(self) -> Dict[str, Dict]:
+        return dict((chat_key, handler.metrics) for chat_key, handler in self._ai_handlers_by_chat_key.items()
+                    if handler.metrics is not None)
+
+    @property
+    def scheduler_metrics(self) -> Dict:
+        return self._prompt_scheduler.metrics()
+
+    @property
+    def partial_answer_store(self) -> Optional[PartialAnswerStore]:
+        return self._partial_answer_store
+
     @property
     def available_chats(self) -> List[Dict]:
         return list(self._generate_available_chats())
@@ -182,8 +260,51 @@ class ChatAIManager(metaclass=Singleton):
                 choices.append(choice)
         return choices
 
+    def abandon_prompts(self, exam_id: str, student_username: str, question_idx: int) -> int:
+        return sum(handler.abandon_prompts(exam_id, student_username, question_idx)
+                   for handler in self._ai_handlers_by_chat_key.values())
+
+    def cancel_prompt(self, action_id: str) -> bool:
+        """
+        Cancel a prompt: removed from the scheduler queue if not sent yet, otherwise its handler stops answering it.
+        The prompt is ended with the answer received so far, marked as truncated.
+        :return: False if the prompt is not in flight or cannot be cancelled
+        """
+        prompt = self._in_flight_prompts.get(action_id)
+        if prompt is None:
+            return False
+        if self._prompt_scheduler.cancel(action_id):
+            return self._in_flight_prompts.end(action_id)
+        handler = self._ai_handlers_by_chat_key.get(prompt.chat_key)
+        return handler is not None and handler.cancel_prompt(action_id)
+
+    def cancel_user_prompts(self, user_sid: str) -> int:
+        """
+        Cancel the prompts whose answer is sent to a websocket
+        :return: the number of cancelled prompts
+        """
+        return sum(1 for action_id in self._in_flight_prompts.find(user_sid=user_sid) if self.cancel_prompt(action_id))
+
+    def cancel_student_prompts(self, exam_id: str, student_username: str) -> int:
+        """
+        Cancel the prompts of a student for an exam
+        :return: the number of cancelled prompts
+        """
+        return sum(1 for action_id in self._in_flight_prompts.find(exam_id=exam_id, student_username=student_username)
+                   if self.cancel_prompt(action_id))
+
+    def warm_opening_turn(self, chat_key: str, model_key: str, hidden_prompt: str, **kwargs) -> bool:
+        handler = self._ai_handlers_by_chat_key.get(chat_key)
+        if not handler:
+            raise Exception("Unmanaged chat: {}".format(chat_key))
+        return handler.warm_opening_turn(model_key, hidden_prompt, **kwargs)
+
     def process_prompt(self, action_id: str, action: AskChatAI, user_sid: str,
-                       private_key: str = None, custom_init_prompt: str = None, **kwargs) -> None:
+                       private_key: str = None, custom_init_prompt: str = None, deadline: datetime = None,
+                       **kwargs) -> None:
+        """
+        :param deadline: the time (UTC) after which the prompt is cancelled if still in flight, eg.: the exam timeout
+        """
         prompt = action['prompt'] if action.get('prompt') else action.get('hidden_prompt')
         if prompt is None:
             raise Exception("No prompt to process")
@@ -192,5 +313,22 @@ class ChatAIManager(metaclass=Singleton):
             raise Exception("Unmanaged chat: {}".format(action['chat_key']))
         request_identifiers = dict(request_type='prompt', question_idx=action['question_idx'],
                                    action_id=action_id, user_sid=user_sid, chat_id=action['chat_id'])
-        handler.send_prompt(action['model_key'], prompt, request_identifiers, private_key=private_key,
-                            action=action, custom_init_prompt=custom_init_prompt, **kwargs)
+        timeout = None
+        if deadline is not None:
+            if deadline.tzinfo is not None:
+                deadline = deadline.astimezone(timezone.utc).replace(tzinfo=None)
+            timeout = (deadline - datetime.utcnow()).total_seconds()
+        self._in_flight_prompts.add(request_identifiers, action['chat_key'], action['model_key'], action['exam_id'],
+                                    action['student_username'], timeout)
+        if not handler.supports_prompt_scheduling:
+            handler.send_prompt(action['model_key'], prompt, request_identifiers, private_key=private_key,
+                                action=action, custom_init_prompt=custom_init_prompt, **kwargs)
+            return
+        # the scheduler sends the prompt once its turn has come. A prompt abandoned after too many rejections is ended
+        self._prompt_scheduler.submit(
+            action['exam_id'], action['student_username'], private_key,
+            lambda on_completed: handler.send_prompt(action['model_key'], prompt, request_identifiers,
+                                                     private_key=private_key, action=action,
+                                                     custom_init_prompt=custom_init_prompt,
+                                                     on_completed=on_completed, **kwargs),
+            job_id=action_id, on_dropped=lambda: self._in_flight_prompts.end(action_id))
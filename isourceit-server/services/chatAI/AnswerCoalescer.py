@@ -0,0 +1,80 @@
+from time import monotonic
+from typing import Dict, List, Optional
+
+__all__ = ['AnswerCoalescer']
+
+
+class _PendingAnswer:
+    __slots__ = ['response', 'chunks', 'size', 'deadline']
+
+    def __init__(self, response: Dict, deadline: float):
+        self.response: Dict = response
+        self.chunks: List[str] = []
+        self.size: int = 0
+        self.deadline: float = deadline
+
+
+class AnswerCoalescer:
+    """
+    Buffer the streamed answer chunks of each prompt (by action id), to relay them as a single chunk once the window
+    has elapsed since the first buffered chunk, or once max_chars characters have been buffered.
+    An ended response always flushes its buffered chunks immediately, a queue position response is relayed immediately.
+    """
+    __slots__ = ['_window_seconds', '_max_chars', '_pending_answers']
+
+    def __init__(self, window_seconds: float, max_chars: int):
+        self._window_seconds = window_seconds
+        self._max_chars = max_chars
+        self._pending_answers: Dict[str, _PendingAnswer] = dict()
+
+    @staticmethod
+    def _merge(pending: _PendingAnswer, response: Dict = None) -> Dict:
+        merged = dict(response if response is not None else pending.response)
+        if response is not None and response.get('answer') is not None:
+            pending.chunks.append(response['answer'])
+        merged['answer'] = ''.join(pending.chunks) if pending.chunks else None
+        return merged
+
+    def add(self, response: Dict) -> Optional[Dict]:
+        """
+        Buffer a prompt response
+        :param response: the response, with its action_id, and optionally an answer chunk and an ended marker
+        :return: the response to relay, merging the buffered chunks, if the buffer has to be flushed
+        """
+        action_id = response.get('action_id')
+        pending = self._pending_answers.get(action_id)
+        if response.get('ended', False) is True:
+            if pending is None:
+                return response
+            del self._pending_answers[action_id]
+            return self._merge(pending, response)
+        answer = response.get('answer')
+        if answer is None:
+            return response if response.get('queue_position') is not None else None
+        if pending is None:
+            pending = _PendingAnswer(response, monotonic() + self._window_seconds)
+            self._pending_answers[action_id] = pending
+        pending.response = response
+        pending.chunks.append(answer)
+        pending.size += len(answer)
+        if pending.size >= self._max_chars or self._window_seconds <= 0:
+            del self._pending_answers[action_id]
+            return self._merge(pending)
+        return None
+
+    def pop_expired(self) -> List[Dict]:
+        """
+        :return: the responses to relay for buffers whose window has elapsed
+        """
+        now = monotonic()
+        expired_ids = [action_id for action_id, pending in self._pending_answers.items() if pending.deadline <= now]
+        return [self._merge(self._pending_answers.pop(action_id)) for action_id in expired_ids]
+
+    def time_to_next_flush(self) -> Optional[float]:
+        """
+        :return: the delay before the next buffer window elapses, or None if nothing is buffered
+        """
+        if not self._pending_answers:
+            return None
+        next_deadline = min(pending.deadline for pending in self._pending_answers.values())
+        return max(0.0, next_deadline - monotonic())
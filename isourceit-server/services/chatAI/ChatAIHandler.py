@@ -51,3 +51,41 @@ class ChatAIHandler(metaclass=ABCMeta):
     @abstractmethod
     def send_prompt(self, model: str, prompt: str, request_identifiers: Dict = None, **kwargs):
         pass
+
+    @property
+    def supports_prompt_scheduling(self) -> bool:
+        """
+        :return: True if send_prompt accepts an on_completed callback, called with the prompt outcome once over, so
+        that prompts can be scheduled by the prompt scheduler
+        """
+        return False
+
+    def abandon_prompts(self, exam_id: str, student_username: str, question_idx: int) -> int:
+        """
+        Abandon the prompts of a student for a question that are still waiting to be sent, ending them
+        :return: the number of abandoned prompts
+        """
+        return 0
+
+    def cancel_prompt(self, action_id: str) -> bool:
+        """
+        Stop answering a sent prompt: its upstream request is closed if possible, and the prompt is ended at once with
+        the answer received so far, marked as truncated
+        :return: False if the prompt is unknown or already answered
+        """
+        return False
+
+    def warm_opening_turn(self, model: str, hidden_prompt: str, **kwargs) -> bool:
+        """
+        Request in background the answer to the opening hidden prompt of a conversation, so that it is cached for the
+        students (see CHATAI_OPENING_TURN_CACHE)
+        :return: True if the answer is cached or requested, False if the handler does not cache opening turns
+        """
+        return False
+
+    @property
+    def metrics(self) -> Optional[Dict]:
+        """
+        :return: the handler metrics if any (eg.: cache hits)
+        """
+        return None
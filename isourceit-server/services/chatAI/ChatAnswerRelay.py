@@ -0,0 +1,149 @@
+import logging
+from time import monotonic
+from typing import Dict, List, Optional
+
+from flask_socketio import SocketIO
+
+from mongoDAO.MongoDAO import MongoDAO
+from mongoDAO.chatAIDescriptionRepository import add_chatai_description
+from mongoDAO.compositionStateRepository import set_composition_chat_turn_answer
+from mongoDAO.studentActionRepository import add_chat_ai_answer, set_chat_ai_achieved, find_action_by_id
+from mongoModel.ChatAIDescription import ChatAIDescription
+from services.chatAI.AnswerCoalescer import AnswerCoalescer
+from services.chatAI.ChatCatalog import ChatCatalog
+from services.chatAI.PartialAnswerStore import PartialAnswerStore
+
+__all__ = ['ChatAnswerRelay']
+
+LOG = logging.getLogger(__name__)
+
+
+class _StreamedAnswer:
+    __slots__ = ['chunks', 'size', 'last_checkpoint']
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.size: int = 0  # in bytes, as the partial answer store
+        self.last_checkpoint: float = monotonic()
+
+    @property
+    def answer(self) -> str:
+        return ''.join(self.chunks)
+
+    def append(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self.size += len(chunk.encode())
+
+    def reset(self, answer: str) -> None:
+        self.chunks = [answer]
+        self.size = len(answer.encode())
+
+
+class ChatAnswerRelay:
+    """
+    Relay the responses of the chat AI handlers: discovered models are saved and published to the chat catalog of
+    every process, prompt answers are sent to the students.
+    Answers are accumulated in memory and saved once achieved. Meanwhile, they are checkpointed in the database
+    every checkpoint_interval seconds, and the partial answer is kept in the partial answer store for reloads.
+    """
+
+    def __init__(self, mongo_dao: MongoDAO, socketio: SocketIO, partial_answer_store: PartialAnswerStore,
+                 coalescer: AnswerCoalescer, checkpoint_interval: float, chat_catalog: ChatCatalog):
+        self._mongo_dao = mongo_dao
+        self._chat_catalog = chat_catalog
+        self._socketio = socketio
+        self._partial_answer_store = partial_answer_store
+        self._coalescer = coalescer
+        self._checkpoint_interval = checkpoint_interval
+        self._streamed_answers: Dict[str, _StreamedAnswer] = dict()
+
+    @staticmethod
+    def from_config(mongo_dao: MongoDAO, config: Dict) -> 'ChatAnswerRelay':
+        redis_url = config.get('REDIS_URL', 'redis://')
+        return ChatAnswerRelay(mongo_dao, SocketIO(message_queue=redis_url),
+                               PartialAnswerStore.from_url(redis_url),
+                               AnswerCoalescer(config.get('CHATAI_RELAY_COALESCE_WINDOW_MS', 50) / 1000,
+                                               config.get('CHATAI_RELAY_COALESCE_MAX_CHARS', 200)),
+                               config.get('CHATAI_RELAY_CHECKPOINT_SECONDS', 5),
+                               ChatCatalog.from_url(redis_url, lambda: []))
+
+    def time_to_next_flush(self) -> Optional[float]:
+        return self._coalescer.time_to_next_flush()
+
+    def handle_response(self, response: Dict) -> None:
+        request_type = response.get('request_type')
+        if request_type == 'model':
+            chat_key = response.get('chat_key')
+            if chat_key is None:
+                LOG.warning('Receive model answer with chat key')
+                return
+            model_key = response.get('answer')
+            if model_key is not None:
+                description = ChatAIDescription(chat_key=chat_key, model_key=model_key)
+                add_chatai_description(self._mongo_dao, description)
+                self._chat_catalog.add(chat_key, model_key)
+                LOG.info("New Chat AI Model discovered! %s : %s", chat_key, model_key)
+
+        elif request_type == 'prompt':
+            action_id = response.get('action_id')
+            user_sid = response.get('user_sid')
+            if action_id is None or user_sid is None:
+                LOG.warning('Receive response without chat_key or model_key or action_id or user_sid')
+                return
+            # streamed answer chunks are coalesced to limit emits
+            coalesced_response = self._coalescer.add(response)
+            if coalesced_response is not None:
+                self._relay_prompt_response(coalesced_response)
+        else:
+            LOG.warning('Receive response without allowed request_type: %s.', request_type)
+
+    def flush_expired(self) -> None:
+        # relay answers whose coalescing window has elapsed
+        for coalesced_response in self._coalescer.pop_expired():
+            self._relay_prompt_response(coalesced_response)
+
+    def _accumulate_chunk(self, action_id: str, chunk: str) -> _StreamedAnswer:
+        streamed_answer = self._streamed_answers.get(action_id)
+        if streamed_answer is None:
+            streamed_answer = _StreamedAnswer()
+            self._streamed_answers[action_id] = streamed_answer
+        streamed_answer.append(chunk)
+        stored_size = self._partial_answer_store.append(action_id, chunk)
+        if stored_size != streamed_answer.size:
+            # the beginning of the answer has been relayed by a previous relay process: recover it
+            partial_answer = self._partial_answer_store.get(action_id)
+            if partial_answer is not None:
+                streamed_answer.reset(partial_answer)
+        return streamed_answer
+
+    def _save_achieved_answer(self, action_id: str, streamed_answer: Optional[_StreamedAnswer],
+                              truncated: bool = False) -> None:
+        answer = streamed_answer.answer if streamed_answer is not None \
+            else self._partial_answer_store.get(action_id)
+        if answer is not None:
+            add_chat_ai_answer(self._mongo_dao, action_id, answer, achieved=True, truncated=truncated)
+        else:
+            set_chat_ai_achieved(self._mongo_dao, action_id, achieved=True, truncated=truncated)
+            # the answer might have been checkpointed only
+            action = find_action_by_id(self._mongo_dao, action_id)
+            answer = action.get('answer') if action is not None else None
+        # once achieved, the answer is copied into the composition state of the student
+        set_composition_chat_turn_answer(self._mongo_dao, action_id, answer, truncated=truncated)
+        self._partial_answer_store.delete(action_id)
+
+    def _relay_prompt_response(self, response: Dict) -> None:
+        action_id = response.get('action_id')
+        chunk = response.get('answer')
+        achieved = response.get('ended', False) is True
+        streamed_answer = self._accumulate_chunk(action_id, chunk) if chunk is not None \
+            else self._streamed_answers.get(action_id)
+        if achieved:
+            self._streamed_answers.pop(action_id, None)
+            # a cancelled prompt is achieved with the answer received so far
+            self._save_achieved_answer(action_id, streamed_answer, truncated=response.get('truncated', False) is True)
+        elif streamed_answer is not None and monotonic() - streamed_answer.last_checkpoint >= self._checkpoint_interval:
+            add_chat_ai_answer(self._mongo_dao, action_id, streamed_answer.answer, achieved=False)
+            streamed_answer.last_checkpoint = monotonic()
+        # remove user_sid from response to relay it
+        user_sid = response.pop('user_sid')
+        self._socketio.emit('answer', response, room=user_sid)
@@ -0,0 +1,121 @@
+import json
+import logging
+from threading import Lock, Thread
+from time import sleep
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+__all__ = ['ChatCatalog']
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'isourceit:chatai-catalog'
+RESUBSCRIBE_DELAY_SECONDS = 1
+
+
+class ChatCatalog:
+    """
+    In-memory catalog of the available chat models, as (chat key, model key) pairs, kept by each server process.
+    It is loaded once from the database, then updated by the changes published on a redis channel by any process:
+    the chat AI manager clears it on start, and the answer relays add the models reported by the handlers.
+    Until loaded, or once changes may have been missed (redis connection lost), it is reloaded on next read.
+    """
+    __slots__ = ['_redis', '_channel', '_loader', '_models', '_lock', '_listener']
+
+    def __init__(self, redis_client: Redis, loader: Callable[[], Iterable[Tuple[str, str]]],
+                 channel: str = DEFAULT_CHANNEL):
+        """
+        :param loader: function returning the models saved in the database
+        """
+        self._redis = redis_client
+        self._channel = channel
+        self._loader = loader
+        self._models: Optional[Set[Tuple[str, str]]] = None
+        self._lock = Lock()
+        self._listener: Optional[Thread] = None
+
+    @staticmethod
+    def from_url(redis_url: str, loader: Callable[[], Iterable[Tuple[str, str]]]) -> 'ChatCatalog':
+        return ChatCatalog(Redis.from_url(redis_url), loader)
+
+    @property
+    def models(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            if self._models is None:
+                self._models = set(self._loader())
+            return sorted(self._models)
+
+    def start(self) -> None:
+        """
+        Listen to the catalog changes published by the other processes
+        """
+        if self._listener is not None:
+            LOG.warning('Chat catalog already listening.')
+            return
+        pubsub = self._subscribe()
+        self._listener = Thread(target=self._listen, args=(pubsub,), name='chat-catalog-listener', daemon=True)
+        self._listener.start()
+
+    def clear(self) -> None:
+        """
+        Clear the catalog of every process, once the models cleared in the database
+        """
+        change = dict(op='clear')
+        self._apply_change(change)
+        self._publish(change)
+
+    def add(self, chat_key: str, model_key: str) -> None:
+        """
+        Add a model to the catalog of every process, once saved in the database
+        """
+        change = dict(op='add', chat_key=chat_key, model_key=model_key)
+        self._apply_change(change)
+        self._publish(change)
+
+    def _publish(self, change: dict) -> None:
+        try:
+            self._redis.publish(self._channel, json.dumps(change))
+        except RedisError as e:
+            LOG.warning('Cannot publish chat catalog change %s: %s', change.get('op'), repr(e))
+
+    def _subscribe(self):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._channel)
+        return pubsub
+
+    def _listen(self, pubsub) -> None:
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe()
+                for message in pubsub.listen():
+                    self._apply(message.get('data'))
+            except RedisError as e:
+                LOG.warning('Chat catalog subscription lost, resubscribe: %s', repr(e))
+                # changes may have been missed meanwhile: reload on next read
+                with self._lock:
+                    self._models = None
+                pubsub = None
+                sleep(RESUBSCRIBE_DELAY_SECONDS)
+
+    def _apply(self, data) -> None:
+        try:
+            change = json.loads(data)
+        except (TypeError, ValueError):
+            LOG.warning('Invalid chat catalog change: %s', data)
+            return
+        self._apply_change(change)
+
+    def _apply_change(self, change: dict) -> None:
+        op = change.get('op')
+        with self._lock:
+            if op == 'clear':
+                self._models = set()
+            elif op == 'add':
+                # not loaded yet: the added model will be loaded from the database
+                if self._models is not None:
+                    self._models.add((change.get('chat_key'), change.get('model_key')))
+            else:
+                LOG.warning('Unknown chat catalog change: %s', op)
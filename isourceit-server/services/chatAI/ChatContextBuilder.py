@@ -0,0 +1,60 @@
+from typing import Dict, List, Optional
+
+__all__ = ['ChatContextBuilder']
+
+# approximate number of characters per token of english text
+CHARS_PER_TOKEN = 4
+# approximate number of tokens used by the chat format for each message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+OMITTED_TURNS_NOTE = '({} earlier messages of the conversation have been omitted.)'
+
+
+class ChatContextBuilder:
+    """
+    Build the messages of a chat request within an approximate token budget.
+    The system prompt, the opening prompt of the conversation (the hidden prompt of socratic questionnaires) and the
+    last prompt are always kept. Then the most recent messages are kept while the budget allows, older messages being
+    collapsed into a short note.
+    A budget of None or lower or equal to 0 keeps the whole conversation.
+    """
+    __slots__ = ['_token_budget']
+
+    def __init__(self, token_budget: Optional[int] = None):
+        self._token_budget = token_budget if token_budget is not None and token_budget > 0 else None
+
+    @staticmethod
+    def estimate_tokens(message: Dict) -> int:
+        content = message.get('content') or ''
+        return MESSAGE_OVERHEAD_TOKENS + (len(content) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    def build(self, system_message: Dict, messages: List[Dict], keep_opening_prompt: bool = False) -> List[Dict]:
+        """
+        :param system_message: the system (init) prompt message
+        :param messages: the conversation messages, ending with the prompt to answer
+        :param keep_opening_prompt: True to keep the first message of the conversation in any case
+        :return: the request messages
+        """
+        if self._token_budget is None or not messages:
+            return [system_message] + messages
+        head = [system_message]
+        first_idx = 0
+        if keep_opening_prompt and len(messages) > 1:
+            head.append(messages[0])
+            first_idx = 1
+        # the last prompt is always kept
+        remaining_budget = self._token_budget - sum(self.estimate_tokens(m) for m in head) \
+            - self.estimate_tokens(messages[-1])
+        kept_idx = len(messages) - 1
+        while kept_idx > first_idx:
+            message_tokens = self.estimate_tokens(messages[kept_idx - 1])
+            if message_tokens > remaining_budget:
+                break
+            remaining_budget -= message_tokens
+            kept_idx -= 1
+        # do not start the kept messages with an answer whose prompt is omitted
+        while kept_idx < len(messages) - 1 and kept_idx > first_idx and messages[kept_idx]['role'] == 'assistant':
+            kept_idx += 1
+        nb_omitted = kept_idx - first_idx
+        if nb_omitted > 0:
+            head.append({'role': 'system', 'content': OMITTED_TURNS_NOTE.format(nb_omitted)})
+        return head + messages[kept_idx:]
@@ -0,0 +1,383 @@
+import logging
+from functools import partial
+from collections import deque
+from threading import Lock, Thread
+from time import sleep
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+import socketio
+
+from utils.LRUCache import LRUCache
+
+__all__ = ['DalaiBackendPool', 'DALAI_END_MARKER']
+
+LOG = logging.getLogger(__name__)
+
+DALAI_END_MARKER = '\n\n<end>'
+DEFAULT_HEALTH_CHECK_SECONDS = 10
+DEFAULT_AFFINITY_SLACK = 1
+DEFAULT_AFFINITY_SIZE = 10000
+DEFAULT_MODEL_CONCURRENCY = 1
+
+
+class DalaiBackend:
+    """
+    A Dalai server, with the prompts being answered by it
+    """
+    __slots__ = ['url', 'sio', 'models', 'in_flight', 'cancelled', 'completed', 'drained', 'ever_connected']
+
+    def __init__(self, url: str, sio: socketio.Client):
+        self.url = url
+        self.sio = sio
+        self.models: Set[str] = set()
+        # prompt requests being answered, by action id
+        self.in_flight: Dict[str, Dict] = dict()
+        # action ids of the in flight prompts already ended by a cancellation, whose results are dropped
+        self.cancelled: Set[str] = set()
+        self.completed = 0
+        self.drained = 0
+        self.ever_connected = False
+
+    @property
+    def connected(self) -> bool:
+        return self.sio.connected
+
+    @property
+    def load(self) -> int:
+        return len(self.in_flight)
+
+    def model_load(self, model: str) -> int:
+        return sum(1 for request in self.in_flight.values() if request['model'] == model)
+
+    def serves(self, model: str) -> bool:
+        # models are unknown until the backend answered its installed models
+        return not self.models or model in self.models
+
+
+class _QueuedPrompt:
+    __slots__ = ['request', 'conversation_key']
+
+    def __init__(self, request: Dict, conversation_key: Optional[Hashable]):
+        self.request = request
+        self.conversation_key = conversation_key
+
+
+class DalaiBackendPool:
+    """
+    Pool of Dalai servers answering the prompts of a chat.
+    Each prompt is routed to the least loaded connected backend serving its model. The prompts of a conversation stick
+    to the backend of its previous prompt while it is at most affinity_slack prompts more loaded than the least loaded
+    backend (negative to disable affinity).
+    As Dalai answers prompts one at a time, a backend answers at most model_concurrency prompts of a model at once.
+    Other prompts wait in a queue by model, their position being given to on_queue_position whenever it changes.
+    Backends are health checked every health_check_seconds: backends never reached are connected again, connected
+    ones reconnect by themselves. When a backend disconnects, it is drained: its prompts are ended, as no answer can
+    be received anymore, and its conversations are routed to other backends.
+    Results are given to on_result, installed models being reported once whatever the number of backends serving them.
+    A cancelled prompt is removed from its queue, or, once sent, ended at once: as Dalai cannot interrupt an answer,
+    its backend stays busy until the answer is over, but its remaining results are dropped.
+    """
+
+    def __init__(self, urls: List[str], on_result: Callable[[Dict], None],
+                 on_queue_position: Callable[[Dict, int], None] = None,
+                 health_check_seconds: float = DEFAULT_HEALTH_CHECK_SECONDS,
+                 affinity_slack: int = DEFAULT_AFFINITY_SLACK, model_concurrency: int = DEFAULT_MODEL_CONCURRENCY,
+                 auto_reconnect: bool = True, debug: bool = False):
+        if not urls:
+            raise Exception('At least one Dalai url is required')
+        self._on_result = on_result
+        self._on_queue_position = on_queue_position
+        self._health_check_seconds = health_check_seconds
+        self._affinity_slack = affinity_slack
+        self._model_concurrency = model_concurrency
+        self._queues: Dict[str, Deque[_QueuedPrompt]] = dict()
+        self._abandoned = 0
+        self._cancelled = 0
+        self._affinities = LRUCache(DEFAULT_AFFINITY_SIZE)
+        self._lock = Lock()
+        self._health_checker: Optional[Thread] = None
+        self._stopped = False
+        self._models_request_identifiers: Optional[Dict] = None
+        self._backends: List[DalaiBackend] = []
+        for url in urls:
+            sio = socketio.Client(reconnection=auto_reconnect, reconnection_delay=5, logger=debug,
+                                  engineio_logger=debug)
+            backend = DalaiBackend(url, sio)
+            sio.on('connect', partial(self._on_backend_connect, backend))
+            sio.on('connect_error', partial(self._on_backend_connect_error, backend))
+            sio.on('disconnect', partial(self._on_backend_disconnect, backend))
+            sio.on('result', partial(self._on_backend_result, backend))
+            sio.on('*', DalaiBackendPool._on_catch_all)
+            self._backends.append(backend)
+
+    @property
+    def connected(self) -> bool:
+        return any(backend.connected for backend in self._backends)
+
+    @property
+    def models(self) -> Set[str]:
+        return set(model for backend in self._backends for model in backend.models)
+
+    def connect(self) -> None:
+        self._stopped = False
+        for backend in self._backends:
+            self._connect_backend(backend)
+        self._health_checker = Thread(target=self._check_health, name='dalai-health-check', daemon=True)
+        self._health_checker.start()
+
+    def disconnect(self) -> None:
+        self._stopped = True
+        for backend in self._backends:
+            if backend.connected:
+                backend.sio.disconnect()
+
+    def _connect_backend(self, backend: DalaiBackend) -> None:
+        try:
+            backend.sio.connect(backend.url)
+        except socketio.exceptions.ConnectionError as e:
+            # already logged on connect error
+            LOG.debug("Cannot connect to Dalai backend %s: %s", backend.url, repr(e))
+
+    def _check_health(self) -> None:
+        while not self._stopped:
+            sleep(self._health_check_seconds)
+            for backend in self._backends:
+                # once connected, the client reconnects by itself
+                if not backend.ever_connected and not self._stopped:
+                    self._connect_backend(backend)
+
+    def request_models(self, request_identifiers: Dict = None) -> None:
+        with self._lock:
+            self._models_request_identifiers = request_identifiers
+            for backend in self._backends:
+                backend.models.clear()
+        for backend in self._backends:
+            if backend.connected:
+                self._emit_models_request(backend)
+
+    def _emit_models_request(self, backend: DalaiBackend) -> None:
+        backend.sio.emit('request', {
+            'method': 'installed',
+            'request_identifiers': self._models_request_identifiers
+        })
+
+    def _select_backend(self, model: str, conversation_key: Optional[Hashable]) -> Optional[DalaiBackend]:
+        # with the lock
+        candidates = [backend for backend in self._backends if backend.connected and backend.serves(model)
+                      and backend.model_load(model) < self._model_concurrency]
+        if not candidates:
+            return None
+        least_loaded = min(candidates, key=lambda b: b.load)
+        if conversation_key is None or self._affinity_slack < 0:
+            return least_loaded
+        affinity_url = self._affinities.get(conversation_key)
+        affinity_backend = next((b for b in candidates if b.url == affinity_url), None)
+        if affinity_backend is not None and affinity_backend.load <= least_loaded.load + self._affinity_slack:
+            return affinity_backend
+        self._affinities.put(conversation_key, least_loaded.url)
+        return least_loaded
+
+    def send_prompt(self, request: Dict, conversation_key: Optional[Hashable] = None) -> bool:
+        """
+        Send a prompt request to a backend, or queue it until a backend can answer it
+        :param request: the Dalai request
+        :param conversation_key: the conversation of the prompt, for affinity
+        :return: False if no connected backend serves the model of the prompt
+        """
+        model = request['model']
+        with self._lock:
+            if not any(backend.connected and backend.serves(model) for backend in self._backends):
+                return False
+            self._queues.setdefault(model, deque()).append(_QueuedPrompt(request, conversation_key))
+        self._dispatch(model, arrived_request=request)
+        return True
+
+    @staticmethod
+    def _action_id(request: Dict) -> Optional[str]:
+        return (request.get('request_identifiers') or dict()).get('action_id')
+
+    def _dispatch(self, model: str, arrived_request: Dict = None) -> None:
+        """
+        Send the queued prompts of a model while backends can answer them, then notify the changed queue positions
+        :param arrived_request: the prompt just queued, if any
+        """
+        dispatched: List[Tuple[DalaiBackend, Dict]] = []
+        with self._lock:
+            queue = self._queues.get(model)
+            while queue:
+                backend = self._select_backend(model, queue[0].conversation_key)
+                if backend is None:
+                    break
+                request = queue.popleft().request
+                action_id = DalaiBackendPool._action_id(request)
+                if action_id is not None:
+                    backend.in_flight[action_id] = request
+                dispatched.append((backend, request))
+            waiting_requests = [queued.request for queued in queue] if queue else []
+        for backend, request in dispatched:
+            try:
+                backend.sio.emit('request', request)
+            except socketio.exceptions.SocketIOError as e:
+                LOG.warning("Cannot send prompt to Dalai backend %s: %s", backend.url, repr(e))
+                with self._lock:
+                    backend.in_flight.pop(DalaiBackendPool._action_id(request), None)
+                self._on_result({'request': request, 'response': DALAI_END_MARKER})
+        if self._on_queue_position is None or not waiting_requests:
+            return
+        if dispatched:
+            # all the waiting prompts move forward
+            for position, request in enumerate(waiting_requests, start=1):
+                self._on_queue_position(request, position)
+        elif waiting_requests[-1] is arrived_request:
+            self._on_queue_position(arrived_request, len(waiting_requests))
+
+    def _dispatch_all(self) -> None:
+        with self._lock:
+            models = [model for model, queue in self._queues.items() if queue]
+        for model in models:
+            self._dispatch(model)
+
+    def abandon_prompts(self, matches: Callable[[Hashable], bool]) -> int:
+        """
+        Remove from the queues the prompts whose conversation matches, and end them
+        :return: the number of abandoned prompts
+        """
+        abandoned_requests = []
+        with self._lock:
+            for model, queue in self._queues.items():
+                kept = deque()
+                for queued in queue:
+                    if queued.conversation_key is not None and matches(queued.conversation_key):
+                        abandoned_requests.append(queued.request)
+                    else:
+                        kept.append(queued)
+                self._queues[model] = kept
+            self._abandoned += len(abandoned_requests)
+        for request in abandoned_requests:
+            self._on_result({'request': request, 'response': DALAI_END_MARKER})
+        if abandoned_requests:
+            # positions of the prompts behind the abandoned ones
+            self._notify_queue_positions()
+        return len(abandoned_requests)
+
+    def cancel_prompt(self, action_id: str) -> bool:
+        """
+        Remove a prompt from its queue, or stop relaying its results if sent, and end it as truncated
+        :return: False if the prompt is neither queued nor in flight
+        """
+        request = None
+        queued = False
+        with self._lock:
+            for queue in self._queues.values():
+                queued_prompt = next((q for q in queue if DalaiBackendPool._action_id(q.request) == action_id), None)
+                if queued_prompt is not None:
+                    queue.remove(queued_prompt)
+                    request = queued_prompt.request
+                    queued = True
+                    break
+            else:
+                backend = next((b for b in self._backends if action_id in b.in_flight
+                                and action_id not in b.cancelled), None)
+                if backend is not None:
+                    backend.cancelled.add(action_id)
+                    request = backend.in_flight[action_id]
+            if request is None:
+                return False
+            self._cancelled += 1
+        self._on_result({'request': request, 'response': DALAI_END_MARKER, 'truncated': True})
+        if queued:
+            self._notify_queue_positions()
+        return True
+
+    def _notify_queue_positions(self) -> None:
+        if self._on_queue_position is None:
+            return
+        with self._lock:
+            waiting_requests = [[queued.request for queued in queue] for queue in self._queues.values()]
+        for requests in waiting_requests:
+            for position, request in enumerate(requests, start=1):
+                self._on_queue_position(request, position)
+
+    def _on_backend_connect(self, backend: DalaiBackend) -> None:
+        LOG.info("Connected to Dalai backend %s", backend.url)
+        backend.ever_connected = True
+        # models of a backend connected after the models request
+        if self._models_request_identifiers is not None:
+            self._emit_models_request(backend)
+        self._dispatch_all()
+
+    def _on_backend_connect_error(self, backend: DalaiBackend, data) -> None:
+        LOG.warning("The connection to Dalai backend %s failed!", backend.url)
+
+    def _on_backend_disconnect(self, backend: DalaiBackend) -> None:
+        LOG.warning("Disconnected from Dalai backend %s, drain it", backend.url)
+        with self._lock:
+            drained_requests = [request for action_id, request in backend.in_flight.items()
+                                if action_id not in backend.cancelled]
+            backend.in_flight.clear()
+            backend.cancelled.clear()
+            backend.drained += len(drained_requests)
+        # no answer will be received: end the prompts
+        for request in drained_requests:
+            self._on_result({'request': request, 'response': DALAI_END_MARKER})
+        with self._lock:
+            # queued prompts no connected backend can answer anymore
+            unserved_requests = []
+            for model, queue in self._queues.items():
+                if queue and not any(b.connected and b.serves(model) for b in self._backends):
+                    unserved_requests.extend(queued.request for queued in queue)
+                    queue.clear()
+        for request in unserved_requests:
+            self._on_result({'request': request, 'response': DALAI_END_MARKER})
+
+    @staticmethod
+    def _on_catch_all(event, data) -> None:
+        LOG.debug("Received unmanaged event: %s", event)
+
+    def _on_backend_result(self, backend: DalaiBackend, data: Dict) -> None:
+        request = data.get('request') or dict()
+        answer = data.get('response')
+        if request.get('method') == 'installed':
+            if answer is None or answer == DALAI_END_MARKER:
+                return
+            with self._lock:
+                known_model = answer in self.models
+                backend.models.add(answer)
+            if known_model:
+                return
+        elif answer == DALAI_END_MARKER:
+            action_id = DalaiBackendPool._action_id(request)
+            with self._lock:
+                if backend.in_flight.pop(action_id, None) is None and action_id is not None:
+                    # already ended by the drain of the backend
+                    return
+                backend.completed += 1
+                cancelled = action_id in backend.cancelled
+                backend.cancelled.discard(action_id)
+            if not cancelled:
+                self._on_result(data)
+            # the backend can answer the next prompt of the model
+            if 'model' in request:
+                self._dispatch(request['model'])
+            return
+        elif DalaiBackendPool._action_id(request) in backend.cancelled:
+            # already ended by its cancellation
+            return
+        self._on_result(data)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                'backends': [{
+                    'url': backend.url,
+                    'connected': backend.connected,
+                    'in_flight': backend.load,
+                    'completed': backend.completed,
+                    'drained': backend.drained,
+                    'models': sorted(backend.models)
+                } for backend in self._backends],
+                'affinities': self._affinities.stats(),
+                'queued': dict((model, len(queue)) for model, queue in self._queues.items() if queue),
+                'abandoned': self._abandoned,
+                'cancelled': self._cancelled
+            }
@@ -1,8 +1,9 @@
 import logging
 from multiprocessing.queues import Queue
 from typing import Dict, Optional
-import socketio
 from services.chatAI.ChatAIHandler import ChatAIHandler
+from services.chatAI.DalaiBackendPool import DalaiBackendPool, DALAI_END_MARKER, DEFAULT_HEALTH_CHECK_SECONDS, \
+    DEFAULT_AFFINITY_SLACK, DEFAULT_MODEL_CONCURRENCY
 
 __all__ = ['DalaiHandler']
 
@@ -19,28 +20,34 @@ NAME_MODEL_DICT = {
 
 
 class DalaiHandler(ChatAIHandler):
-    __slots__ = ['_sio', '_dalai_url', '_models', '_response_queue']
+    """
+    Prompts are answered by a pool of Dalai servers (CHATAI_DALAI_URL may list several urls), see DalaiBackendPool.
+    """
+    __slots__ = ['_backend_pool', '_dalai_urls', '_health_check_seconds', '_affinity_slack', '_model_concurrency',
+                 '_response_queue']
 
     def __init__(self, response_queue: Queue, config: Dict = None, auto_reconnect: bool = True, debug: bool = False):
-        self._sio: socketio.Client = socketio.Client(reconnection=auto_reconnect, reconnection_delay=5,
-                                                     logger=debug, engineio_logger=debug)
         self._init_config(config)
-        self._init_socket_io()
-        self._models = set()
+        self._backend_pool = DalaiBackendPool(self._dalai_urls, self._on_result,
+                                              on_queue_position=self._on_queue_position,
+                                              health_check_seconds=self._health_check_seconds,
+                                              affinity_slack=self._affinity_slack,
+                                              model_concurrency=self._model_concurrency,
+                                              auto_reconnect=auto_reconnect, debug=debug)
         self._response_queue = response_queue
 
     def _init_config(self, config: Dict = None):
         if config is not None:
-            self._dalai_url = config.get('CHATAI_DALAI_URL', 'http://localhost:5001')
+            dalai_urls = config.get('CHATAI_DALAI_URL', 'http://localhost:5001')
+            self._dalai_urls = [dalai_urls] if isinstance(dalai_urls, str) else list(dalai_urls)
+            self._health_check_seconds = config.get('CHATAI_DALAI_HEALTH_CHECK_SECONDS', DEFAULT_HEALTH_CHECK_SECONDS)
+            self._affinity_slack = config.get('CHATAI_DALAI_AFFINITY_SLACK', DEFAULT_AFFINITY_SLACK)
+            self._model_concurrency = config.get('CHATAI_DALAI_MODEL_CONCURRENCY', DEFAULT_MODEL_CONCURRENCY)
         else:
-            self._dalai_url = 'http://localhost:5001'
-
-    def _init_socket_io(self):
-        self._sio.on('connect', self._on_connect)
-        self._sio.on('connect_error', self._on_connect_error)
-        self._sio.on('disconnect', self._on_disconnect)
-        self._sio.on('result', self._on_result)
-        self._sio.on('*', self._on_catch_all)
+            self._dalai_urls = ['http://localhost:5001']
+            self._health_check_seconds = DEFAULT_HEALTH_CHECK_SECONDS
+            self._affinity_slack = DEFAULT_AFFINITY_SLACK
+            self._model_concurrency = DEFAULT_MODEL_CONCURRENCY
 
     @property
     def chat_key(self) -> str:
@@ -63,28 +70,27 @@ class DalaiHandler(ChatAIHandler):
 
     @property
     def connected(self):
-        return self._sio.connected
+        return self._backend_pool.connected
 
     @property
     def models(self):
-        return self._models
+        return self._backend_pool.models
+
+    @property
+    def metrics(self) -> Optional[Dict]:
+        return self._backend_pool.metrics()
 
     def connect(self):
-        self._sio.connect(self._dalai_url)
+        self._backend_pool.connect()
 
     def disconnect(self):
-        self._sio.disconnect()
+        self._backend_pool.disconnect()
 
     def request_available_models(self, request_identifiers: Dict = None, **kwargs):
         if not self.connected:
             LOG.warning('Cannot request available model. Not Connected.')
             return
-        self._models.clear()
-        request = {
-            'method': 'installed',
-            'request_identifiers': request_identifiers
-        }
-        self._sio.emit('request', request)
+        self._backend_pool.request_models(request_identifiers)
 
     def send_prompt(self, model: str, prompt: str, request_identifiers: Dict = None, **kwargs):
         if not self.connected:
@@ -112,20 +118,31 @@ class DalaiHandler(ChatAIHandler):
         debug
         html
         """
-        self._sio.emit('request', request)
-
-    def _on_connect(self):
-        LOG.debug("Connected to Dalai")
-
-    def _on_connect_error(self, data):
-        LOG.warning("The connection to Dalai failed!")
-        #print(data)
-
-    def _on_disconnect(self):
-        LOG.debug("Disconnected from Dalai")
-
-    def _on_catch_all(self, event, data):
-        LOG.debug("Received unmanaged event: ", event)
+        # the prompts of a conversation preferably go to the same backend
+        action = kwargs.get('action')
+        conversation_key = (action['exam_id'], action['student_username'], action['question_idx'],
+                            action['chat_id']) if action else None
+        if not self._backend_pool.send_prompt(request, conversation_key):
+            LOG.warning('Cannot send prompt. No Dalai backend available.')
+
+    def abandon_prompts(self, exam_id: str, student_username: str, question_idx: int) -> int:
+        return self._backend_pool.abandon_prompts(
+            lambda conversation_key: conversation_key[:3] == (exam_id, student_username, question_idx))
+
+    def cancel_prompt(self, action_id: str) -> bool:
+        return self._backend_pool.cancel_prompt(action_id)
+
+    def _on_queue_position(self, request: Dict, position: int):
+        # the position is relayed as an answer without content
+        result = dict()
+        request_identifiers = request.get('request_identifiers', None)
+        if request_identifiers is not None:
+            result.update(request_identifiers)
+        result['ended'] = False
+        result['queue_position'] = position
+        result['chat_key'] = self.chat_key
+        result['model_key'] = request['model']
+        self._response_queue.put(result)
 
     def _on_result(self, data):
         # Retrieve request and
@@ -147,8 +164,10 @@ class DalaiHandler(ChatAIHandler):
             result.update(request_identifiers)
 
         # if answer is end marker, pop the callback for a last call
-        if answer == '\n\n<end>':
+        if answer == DALAI_END_MARKER:
             result['ended'] = True
+            if data.get('truncated') is True:
+                result['truncated'] = True
         else:
             result['ended'] = False
             result['answer'] = answer
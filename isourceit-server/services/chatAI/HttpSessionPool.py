@@ -0,0 +1,100 @@
+import hashlib
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterator, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+__all__ = ['HttpSessionPool']
+
+DEFAULT_POOL_MAX_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+class _PooledSession:
+    __slots__ = ['session', 'in_use', 'last_used']
+
+    def __init__(self, session: requests.Session):
+        self.session = session
+        self.in_use = 0
+        self.last_used = monotonic()
+
+
+class HttpSessionPool:
+    """
+    Keep-alive HTTP sessions by API key and base url, so that requests reuse opened (TLS) connections.
+    Each session keeps at most pool_max_size connections. Sessions unused for idle_timeout seconds are closed.
+    API keys are only kept hashed.
+    """
+    __slots__ = ['_pool_max_size', '_idle_timeout', '_sessions', '_lock', '_last_eviction', '_created', '_reused',
+                 '_evicted']
+
+    def __init__(self, pool_max_size: int = DEFAULT_POOL_MAX_SIZE, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self._pool_max_size = pool_max_size
+        self._idle_timeout = idle_timeout
+        self._sessions: Dict[Tuple[str, str], _PooledSession] = dict()
+        self._lock = Lock()
+        self._last_eviction = monotonic()
+        self._created = 0
+        self._reused = 0
+        self._evicted = 0
+
+    @staticmethod
+    def session_key(api_key: str, url: str) -> Tuple[str, str]:
+        """
+        :return: the hashed API key and the base url of the url
+        """
+        split_url = urlsplit(url)
+        return hashlib.sha256(api_key.encode()).hexdigest(), '{}://{}'.format(split_url.scheme, split_url.netloc)
+
+    def _create_session(self, base_url: str) -> requests.Session:
+        session = requests.Session()
+        session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_max_size))
+        return session
+
+    @contextmanager
+    def session(self, api_key: str, url: str) -> Iterator[requests.Session]:
+        """
+        Provide the session of an API key for an url, while in use it cannot be evicted
+        """
+        session_key = HttpSessionPool.session_key(api_key, url)
+        with self._lock:
+            self._evict_idle_sessions()
+            pooled_session = self._sessions.get(session_key)
+            if pooled_session is None:
+                pooled_session = _PooledSession(self._create_session(session_key[1]))
+                self._sessions[session_key] = pooled_session
+                self._created += 1
+            else:
+                self._reused += 1
+            pooled_session.in_use += 1
+        try:
+            yield pooled_session.session
+        finally:
+            with self._lock:
+                pooled_session.in_use -= 1
+                pooled_session.last_used = monotonic()
+
+    def _evict_idle_sessions(self) -> None:
+        # checked at most twice per idle timeout, with the lock
+        now = monotonic()
+        if now - self._last_eviction < self._idle_timeout / 2:
+            return
+        self._last_eviction = now
+        idle_keys = [key for key, pooled_session in self._sessions.items()
+                     if pooled_session.in_use == 0 and now - pooled_session.last_used >= self._idle_timeout]
+        for key in idle_keys:
+            self._sessions.pop(key).session.close()
+        self._evicted += len(idle_keys)
+
+    def close(self) -> None:
+        with self._lock:
+            for pooled_session in self._sessions.values():
+                pooled_session.session.close()
+            self._sessions.clear()
+
+    def stats(self) -> dict:
+        return dict(sessions=len(self._sessions), created=self._created, reused=self._reused, evicted=self._evicted)
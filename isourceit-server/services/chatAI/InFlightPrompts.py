@@ -0,0 +1,106 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional
+
+__all__ = ['InFlightPrompts']
+
+DEFAULT_MAX_AGE_SECONDS = 3600
+
+
+class _InFlightPrompt:
+    __slots__ = ['request_identifiers', 'chat_key', 'model_key', 'exam_id', 'student_username', 'submitted',
+                 'deadline']
+
+    def __init__(self, request_identifiers: Dict, chat_key: str, model_key: str, exam_id: str,
+                 student_username: str, deadline: Optional[float]):
+        self.request_identifiers = request_identifiers
+        self.chat_key = chat_key
+        self.model_key = model_key
+        self.exam_id = exam_id
+        self.student_username = student_username
+        self.submitted = monotonic()
+        self.deadline = deadline  # monotonic time
+
+
+class InFlightPrompts:
+    """
+    Prompts from their submission to the end of their answer, by action id, to cancel them by action, websocket or
+    student. The handlers put their responses through it to the response queue: ended prompts are forgotten.
+    Prompts never ended by their handler (eg.: failed requests) are forgotten once older than max_age seconds.
+    """
+    __slots__ = ['_response_queue', '_max_age', '_prompts', '_lock']
+
+    def __init__(self, response_queue, max_age: float = DEFAULT_MAX_AGE_SECONDS):
+        self._response_queue = response_queue
+        self._max_age = max_age
+        self._prompts: Dict[str, _InFlightPrompt] = dict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._prompts)
+
+    def put(self, response: Dict, *args, **kwargs) -> None:
+        if response.get('request_type') == 'prompt' and response.get('ended') is True:
+            with self._lock:
+                self._prompts.pop(response.get('action_id'), None)
+        self._response_queue.put(response, *args, **kwargs)
+
+    def add(self, request_identifiers: Dict, chat_key: str, model_key: str, exam_id: str, student_username: str,
+            timeout: Optional[float] = None) -> None:
+        """
+        :param timeout: seconds after which the prompt has to be cancelled, if any
+        """
+        prompt = _InFlightPrompt(request_identifiers, chat_key, model_key, exam_id, student_username,
+                                 monotonic() + timeout if timeout is not None else None)
+        with self._lock:
+            self._prompts[request_identifiers['action_id']] = prompt
+
+    def get(self, action_id: str) -> Optional[_InFlightPrompt]:
+        return self._prompts.get(action_id)
+
+    def end(self, action_id: str) -> bool:
+        """
+        End a prompt that has not been answered (eg.: abandoned by the scheduler), with a truncated empty answer
+        :return: False if the prompt was not in flight
+        """
+        prompt = self._prompts.get(action_id)
+        if prompt is None:
+            return False
+        result = dict(prompt.request_identifiers)
+        result['ended'] = True
+        result['truncated'] = True
+        result['chat_key'] = prompt.chat_key
+        result['model_key'] = prompt.model_key
+        self.put(result)
+        return True
+
+    def find(self, user_sid: str = None, exam_id: str = None, student_username: str = None) -> List[str]:
+        """
+        :return: the action ids of the prompts of the websocket, or of the student of the exam
+        """
+        with self._lock:
+            return [action_id for action_id, prompt in self._prompts.items()
+                    if (user_sid is None or prompt.request_identifiers.get('user_sid') == user_sid)
+                    and (exam_id is None or prompt.exam_id == exam_id)
+                    and (student_username is None or prompt.student_username == student_username)]
+
+    def find_expired(self) -> List[str]:
+        """
+        :return: the action ids of the prompts whose timeout has elapsed
+        """
+        now = monotonic()
+        with self._lock:
+            return [action_id for action_id, prompt in self._prompts.items()
+                    if prompt.deadline is not None and prompt.deadline <= now]
+
+    def forget_stale(self) -> int:
+        """
+        :return: the number of forgotten prompts
+        """
+        now = monotonic()
+        with self._lock:
+            stale_ids = [action_id for action_id, prompt in self._prompts.items()
+                         if now - prompt.submitted >= self._max_age]
+            for action_id in stale_ids:
+                del self._prompts[action_id]
+        return len(stale_ids)
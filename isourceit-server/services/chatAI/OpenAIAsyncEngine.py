@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from time import monotonic
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Mapping, Optional, Tuple
+
+import aiohttp
+import eventlet
+from eventlet.hubs import trampoline
+
+from services.chatAI.HttpSessionPool import HttpSessionPool, DEFAULT_IDLE_TIMEOUT
+
+__all__ = ['OpenAIAsyncEngine']
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_STREAMS = 200
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+# native thread: the event loop must not run in a green thread of the server
+_native_threading = eventlet.patcher.original('threading')
+
+
+class _PooledClientSession:
+    __slots__ = ['session', 'in_use', 'last_used']
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+        self.in_use = 0
+        self.last_used = monotonic()
+
+
+class _Stream:
+    __slots__ = ['task', 'cancelled']
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+
+
+async def _iter_sse_data(content: aiohttp.StreamReader) -> AsyncIterator[str]:
+    """
+    Iterate over the data of the server-sent events of a response body
+    """
+    data_lines = []
+    async for line in content:
+        line = line.decode().rstrip('\r\n')
+        if not line:
+            if data_lines:
+                yield '\n'.join(data_lines)
+                data_lines = []
+        elif line.startswith('data:'):
+            data_lines.append(line[6:] if line.startswith('data: ') else line[5:])
+    if data_lines:
+        yield '\n'.join(data_lines)
+
+
+class OpenAIAsyncEngine:
+    """
+    Stream OpenAI chat completions with aiohttp, from an asyncio event loop running in a dedicated native thread, so
+    that hundreds of streams proceed concurrently. At most max_streams streams are opened at once, others wait for a
+    slot without holding any connection.
+    As the HTTP session pool, keep-alive client sessions are kept by API key and base url, with at most pool_max_size
+    connections each, and closed once unused for idle_timeout seconds.
+    Stream callbacks are not run in the event loop thread but dispatched to a green thread of the server, so that they
+    can use the server connections and queues.
+    A stream can be cancelled at any time: its response is closed and its slot released.
+    """
+
+    def __init__(self, max_streams: int = DEFAULT_MAX_STREAMS, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT, pool_max_size: int = None,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self._max_streams = max_streams
+        self._pool_max_size = pool_max_size if pool_max_size is not None else max_streams
+        self._idle_timeout = idle_timeout
+        self._timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = None
+        self._sessions: Dict[Tuple[str, str], _PooledClientSession] = dict()
+        self._evicted_sessions = 0
+        self._stream_slots: Optional[asyncio.Semaphore] = None
+        # callbacks to run in the server: queued by the event loop thread, which then wakes up the dispatcher
+        self._callbacks: Deque[Tuple[Callable, Tuple]] = deque()
+        self._wakeup_fds: Optional[Tuple[int, int]] = None
+        self._dispatcher = None
+        self._active_streams = 0
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None
+
+    @property
+    def active_streams(self) -> int:
+        return self._active_streams
+
+    def stats(self) -> dict:
+        return dict(active_streams=self._active_streams, sessions=len(self._sessions),
+                    evicted=self._evicted_sessions)
+
+    def start(self) -> None:
+        if self.running:
+            LOG.warning('OpenAI async engine already started.')
+            return
+        self._wakeup_fds = os.pipe()
+        os.set_blocking(self._wakeup_fds[0], False)
+        self._dispatcher = eventlet.spawn(self._dispatch_callbacks)
+        self._loop = asyncio.new_event_loop()
+        started = _native_threading.Event()
+        self._loop_thread = _native_threading.Thread(target=self._run_loop, args=(started,),
+                                                     name='openai-async-engine', daemon=True)
+        self._loop_thread.start()
+        started.wait()
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop_thread = None
+        self._loop = None
+        self._dispatcher.kill()
+        self._dispatcher = None
+        for fd in self._wakeup_fds:
+            os.close(fd)
+        self._wakeup_fds = None
+
+    def _run_loop(self, started) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._stream_slots = asyncio.Semaphore(self._max_streams)
+        eviction_task = self._loop.create_task(self._evict_idle_sessions())
+        started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            eviction_task.cancel()
+            for pooled_session in self._sessions.values():
+                self._loop.run_until_complete(pooled_session.session.close())
+            self._sessions.clear()
+            self._loop.close()
+
+    def _acquire_session(self, api_key: str, url: str) -> _PooledClientSession:
+        # from the event loop thread
+        session_key = HttpSessionPool.session_key(api_key, url)
+        pooled_session = self._sessions.get(session_key)
+        if pooled_session is None:
+            pooled_session = _PooledClientSession(aiohttp.ClientSession(
+                timeout=self._timeout, connector=aiohttp.TCPConnector(limit=self._pool_max_size,
+                                                                      keepalive_timeout=self._idle_timeout)))
+            self._sessions[session_key] = pooled_session
+        pooled_session.in_use += 1
+        return pooled_session
+
+    async def _evict_idle_sessions(self) -> None:
+        while True:
+            await asyncio.sleep(self._idle_timeout / 2)
+            now = monotonic()
+            idle_keys = [key for key, pooled_session in self._sessions.items()
+                         if pooled_session.in_use == 0 and now - pooled_session.last_used >= self._idle_timeout]
+            for key in idle_keys:
+                await self._sessions.pop(key).session.close()
+            self._evicted_sessions += len(idle_keys)
+
+    def _dispatch_callbacks(self) -> None:
+        # green thread of the server
+        while True:
+            trampoline(self._wakeup_fds[0], read=True)
+            try:
+                os.read(self._wakeup_fds[0], 4096)
+            except BlockingIOError:
+                pass
+            while self._callbacks:
+                callback, args = self._callbacks.popleft()
+                try:
+                    callback(*args)
+                except Exception as e:
+                    LOG.warning('Error in OpenAI stream callback: %s', repr(e))
+
+    def _call_back(self, callback: Callable, *args: Any) -> None:
+        # from the event loop thread
+        self._callbacks.append((callback, args))
+        os.write(self._wakeup_fds[1], b'\0')
+
+    def stream(self, api_key: str, url: str, headers: Dict[str, str], body: Dict, on_event: Callable[[Dict], None],
+               on_end: Callable[[Optional[Exception], bool, Optional[Mapping[str, str]]], None]) -> Callable[[], None]:
+        """
+        Request a chat completion stream
+        :param api_key: the API key of the request, to select its client session
+        :param url: the chat completion url
+        :param headers: the request headers
+        :param body: the request body
+        :param on_event: called with the data of each event of the stream, until the end marker
+        :param on_end: called once the stream is over, with the error if any (asyncio.CancelledError if cancelled),
+        True if the stream has been opened, and the response headers if any
+        :return: a function cancelling the stream: its response is closed and its slot released
+        """
+        if not self.running:
+            raise Exception('OpenAI async engine not started')
+        stream = _Stream()
+        asyncio.run_coroutine_threadsafe(self._stream(stream, api_key, url, headers, json.dumps(body), on_event,
+                                                      on_end), self._loop)
+        return lambda: self._loop.call_soon_threadsafe(self._cancel_stream, stream)
+
+    @staticmethod
+    def _cancel_stream(stream: _Stream) -> None:
+        # from the event loop thread. A stream not started yet is cancelled on start
+        stream.cancelled = True
+        if stream.task is not None:
+            stream.task.cancel()
+
+    async def _stream(self, stream: _Stream, api_key: str, url: str, headers: Dict[str, str], body: str,
+                      on_event: Callable, on_end: Callable) -> None:
+        opened = False
+        error = None
+        response_headers = None
+        stream.task = asyncio.current_task()
+        try:
+            if stream.cancelled:
+                raise asyncio.CancelledError()
+            async with self._stream_slots:
+                self._active_streams += 1
+                pooled_session = self._acquire_session(api_key, url)
+                try:
+                    async with pooled_session.session.post(url, data=body, headers=headers) as http_response:
+                        response_headers = http_response.headers
+                        http_response.raise_for_status()
+                        opened = True
+                        async for event_data in _iter_sse_data(http_response.content):
+                            if event_data == '[DONE]':
+                                # end marker received. stop here
+                                break
+                            self._call_back(on_event, json.loads(event_data))
+                finally:
+                    self._active_streams -= 1
+                    pooled_session.in_use -= 1
+                    pooled_session.last_used = monotonic()
+        except (Exception, asyncio.CancelledError) as e:
+            # a cancelled stream is over: its response is closed on exit
+            error = e
+        stream.task = None
+        self._call_back(on_end, error, opened, response_headers)
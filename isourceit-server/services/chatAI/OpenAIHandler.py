@@ -1,10 +1,13 @@
+import asyncio
 import json
 import logging
 from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
 from multiprocessing.queues import Queue
-from typing import Optional, Dict, List
+from threading import Lock
+from typing import Optional, Dict, List, Tuple, Callable, Mapping, Set
 
+import aiohttp
 import requests
 import sseclient
 
@@ -12,6 +15,13 @@ from mongoDAO.MongoDAO import MongoDAO
 from mongoDAO.studentActionRepository import find_last_chat_ai_model_interactions
 from mongoModel.StudentAction import AskChatAI
 from services.chatAI.ChatAIHandler import ChatAIHandler
+from services.chatAI.ChatContextBuilder import ChatContextBuilder
+from services.chatAI.HttpSessionPool import HttpSessionPool, DEFAULT_IDLE_TIMEOUT
+from services.chatAI.OpenAIAsyncEngine import OpenAIAsyncEngine, DEFAULT_MAX_STREAMS
+from services.chatAI.OpeningTurnCache import OpeningTurnCache, DEFAULT_TTL_SECONDS as DEFAULT_OPENING_TURN_TTL
+from services.chatAI.PromptScheduler import PromptOutcome, parse_rate_limit_headers
+from services.chatAI.TranscriptInvalidations import TranscriptInvalidations
+from utils.LRUCache import LRUCache
 
 __all__ = ['OpenAIHAndler']
 
@@ -21,10 +31,13 @@ NAME_MODEL_DICT = {
     'gpt-3.5-turbo': 'Most capable GPT-3.5 model.'
 }
 
-OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+OPENAI_CHAT_PATH = "/chat/completions"
 DEFAULT_WORKER_POOL_SIZE = 4
+DEFAULT_TRANSCRIPT_CACHE_SIZE = 1000
 OPENAI_SYSTEM_INIT_PROMPT = "You are a helpful assistant."
 OPENAI_TEMPERATURE = 0.6
+DEFAULT_WARM_TIMEOUT = 120
 
 
 def generate_request_messages_from_previous_chat_interactions(chat_interactions: List):
@@ -40,20 +53,89 @@ def generate_request_messages_from_previous_chat_interactions(chat_interactions:
                        'prompt']}
 
 
+def _is_retryable_status(status: int) -> bool:
+    # rate limited or provider error
+    return status == 429 or status >= 500
+
+
+def _transcript_turn(prompt: Optional[str], hidden_prompt: Optional[str], answer: Optional[str] = None,
+                     achieved: bool = False) -> Dict:
+    # same shape as the interactions retrieved from the database
+    turn = {'prompt': prompt, 'achieved': achieved}
+    if hidden_prompt:
+        turn['hidden_prompt'] = hidden_prompt
+    if achieved:
+        turn['answer'] = answer if answer is not None else ''
+    return turn
+
+
+class _TranscriptUse:
+    __slots__ = ['prompts', 'stale']
+
+    def __init__(self):
+        self.prompts = 1  # prompts of the conversation being handled
+        self.stale = False  # True once the transcript taken by a prompt may miss a turn
+
+
 class OpenAIHAndler(ChatAIHandler):
-    __slots__ = ['_response_queue', '_worker_pool_size', '_worker_pool']
+    """
+    Conversation transcripts are kept in a bounded LRU cache by (student, exam, question index, chat id), extended as
+    prompts are answered, to avoid reading the whole conversation from the database on each prompt. A transcript is
+    taken out of the cache while its prompt is handled, and put back once the prompt is ended, unless stale: when
+    prompts of the conversation overlap, or when it is invalidated meanwhile. When a process handles a prompt, the
+    other processes drop their transcript of the conversation (see TranscriptInvalidations).
+    Answers are streamed by the threads of the worker pool ('thread', default), or by the asyncio engine ('asyncio').
+    With the asyncio engine, the worker pool only prepares requests.
+    Prompts being answered are kept by action id to cancel them: the asyncio engine closes the stream at once, a thread
+    closes it on its next event.
+    """
+    __slots__ = ['_response_queue', '_worker_pool_size', '_worker_pool', '_transcript_cache',
+                 '_transcript_invalidations', '_invalidated_transcripts', '_transcript_uses', '_transcript_lock',
+                 '_chat_url', '_engine', '_async_max_streams', '_async_engine', '_http_pool_size', '_http_idle_timeout',
+                 '_http_session_pool', '_opening_turn_cache', '_active_prompts', '_cancelled_prompts']
 
     def __init__(self, response_queue: Queue, config: Dict = None):
         self._worker_pool: ThreadPoolExecutor = None
         self._worker_pool_size: int = -1
         self._response_queue: Queue = response_queue
+        self._transcript_cache: Optional[LRUCache] = None
+        self._transcript_invalidations: Optional[TranscriptInvalidations] = None
+        self._invalidated_transcripts: int = 0
+        # conversations whose prompts are being handled, by transcript key
+        self._transcript_uses: Dict[Tuple, _TranscriptUse] = dict()
+        self._transcript_lock = Lock()
+        self._chat_url: str = OPENAI_BASE_URL + OPENAI_CHAT_PATH
+        self._engine: str = 'thread'
+        self._async_max_streams: int = DEFAULT_MAX_STREAMS
+        self._async_engine: Optional[OpenAIAsyncEngine] = None
+        self._http_pool_size: Optional[int] = None
+        self._http_idle_timeout: float = DEFAULT_IDLE_TIMEOUT
+        self._http_session_pool: Optional[HttpSessionPool] = None
+        self._opening_turn_cache: Optional[OpeningTurnCache] = None
+        # close function of the stream of the prompts being answered (None until opened), by action id
+        self._active_prompts: Dict[str, Optional[Callable[[], None]]] = dict()
+        self._cancelled_prompts: Set[str] = set()
         self._init_config(config)
 
     def _init_config(self, config: Dict = None):
         if config is not None:
             self._worker_pool_size = config.get('CHATAI_OPENAI_POOL_SIZE', DEFAULT_WORKER_POOL_SIZE)
+            transcript_cache_size = config.get('CHATAI_OPENAI_TRANSCRIPT_CACHE_SIZE', DEFAULT_TRANSCRIPT_CACHE_SIZE)
+            self._chat_url = config.get('CHATAI_OPENAI_BASE_URL', OPENAI_BASE_URL).rstrip('/') + OPENAI_CHAT_PATH
+            self._engine = config.get('CHATAI_OPENAI_ENGINE', 'thread')
+            self._async_max_streams = config.get('CHATAI_OPENAI_ASYNC_MAX_STREAMS', DEFAULT_MAX_STREAMS)
+            self._http_pool_size = config.get('CHATAI_OPENAI_HTTP_POOL_SIZE')
+            self._http_idle_timeout = config.get('CHATAI_OPENAI_HTTP_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT)
+            if transcript_cache_size > 0:
+                self._transcript_invalidations = TranscriptInvalidations.from_url(config.get('REDIS_URL', 'redis://'))
+            if config.get('CHATAI_OPENING_TURN_CACHE', False):
+                self._opening_turn_cache = OpeningTurnCache.from_url(
+                    config.get('REDIS_URL', 'redis://'),
+                    ttl=config.get('CHATAI_OPENING_TURN_CACHE_TTL', DEFAULT_OPENING_TURN_TTL))
         else:
             self._worker_pool_size = DEFAULT_WORKER_POOL_SIZE
+            transcript_cache_size = DEFAULT_TRANSCRIPT_CACHE_SIZE
+        self._transcript_cache = LRUCache(transcript_cache_size) if transcript_cache_size > 0 else None
 
     @property
     def chat_key(self) -> str:
@@ -78,11 +160,36 @@ class OpenAIHAndler(ChatAIHandler):
     def connected(self):
         return self._worker_pool is not None
 
+    @property
+    def metrics(self) -> Optional[Dict]:
+        metrics = dict()
+        if self._transcript_cache is not None:
+            transcript_cache_stats = self._transcript_cache.stats()
+            transcript_cache_stats['invalidated'] = self._invalidated_transcripts
+            metrics['transcript_cache'] = transcript_cache_stats
+        if self._async_engine is not None:
+            metrics['http_sessions'] = self._async_engine.stats()
+            if self._http_session_pool is not None:
+                metrics['warm_up_http_sessions'] = self._http_session_pool.stats()
+        elif self._http_session_pool is not None:
+            metrics['http_sessions'] = self._http_session_pool.stats()
+        return metrics if metrics else None
+
     def connect(self):
         if self.connected:
             LOG.warning('Already connect.')
             return
         self._worker_pool = ThreadPoolExecutor(max_workers=self._worker_pool_size)
+        if self._transcript_invalidations is not None:
+            self._transcript_invalidations.start(self._invalidate_transcript)
+        # a thread sends a single request at once. With the asyncio engine, the pool only sends opening turn warm-ups
+        self._http_session_pool = HttpSessionPool(pool_max_size=self._http_pool_size or self._worker_pool_size,
+                                                  idle_timeout=self._http_idle_timeout)
+        if self._engine == 'asyncio':
+            self._async_engine = OpenAIAsyncEngine(max_streams=self._async_max_streams,
+                                                   pool_max_size=self._http_pool_size,
+                                                   idle_timeout=self._http_idle_timeout)
+            self._async_engine.start()
 
     def disconnect(self):
         if self.connected:
@@ -90,6 +197,12 @@ class OpenAIHAndler(ChatAIHandler):
             return
         self._worker_pool.shutdown(wait=True, cancel_futures=True)
         self._worker_pool = None
+        if self._async_engine is not None:
+            self._async_engine.stop()
+            self._async_engine = None
+        if self._http_session_pool is not None:
+            self._http_session_pool.close()
+            self._http_session_pool = None
 
     def request_available_models(self, request_identifiers: Dict = None, **kwargs):
         if not self.connected:
@@ -103,19 +216,94 @@ class OpenAIHAndler(ChatAIHandler):
             result['chat_key'] = self.chat_key
             self._response_queue.put(result)
 
-    def _handle_prompt(self, action: AskChatAI, private_key: str, request_identifiers: Dict = None,
-                       extra: dict = None):
-        # retrieve previous exchanges (requires examId, username, questionIdx, chat_key)
-        mongo_dao = MongoDAO()
-        old_chat_interactions = find_last_chat_ai_model_interactions(mongo_dao, username=action['student_username'],
+    @staticmethod
+    def _transcript_key(action: AskChatAI) -> Tuple:
+        return action['student_username'], action['exam_id'], action['question_idx'], action['chat_id']
+
+    def _find_previous_interactions(self, action: AskChatAI) -> Tuple[Tuple, List[Dict]]:
+        """
+        Retrieve the previous exchanges of the conversation, from the transcript cache or the database.
+        The transcript is used by the prompt until released
+        :return: the transcript cache key and the previous interactions, ending with the prompt of the action
+        """
+        transcript_key = OpenAIHAndler._transcript_key(action)
+        if self._transcript_cache is not None:
+            with self._transcript_lock:
+                use = self._transcript_uses.get(transcript_key)
+                if use is None:
+                    self._transcript_uses[transcript_key] = _TranscriptUse()
+                else:
+                    # overlapping prompts: none of their transcripts has the answer of the other
+                    use.prompts += 1
+                    use.stale = True
+                # taken until the prompt is ended: a prompt never ended (eg.: abandoned) is reloaded next time
+                transcript = self._transcript_cache.pop(transcript_key)
+            if self._transcript_invalidations is not None:
+                self._transcript_invalidations.publish(transcript_key)
+            if transcript is not None:
+                return transcript_key, transcript + [_transcript_turn(action.get('prompt'),
+                                                                      action.get('hidden_prompt'))]
+        old_chat_interactions = find_last_chat_ai_model_interactions(MongoDAO(), username=action['student_username'],
                                                                      exam_id=action['exam_id'],
                                                                      question_idx=action['question_idx'],
                                                                      chat_id=action['chat_id'])
-        # forge request using stream mode and user tracking
+        return transcript_key, old_chat_interactions
+
+    def _release_transcript(self, transcript_key: Tuple) -> None:
+        if self._transcript_cache is None:
+            return
+        with self._transcript_lock:
+            use = self._transcript_uses.get(transcript_key)
+            if use is not None:
+                use.prompts -= 1
+                if use.prompts <= 0:
+                    del self._transcript_uses[transcript_key]
+
+    def _invalidate_transcript(self, transcript_key: Optional[Tuple]) -> None:
+        # the conversation is continued by another process
+        with self._transcript_lock:
+            if transcript_key is None:
+                self._invalidated_transcripts += len(self._transcript_cache)
+                self._transcript_cache.clear()
+                for use in self._transcript_uses.values():
+                    use.stale = True
+                return
+            use = self._transcript_uses.get(transcript_key)
+            if use is not None:
+                use.stale = True
+            if self._transcript_cache.pop(transcript_key) is not None:
+                self._invalidated_transcripts += 1
+
+    def _cache_transcript(self, transcript_key: Tuple, chat_interactions: List[Dict], action: AskChatAI,
+                          answer_chunks: Optional[List[str]]) -> None:
+        if self._transcript_cache is None or not chat_interactions:
+            return
+        # the last interaction is the prompt just handled: replace it by its final state (answered if achieved)
+        answer = ''.join(answer_chunks) if answer_chunks else None
+        last_turn = _transcript_turn(action.get('prompt'), action.get('hidden_prompt'), answer,
+                                     achieved=answer_chunks is not None)
+        with self._transcript_lock:
+            use = self._transcript_uses.get(transcript_key)
+            if use is None or use.stale:
+                # a newer transcript is being built, or the next prompt reloads it from the database
+                self._invalidated_transcripts += 1
+                return
+            self._transcript_cache.put(transcript_key, chat_interactions[:-1] + [last_turn])
+
+    def _forge_request(self, action: AskChatAI, private_key: str, old_chat_interactions: List[Dict],
+                       extra: dict) -> Tuple[Dict, Dict]:
+        """
+        Forge request using stream mode and user tracking
+        :return: the request body and headers
+        """
         init_prompt = extra['custom_init_prompt'] if 'custom_init_prompt' in extra else OPENAI_SYSTEM_INIT_PROMPT
         temperature = extra['custom_temperature'] if 'custom_temperature' in extra is not None else OPENAI_TEMPERATURE
-        rq_messages = [{"role": "system", "content": init_prompt}] + list(
-            generate_request_messages_from_previous_chat_interactions(old_chat_interactions))
+        # keep the conversation within the token budget, with the socratic opening hidden prompt in any case
+        context_builder = ChatContextBuilder(extra.get('context_token_budget'))
+        rq_messages = context_builder.build(
+            {"role": "system", "content": init_prompt},
+            list(generate_request_messages_from_previous_chat_interactions(old_chat_interactions)),
+            keep_opening_prompt=bool(old_chat_interactions and old_chat_interactions[0].get('hidden_prompt')))
         rq_body = {
             'model': action['model_key'],
             'messages': rq_messages,
@@ -125,81 +313,329 @@ class OpenAIHAndler(ChatAIHandler):
         }
         rq_headers = {"Authorization": "Bearer {}".format(private_key),
                       "Content-Type": "application/json"}
+        return rq_body, rq_headers
 
-        # send request as stream and retrieve event sequentially
-        try:
-            http_response = requests.post(OPENAI_CHAT_URL, data=json.dumps(rq_body), headers=rq_headers, stream=True)
-            http_response.raise_for_status()
-        except requests.exceptions.Timeout as e:
-            LOG.warning('timeout exception: {}'.format(repr(e)))
-        except requests.exceptions.ConnectionError as e:
-            LOG.warning('Connection exception: {}'.format(repr(e)))
-        except requests.exceptions.HTTPError as e:
-            LOG.warning('HTTPError: {}'.format(repr(e)))
-        except requests.exceptions.RequestException as e:
-            LOG.warning('Other request error: {}'.format(repr(e)))
-        else:
-            client = sseclient.SSEClient(http_response)
-            for event in client.events():
-                if event.data == '[DONE]':
-                    # end marker received. stop here
-                    break
-                # parse json data
-                try:
-                    ev_data = json.loads(event.data)
-                except JSONDecodeError as e:
-                    LOG.warning("Got json decode error: {}".format(repr(e)))
-                    break
-                else:
-                    # process finish_reason (for logging)
-                    finish_reason = ev_data['choices'][0]["finish_reason"]
-                    if finish_reason == 'content_filter':
-                        LOG.warning("Got OpenAI answer with content_filter marker: Omitted content due to a flag from "
-                                    "OpenAI content filters. User {}".format(action['student_username']))
-                    elif finish_reason == 'length':
-                        LOG.warning("Got OpenAI answer with length marker: Incomplete model output due to max_tokens "
-                                    "parameter or token limit. User {}".format(action['student_username']))
-                    # process answer delta
-                    delta = ev_data['choices'][0]['delta']
-                    # if role received, check it for logging and do nothing else
-                    if 'role' in delta:
-                        if delta['role'] != 'assistant':
-                            LOG.warning("Got OpenAI answer with bad role: {}".format(delta['role']))
-                        continue
-                    # if content received, set it as the answer of the result and send the result to the queue
-                    if 'content' in delta:
-                        # prepare a response
-                        result = dict()
-                        if request_identifiers is not None:
-                            result.update(request_identifiers)
-                        result['answer'] = delta['content']
-                        result['ended'] = False
-                        result['chat_key'] = self.chat_key
-                        result['model_key'] = action['model_key']
-                        self._response_queue.put(result)
+    def _process_event(self, ev_data: Dict, action: AskChatAI, request_identifiers: Optional[Dict],
+                       answer_chunks: List[str]) -> Optional[str]:
+        """
+        :return: the finish reason of the event if any
+        """
+        # process finish_reason (for logging)
+        finish_reason = ev_data['choices'][0]["finish_reason"]
+        if finish_reason == 'content_filter':
+            LOG.warning("Got OpenAI answer with content_filter marker: Omitted content due to a flag from "
+                        "OpenAI content filters. User {}".format(action['student_username']))
+        elif finish_reason == 'length':
+            LOG.warning("Got OpenAI answer with length marker: Incomplete model output due to max_tokens "
+                        "parameter or token limit. User {}".format(action['student_username']))
+        # process answer delta
+        delta = ev_data['choices'][0]['delta']
+        # if role received, check it for logging and do nothing else
+        if 'role' in delta:
+            if delta['role'] != 'assistant':
+                LOG.warning("Got OpenAI answer with bad role: {}".format(delta['role']))
+            return finish_reason
+        # if content received, set it as the answer of the result and send the result to the queue
+        if 'content' in delta:
+            # prepare a response
+            result = dict()
+            if request_identifiers is not None:
+                result.update(request_identifiers)
+            result['answer'] = delta['content']
+            result['ended'] = False
+            result['chat_key'] = self.chat_key
+            result['model_key'] = action['model_key']
+            self._response_queue.put(result)
+            answer_chunks.append(delta['content'])
+        return finish_reason
+
+    def _opening_turn_key(self, rq_body: Dict, old_chat_interactions: List[Dict]) -> Optional[str]:
+        """
+        :return: the opening turn cache key of the request if it is the opening turn of a conversation and the cache
+        is enabled, None otherwise
+        """
+        if self._opening_turn_cache is None or len(old_chat_interactions) != 1 \
+                or not old_chat_interactions[0].get('hidden_prompt'):
+            return None
+        return OpeningTurnCache.cache_key(rq_body['model'], rq_body['messages'][0]['content'],
+                                          old_chat_interactions[0]['hidden_prompt'], rq_body['temperature'])
+
+    def _replay_opening_turn(self, opening_turn_key: Optional[str], action: AskChatAI,
+                             request_identifiers: Optional[Dict], transcript_key: Tuple,
+                             old_chat_interactions: List[Dict]) -> bool:
+        """
+        Send the cached answer of an opening turn as a streamed answer
+        :return: True if the answer was cached
+        """
+        if opening_turn_key is None:
+            return False
+        answer = self._opening_turn_cache.get(opening_turn_key)
+        if answer is None:
+            return False
+        self._process_event({'choices': [{'finish_reason': None, 'delta': {'content': answer}}]}, action,
+                            request_identifiers, [])
+        self._end_prompt(action, request_identifiers, transcript_key, old_chat_interactions, [answer])
+        return True
+
+    def _cache_opening_turn(self, opening_turn_key: Optional[str], finish_reason: Optional[str],
+                            answer_chunks: Optional[List[str]]) -> None:
+        # only complete answers are cached
+        if opening_turn_key is not None and finish_reason == 'stop' and answer_chunks:
+            self._opening_turn_cache.put(opening_turn_key, ''.join(answer_chunks))
+
+    def _end_prompt(self, action: AskChatAI, request_identifiers: Optional[Dict], transcript_key: Tuple,
+                    old_chat_interactions: List[Dict], answer_chunks: Optional[List[str]],
+                    truncated: bool = False) -> None:
+        if answer_chunks is not None:
             # send a last response to mark the end
             result = dict()
             if request_identifiers is not None:
                 result.update(request_identifiers)
             result['ended'] = True
+            if truncated:
+                result['truncated'] = True
             result['chat_key'] = self.chat_key
             result['model_key'] = action['model_key']
             self._response_queue.put(result)
+        self._cache_transcript(transcript_key, old_chat_interactions, action, answer_chunks)
+
+    @staticmethod
+    def _action_id(request_identifiers: Optional[Dict]) -> Optional[str]:
+        return request_identifiers.get('action_id') if request_identifiers is not None else None
+
+    def _is_cancelled(self, request_identifiers: Optional[Dict]) -> bool:
+        return OpenAIHAndler._action_id(request_identifiers) in self._cancelled_prompts
+
+    def _set_stream_closer(self, request_identifiers: Optional[Dict], close_stream: Callable[[], None]) -> None:
+        action_id = OpenAIHAndler._action_id(request_identifiers)
+        if action_id in self._active_prompts:
+            self._active_prompts[action_id] = close_stream
+            if action_id in self._cancelled_prompts:
+                # cancelled while the request was sent
+                close_stream()
+
+    def _forget_prompt(self, action: AskChatAI, request_identifiers: Optional[Dict]) -> None:
+        action_id = OpenAIHAndler._action_id(request_identifiers)
+        self._active_prompts.pop(action_id, None)
+        self._cancelled_prompts.discard(action_id)
+        self._release_transcript(OpenAIHAndler._transcript_key(action))
+
+    def cancel_prompt(self, action_id: str) -> bool:
+        if action_id not in self._active_prompts or action_id in self._cancelled_prompts:
+            return False
+        self._cancelled_prompts.add(action_id)
+        close_stream = self._active_prompts[action_id]
+        if close_stream is not None:
+            close_stream()
+        return True
+
+    def _handle_prompt(self, action: AskChatAI, private_key: str, request_identifiers: Dict = None,
+                       extra: dict = None) -> PromptOutcome:
+        # retrieve previous exchanges (requires examId, username, questionIdx, chat_key)
+        transcript_key, old_chat_interactions = self._find_previous_interactions(action)
+        # answer chunks, None while the answer is not achieved
+        answer_chunks: Optional[List[str]] = None
+        outcome = PromptOutcome()
+        finish_reason: Optional[str] = None
+        rq_body, rq_headers = self._forge_request(action, private_key, old_chat_interactions, extra)
+        opening_turn_key = self._opening_turn_key(rq_body, old_chat_interactions)
+        if self._replay_opening_turn(opening_turn_key, action, request_identifiers, transcript_key,
+                                     old_chat_interactions):
+            return outcome
+        if self._is_cancelled(request_identifiers):
+            self._end_prompt(action, request_identifiers, transcript_key, old_chat_interactions, [], truncated=True)
+            return outcome
+
+        # send request as stream, on a keep-alive session of the key, and retrieve event sequentially
+        with self._http_session_pool.session(private_key, self._chat_url) as http_session:
+            try:
+                http_response = http_session.post(self._chat_url, data=json.dumps(rq_body), headers=rq_headers,
+                                                 stream=True)
+                http_response.raise_for_status()
+            except requests.exceptions.Timeout as e:
+                LOG.warning('timeout exception: {}'.format(repr(e)))
+            except requests.exceptions.ConnectionError as e:
+                LOG.warning('Connection exception: {}'.format(repr(e)))
+            except requests.exceptions.HTTPError as e:
+                LOG.warning('HTTPError: {}'.format(repr(e)))
+                outcome = PromptOutcome(retry=_is_retryable_status(e.response.status_code),
+                                        rate_limit=parse_rate_limit_headers(e.response.headers))
+            except requests.exceptions.RequestException as e:
+                LOG.warning('Other request error: {}'.format(repr(e)))
+            else:
+                outcome = PromptOutcome(rate_limit=parse_rate_limit_headers(http_response.headers))
+                answer_chunks = []
+                client = sseclient.SSEClient(http_response)
+                marker_received = False
+                for event in client.events():
+                    if marker_received:
+                        # read the stream until its end to release the connection to the session pool
+                        continue
+                    if event.data == '[DONE]':
+                        # end marker received. stop processing here
+                        marker_received = True
+                        continue
+                    if self._is_cancelled(request_identifiers):
+                        # the connection is closed rather than released, as the stream is not read to its end
+                        http_response.close()
+                        break
+                    # parse json data
+                    try:
+                        ev_data = json.loads(event.data)
+                    except JSONDecodeError as e:
+                        LOG.warning("Got json decode error: {}".format(repr(e)))
+                        break
+                    else:
+                        finish_reason = self._process_event(ev_data, action, request_identifiers,
+                                                            answer_chunks) or finish_reason
+        if self._is_cancelled(request_identifiers):
+            outcome.retry = False
+            self._end_prompt(action, request_identifiers, transcript_key, old_chat_interactions, answer_chunks or [],
+                             truncated=True)
+        elif not outcome.retry:
+            self._end_prompt(action, request_identifiers, transcript_key, old_chat_interactions, answer_chunks)
+            self._cache_opening_turn(opening_turn_key, finish_reason, answer_chunks)
+        return outcome
+
+    def _run_prompt(self, action: AskChatAI, private_key: str, request_identifiers: Dict = None,
+                    extra: dict = None, on_completed: Callable[[PromptOutcome], None] = None):
+        outcome = PromptOutcome()
+        try:
+            outcome = self._handle_prompt(action, private_key, request_identifiers, extra)
+        finally:
+            self._forget_prompt(action, request_identifiers)
+            if on_completed is not None:
+                on_completed(outcome)
+
+    def _handle_prompt_async(self, action: AskChatAI, private_key: str, request_identifiers: Dict = None,
+                             extra: dict = None, on_completed: Callable[[PromptOutcome], None] = None):
+        # retrieve previous exchanges and forge the request here, then let the async engine stream the answer
+        try:
+            transcript_key, old_chat_interactions = self._find_previous_interactions(action)
+            rq_body, rq_headers = self._forge_request(action, private_key, old_chat_interactions, extra)
+            opening_turn_key = self._opening_turn_key(rq_body, old_chat_interactions)
+            # ended without request if the answer is cached, or the prompt already cancelled
+            ended = self._replay_opening_turn(opening_turn_key, action, request_identifiers, transcript_key,
+                                              old_chat_interactions)
+            if not ended and self._is_cancelled(request_identifiers):
+                self._end_prompt(action, request_identifiers, transcript_key, old_chat_interactions, [],
+                                 truncated=True)
+                ended = True
+        except Exception:
+            self._forget_prompt(action, request_identifiers)
+            if on_completed is not None:
+                on_completed(PromptOutcome())
+            raise
+        if ended:
+            self._forget_prompt(action, request_identifiers)
+            if on_completed is not None:
+                on_completed(PromptOutcome())
+            return
+        answer_chunks: List[str] = []
+        finish_reasons: List[str] = []
+
+        def on_event(ev_data: Dict):
+            finish_reason = self._process_event(ev_data, action, request_identifiers, answer_chunks)
+            if finish_reason is not None:
+                finish_reasons.append(finish_reason)
+
+        def on_end(error: Optional[Exception], opened: bool, response_headers: Optional[Mapping[str, str]]):
+            outcome = PromptOutcome(rate_limit=parse_rate_limit_headers(response_headers)
+                                    if response_headers is not None else None)
+            if isinstance(error, asyncio.TimeoutError):
+                LOG.warning('timeout exception: {}'.format(repr(error)))
+            elif isinstance(error, aiohttp.ClientConnectionError):
+                LOG.warning('Connection exception: {}'.format(repr(error)))
+            elif isinstance(error, aiohttp.ClientResponseError):
+                LOG.warning('HTTPError: {}'.format(repr(error)))
+                outcome.retry = not opened and _is_retryable_status(error.status)
+            elif isinstance(error, JSONDecodeError):
+                LOG.warning("Got json decode error: {}".format(repr(error)))
+            elif error is not None and not isinstance(error, asyncio.CancelledError):
+                LOG.warning('Other request error: {}'.format(repr(error)))
+            try:
+                if self._is_cancelled(request_identifiers):
+                    # the answer received so far is kept
+                    outcome.retry = False
+                    self._end_prompt(action, request_identifiers, transcript_key, old_chat_interactions,
+                                     answer_chunks, truncated=True)
+                # as with the thread pool, the end is marked only if the stream has been opened
+                elif not outcome.retry:
+                    self._end_prompt(action, request_identifiers, transcript_key, old_chat_interactions,
+                                     answer_chunks if opened else None)
+                    if error is None:
+                        self._cache_opening_turn(opening_turn_key, finish_reasons[-1] if finish_reasons else None,
+                                                 answer_chunks)
+            finally:
+                self._forget_prompt(action, request_identifiers)
+                if on_completed is not None:
+                    on_completed(outcome)
+
+        self._set_stream_closer(request_identifiers, self._async_engine.stream(
+            private_key, self._chat_url, rq_headers, rq_body, on_event, on_end))
+
+    @property
+    def supports_prompt_scheduling(self) -> bool:
+        return True
+
+    def _warm_opening_turn(self, opening_turn_key: str, private_key: str, rq_body: Dict, rq_headers: Dict) -> None:
+        try:
+            with self._http_session_pool.session(private_key, self._chat_url) as http_session:
+                http_response = http_session.post(self._chat_url, data=json.dumps(rq_body), headers=rq_headers,
+                                                  timeout=DEFAULT_WARM_TIMEOUT)
+                http_response.raise_for_status()
+                choice = http_response.json()['choices'][0]
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError) as e:
+            LOG.warning('Cannot warm opening turn: {}'.format(repr(e)))
+            return
+        if choice.get('finish_reason') == 'stop' and choice.get('message', {}).get('content'):
+            self._opening_turn_cache.put(opening_turn_key, choice['message']['content'])
+
+    def warm_opening_turn(self, model: str, hidden_prompt: str, **kwargs) -> bool:
+        if not self.connected or self._opening_turn_cache is None:
+            return False
+        private_key: str = kwargs.get('private_key')
+        if not private_key:
+            LOG.warning('Cannot request OpenAI without any private key.')
+            return False
+        extra_keys = ('custom_init_prompt', 'custom_temperature')
+        extra = dict((k, kwargs[k]) for k in extra_keys if k in kwargs and kwargs[k])
+        # same request as the opening turn of a student
+        action = AskChatAI(model_key=model, student_username=kwargs.get('username', ''))
+        old_chat_interactions = [_transcript_turn(None, hidden_prompt)]
+        rq_body, rq_headers = self._forge_request(action, private_key, old_chat_interactions, extra)
+        opening_turn_key = self._opening_turn_key(rq_body, old_chat_interactions)
+        if self._opening_turn_cache.contains(opening_turn_key):
+            return True
+        rq_body['stream'] = False
+        self._worker_pool.submit(self._warm_opening_turn, opening_turn_key, private_key, rq_body, rq_headers)
+        return True
 
     def send_prompt(self, model: str, prompt: str, request_identifiers: Dict = None, **kwargs):
+        on_completed: Optional[Callable[[PromptOutcome], None]] = kwargs.get('on_completed')
         if not self.connected:
             LOG.warning('Cannot request available model. Not Connected.')
+            if on_completed is not None:
+                on_completed(PromptOutcome())
             return
         private_key: str = kwargs.get('private_key')
         if not private_key:
             LOG.warning('Cannot request OpenAI without any private key.')
+            if on_completed is not None:
+                on_completed(PromptOutcome())
             return
         action: AskChatAI = kwargs.get('action')
         if not action:
             LOG.warning('Cannot request OpenAI without any action.')
+            if on_completed is not None:
+                on_completed(PromptOutcome())
             return
-        extra_keys = ('custom_init_prompt', 'custom_temperature')
+        extra_keys = ('custom_init_prompt', 'custom_temperature', 'context_token_budget')
         extra = dict((k, kwargs[k]) for k in extra_keys if k in kwargs and kwargs[k])
 
-        # Request thread pools of openai worker to
-        self._worker_pool.submit(self._handle_prompt, action, private_key, request_identifiers, extra)
+        action_id = OpenAIHAndler._action_id(request_identifiers)
+        if action_id is not None:
+            self._active_prompts[action_id] = None
+        # Request thread pools of openai worker to handle the prompt, or to hand it to the async engine
+        handle_prompt = self._handle_prompt_async if self._async_engine is not None else self._run_prompt
+        self._worker_pool.submit(handle_prompt, action, private_key, request_identifiers, extra, on_completed)
@@ -0,0 +1,43 @@
+import hashlib
+import json
+from typing import Optional
+
+from redis import Redis
+
+__all__ = ['OpeningTurnCache']
+
+DEFAULT_KEY_PREFIX = 'isourceit:opening-turn:'
+DEFAULT_TTL_SECONDS = 86400
+
+
+class OpeningTurnCache:
+    """
+    Redis cache of the answers to the opening turns of conversations (the hidden prompt of socratic questionnaires),
+    which are identical for every student of a question. Answers are keyed by a hash of the model, system prompt, hidden
+    prompt and temperature of the request, and expire after ttl seconds.
+    """
+    __slots__ = ['_redis', '_key_prefix', '_ttl']
+
+    def __init__(self, redis_client: Redis, key_prefix: str = DEFAULT_KEY_PREFIX, ttl: int = DEFAULT_TTL_SECONDS):
+        self._redis = redis_client
+        self._key_prefix = key_prefix
+        self._ttl = ttl
+
+    @staticmethod
+    def from_url(redis_url: str, ttl: int = DEFAULT_TTL_SECONDS) -> 'OpeningTurnCache':
+        return OpeningTurnCache(Redis.from_url(redis_url), ttl=ttl)
+
+    @staticmethod
+    def cache_key(model: str, system_prompt: str, hidden_prompt: str, temperature: float) -> str:
+        request_key = json.dumps([model, system_prompt, hidden_prompt, temperature])
+        return hashlib.sha256(request_key.encode()).hexdigest()
+
+    def get(self, cache_key: str) -> Optional[str]:
+        answer = self._redis.get(self._key_prefix + cache_key)
+        return answer.decode() if answer is not None else None
+
+    def put(self, cache_key: str, answer: str) -> None:
+        self._redis.set(self._key_prefix + cache_key, answer.encode(), ex=self._ttl)
+
+    def contains(self, cache_key: str) -> bool:
+        return self._redis.exists(self._key_prefix + cache_key) > 0
@@ -0,0 +1,55 @@
+from typing import Dict, Iterable, Optional
+
+from redis import Redis
+
+__all__ = ['PartialAnswerStore']
+
+DEFAULT_KEY_PREFIX = 'isourceit:partial-answer:'
+DEFAULT_TTL_SECONDS = 3600
+
+
+class PartialAnswerStore:
+    """
+    Redis store of the answers being streamed, by action id, so that any server process can read an in-flight answer.
+    Keys expire after ttl seconds without update.
+    """
+    __slots__ = ['_redis', '_key_prefix', '_ttl']
+
+    def __init__(self, redis_client: Redis, key_prefix: str = DEFAULT_KEY_PREFIX, ttl: int = DEFAULT_TTL_SECONDS):
+        self._redis = redis_client
+        self._key_prefix = key_prefix
+        self._ttl = ttl
+
+    @staticmethod
+    def from_url(redis_url: str) -> 'PartialAnswerStore':
+        return PartialAnswerStore(Redis.from_url(redis_url))
+
+    def _redis_key(self, action_id: str) -> str:
+        return self._key_prefix + action_id
+
+    def append(self, action_id: str, chunk: str) -> int:
+        """
+        Append a chunk to the partial answer of an action
+        :return: the size in bytes of the partial answer
+        """
+        key = self._redis_key(action_id)
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.append(key, chunk.encode())
+        pipeline.expire(key, self._ttl)
+        size, _ = pipeline.execute()
+        return size
+
+    def get(self, action_id: str) -> Optional[str]:
+        answer = self._redis.get(self._redis_key(action_id))
+        return answer.decode() if answer is not None else None
+
+    def get_many(self, action_ids: Iterable[str]) -> Dict[str, str]:
+        action_ids = list(action_ids)
+        if not action_ids:
+            return dict()
+        answers = self._redis.mget([self._redis_key(action_id) for action_id in action_ids])
+        return dict((action_id, answer.decode()) for action_id, answer in zip(action_ids, answers)
+                    if answer is not None)
+
+    def delete(self, action_id: str) -> None:
+        self._redis.delete(self._redis_key(action_id))
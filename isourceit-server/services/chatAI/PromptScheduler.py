@@ -0,0 +1,369 @@
+import hashlib
+import logging
+import random
+from collections import OrderedDict, deque
+from threading import Lock, Timer
+from time import monotonic
+from typing import Callable, Deque, Dict, List, Mapping, Optional
+
+__all__ = ['PromptScheduler', 'PromptOutcome', 'parse_rate_limit_headers']
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_EXAM_CONCURRENCY = 20
+DEFAULT_KEY_CONCURRENCY = 50
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+# weight of the last wait time in the average wait time of an exam
+WAIT_AVERAGE_WEIGHT = 0.2
+
+
+def _parse_reset_duration(value: str) -> Optional[float]:
+    # OpenAI durations: '1s', '6m0s', '20ms'
+    seconds = 0.0
+    number = ''
+    idx = 0
+    try:
+        while idx < len(value):
+            char = value[idx]
+            if char.isdigit() or char == '.':
+                number += char
+            elif value.startswith('ms', idx):
+                seconds += float(number) / 1000
+                number = ''
+                idx += 1
+            elif char in 'hms':
+                seconds += float(number) * {'h': 3600, 'm': 60, 's': 1}[char]
+                number = ''
+            else:
+                return None
+            idx += 1
+        return seconds + float(number) if number else seconds
+    except ValueError:
+        return None
+
+
+def parse_rate_limit_headers(headers: Mapping[str, str]) -> Dict:
+    """
+    Extract the rate limit information from the headers of a provider response
+    :return: the request limit, remaining requests and reset delay (in seconds) of the rate limit, and the retry
+    delay (in seconds), if provided
+    """
+    rate_limit = dict()
+    for name, header in (('limit', 'x-ratelimit-limit-requests'), ('remaining', 'x-ratelimit-remaining-requests')):
+        value = headers.get(header)
+        if value is not None and value.isdigit():
+            rate_limit[name] = int(value)
+    reset = headers.get('x-ratelimit-reset-requests')
+    if reset is not None:
+        reset_seconds = _parse_reset_duration(reset)
+        if reset_seconds is not None:
+            rate_limit['reset'] = reset_seconds
+    retry_after = headers.get('retry-after')
+    if retry_after is not None:
+        try:
+            rate_limit['retry_after'] = float(retry_after)
+        except ValueError:
+            pass
+    return rate_limit
+
+
+class PromptOutcome:
+    """
+    Outcome of a prompt, reported by the handler to the scheduler once the prompt is over
+    """
+    __slots__ = ['retry', 'rate_limit']
+
+    def __init__(self, retry: bool = False, rate_limit: Dict = None):
+        self.retry = retry  # True if the prompt has been rejected by the provider but may be retried (429/5xx)
+        self.rate_limit = rate_limit if rate_limit is not None else dict()
+
+
+class _PromptJob:
+    __slots__ = ['exam_id', 'student', 'key_id', 'start', 'job_id', 'on_dropped', 'submitted', 'ready_at',
+                 'attempts']
+
+    def __init__(self, exam_id: str, student: str, key_id: str, start: Callable, job_id: Optional[str] = None,
+                 on_dropped: Optional[Callable[[], None]] = None):
+        self.exam_id = exam_id
+        self.student = student
+        self.key_id = key_id
+        self.start = start
+        self.job_id = job_id
+        self.on_dropped = on_dropped
+        self.submitted = monotonic()
+        self.ready_at = 0.0
+        self.attempts = 0
+
+
+class _ExamQueue:
+    __slots__ = ['jobs_by_student', 'in_flight', 'wait_average', 'wait_max']
+
+    def __init__(self):
+        self.jobs_by_student: OrderedDict[str, Deque[_PromptJob]] = OrderedDict()
+        self.in_flight = 0
+        self.wait_average = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(jobs) for jobs in self.jobs_by_student.values())
+
+
+class _KeyState:
+    __slots__ = ['limit', 'in_flight', 'queued', 'backoff_until']
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.queued = 0
+        self.backoff_until = 0.0  # monotonic time until which the prompts rejected with the key are retried
+
+
+class _SchedulerCounters:
+    __slots__ = ['retries', 'dropped', 'rejected']
+
+    def __init__(self):
+        self.retries = 0
+        self.dropped = 0
+        self.rejected = 0
+
+
+class PromptScheduler:
+    """
+    Schedule the prompts sent to a chat provider, instead of sending them in arrival order.
+    Prompts are queued by exam then by student. Exams are served in turn, and students of an exam in turn, within
+    per-exam and per-API-key concurrency limits.
+    A prompt rejected by the provider (429/5xx) is retried with an exponential backoff (or after the delay given by
+    the provider), before the next prompts of its student. Once rejected more than max_retries times, it is dropped:
+    its on_dropped callback has to end it.
+    The concurrency limit of a key adapts to the provider: it is halved on rejection, limited to the remaining requests
+    of the rate limit, and increased by one on success, up to key_concurrency.
+    An exam is forgotten once it has no queued or in-flight prompt, and a key once it has no queued or in-flight
+    prompt and its backoff has elapsed: only cumulative counters are kept.
+    """
+
+    def __init__(self, exam_concurrency: int = DEFAULT_EXAM_CONCURRENCY,
+                 key_concurrency: int = DEFAULT_KEY_CONCURRENCY, max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_seconds: float = DEFAULT_BACKOFF_SECONDS):
+        self._exam_concurrency = exam_concurrency
+        self._key_concurrency = key_concurrency
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._exam_queues: OrderedDict[str, _ExamQueue] = OrderedDict()
+        self._key_states: Dict[str, _KeyState] = dict()
+        self._counters = _SchedulerCounters()
+        self._lock = Lock()
+        self._timer: Optional[Timer] = None
+        self._timer_deadline: Optional[float] = None
+
+    @staticmethod
+    def from_config(config: Dict) -> 'PromptScheduler':
+        return PromptScheduler(exam_concurrency=config.get('CHATAI_SCHEDULER_EXAM_CONCURRENCY',
+                                                           DEFAULT_EXAM_CONCURRENCY),
+                               key_concurrency=config.get('CHATAI_SCHEDULER_KEY_CONCURRENCY', DEFAULT_KEY_CONCURRENCY),
+                               max_retries=config.get('CHATAI_SCHEDULER_MAX_RETRIES', DEFAULT_MAX_RETRIES),
+                               backoff_seconds=config.get('CHATAI_SCHEDULER_BACKOFF_SECONDS',
+                                                          DEFAULT_BACKOFF_SECONDS))
+
+    @staticmethod
+    def key_id(api_key: Optional[str]) -> str:
+        # API keys are only kept hashed
+        return hashlib.sha256(api_key.encode()).hexdigest() if api_key else ''
+
+    def submit(self, exam_id: str, student: str, api_key: Optional[str],
+               start: Callable[[Callable[[PromptOutcome], None]], None], job_id: str = None,
+               on_dropped: Callable[[], None] = None) -> None:
+        """
+        Queue a prompt
+        :param exam_id: the exam of the prompt
+        :param student: the student of the prompt
+        :param api_key: the API key used to send the prompt
+        :param start: called to send the prompt, with the callback to call once the prompt is over. Must not block.
+        :param job_id: the identifier of the prompt, to cancel it
+        :param on_dropped: called once the prompt is abandoned after too many rejections
+        """
+        job = _PromptJob(exam_id, student, PromptScheduler.key_id(api_key), start, job_id, on_dropped)
+        with self._lock:
+            self._enqueue(job, first=False)
+        self._dispatch()
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Remove a prompt waiting for its turn (or for its retry)
+        :return: False if the prompt is not queued (unknown, or being sent)
+        """
+        with self._lock:
+            for exam_queue in self._exam_queues.values():
+                for student, student_jobs in exam_queue.jobs_by_student.items():
+                    job = next((j for j in student_jobs if j.job_id == job_id), None)
+                    if job is None:
+                        continue
+                    student_jobs.remove(job)
+                    if not student_jobs:
+                        del exam_queue.jobs_by_student[student]
+                    self._key_states[job.key_id].queued -= 1
+                    self._forget_idle(monotonic())
+                    return True
+        return False
+
+    def _enqueue(self, job: _PromptJob, first: bool) -> None:
+        exam_queue = self._exam_queues.get(job.exam_id)
+        if exam_queue is None:
+            exam_queue = _ExamQueue()
+            self._exam_queues[job.exam_id] = exam_queue
+        student_jobs = exam_queue.jobs_by_student.get(job.student)
+        if student_jobs is None:
+            student_jobs = deque()
+            exam_queue.jobs_by_student[job.student] = student_jobs
+        if first:
+            student_jobs.appendleft(job)
+        else:
+            student_jobs.append(job)
+        key_state = self._key_states.get(job.key_id)
+        if key_state is None:
+            key_state = _KeyState(self._key_concurrency)
+            self._key_states[job.key_id] = key_state
+        key_state.queued += 1
+
+    def _forget_idle(self, now: float) -> None:
+        # with the lock: forget the exams and keys without prompts, so that only active ones are walked
+        idle_exam_ids = [exam_id for exam_id, exam_queue in self._exam_queues.items()
+                         if not exam_queue.jobs_by_student and exam_queue.in_flight == 0]
+        for exam_id in idle_exam_ids:
+            del self._exam_queues[exam_id]
+        idle_key_ids = [key_id for key_id, key_state in self._key_states.items()
+                        if key_state.queued == 0 and key_state.in_flight == 0 and key_state.backoff_until <= now]
+        for key_id in idle_key_ids:
+            del self._key_states[key_id]
+
+    def _pop_next_job(self, now: float) -> Optional[_PromptJob]:
+        # exams in turn, then students of the exam in turn
+        for exam_id, exam_queue in self._exam_queues.items():
+            if exam_queue.in_flight >= self._exam_concurrency:
+                continue
+            for student, student_jobs in exam_queue.jobs_by_student.items():
+                job = student_jobs[0]
+                key_state = self._key_states[job.key_id]
+                if job.ready_at > now or key_state.in_flight >= key_state.limit:
+                    continue
+                student_jobs.popleft()
+                key_state.queued -= 1
+                if student_jobs:
+                    exam_queue.jobs_by_student.move_to_end(student)
+                else:
+                    del exam_queue.jobs_by_student[student]
+                self._exam_queues.move_to_end(exam_id)
+                return job
+        return None
+
+    def _dispatch(self) -> None:
+        jobs_to_start: List[_PromptJob] = []
+        with self._lock:
+            now = monotonic()
+            job = self._pop_next_job(now)
+            while job is not None:
+                exam_queue = self._exam_queues[job.exam_id]
+                exam_queue.in_flight += 1
+                self._key_states[job.key_id].in_flight += 1
+                wait_time = now - job.submitted
+                exam_queue.wait_average += WAIT_AVERAGE_WEIGHT * (wait_time - exam_queue.wait_average)
+                exam_queue.wait_max = max(exam_queue.wait_max, wait_time)
+                job.attempts += 1
+                jobs_to_start.append(job)
+                job = self._pop_next_job(now)
+            self._forget_idle(now)
+            self._schedule_backoff_wakeup(now)
+        for job in jobs_to_start:
+            try:
+                job.start(lambda outcome, started_job=job: self._complete(started_job, outcome))
+            except Exception as e:
+                LOG.warning('Cannot start prompt: %s', repr(e))
+                self._complete(job, PromptOutcome())
+
+    def _schedule_backoff_wakeup(self, now: float) -> None:
+        # with the lock: wake up the dispatch once the first retried prompt is ready
+        ready_times = [student_jobs[0].ready_at for exam_queue in self._exam_queues.values()
+                       for student_jobs in exam_queue.jobs_by_student.values() if student_jobs[0].ready_at > now]
+        if not ready_times:
+            return
+        deadline = min(ready_times)
+        if self._timer is not None and self._timer_deadline <= deadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = Timer(deadline - now, self._on_backoff_elapsed)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_backoff_elapsed(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._timer_deadline = None
+        self._dispatch()
+
+    def _complete(self, job: _PromptJob, outcome: PromptOutcome) -> None:
+        dropped = False
+        with self._lock:
+            exam_queue = self._exam_queues[job.exam_id]
+            exam_queue.in_flight -= 1
+            key_state = self._key_states[job.key_id]
+            key_state.in_flight -= 1
+            self._adapt_key_limit(key_state, outcome)
+            if outcome.retry:
+                self._counters.rejected += 1
+                if job.attempts <= self._max_retries:
+                    self._counters.retries += 1
+                    backoff = outcome.rate_limit.get('retry_after')
+                    if backoff is None:
+                        backoff = min(MAX_BACKOFF_SECONDS, self._backoff_seconds * 2 ** (job.attempts - 1))
+                        backoff *= random.uniform(0.5, 1.0)
+                    job.ready_at = monotonic() + backoff
+                    key_state.backoff_until = max(key_state.backoff_until, job.ready_at)
+                    self._enqueue(job, first=True)
+                else:
+                    self._counters.dropped += 1
+                    dropped = True
+                    LOG.warning('Prompt of student %s for exam %s rejected %d times, abandoned', job.student,
+                                job.exam_id, job.attempts)
+        if dropped and job.on_dropped is not None:
+            try:
+                job.on_dropped()
+            except Exception as e:
+                LOG.warning('Cannot end abandoned prompt: %s', repr(e))
+        self._dispatch()
+
+    def _adapt_key_limit(self, key_state: _KeyState, outcome: PromptOutcome) -> None:
+        if outcome.retry:
+            key_state.limit = max(1, key_state.limit // 2)
+        else:
+            key_state.limit = min(self._key_concurrency, key_state.limit + 1)
+        remaining = outcome.rate_limit.get('remaining')
+        if remaining is not None:
+            # do not send more requests than the remaining ones of the rate limit window
+            key_state.limit = max(1, min(key_state.limit, remaining + key_state.in_flight))
+
+    def metrics(self) -> Dict:
+        """
+        :return: the metrics of the active exams and keys (wait times since the exam became active), and the
+        cumulative counters of rejected, retried and dropped prompts
+        """
+        with self._lock:
+            return {
+                'exams': dict((exam_id, {
+                    'queue_depth': exam_queue.depth,
+                    'in_flight': exam_queue.in_flight,
+                    'wait_average_ms': int(exam_queue.wait_average * 1000),
+                    'wait_max_ms': int(exam_queue.wait_max * 1000)
+                }) for exam_id, exam_queue in self._exam_queues.items()),
+                'keys': [{
+                    'concurrency_limit': key_state.limit,
+                    'in_flight': key_state.in_flight,
+                    'queue_depth': key_state.queued
+                } for key_state in self._key_states.values()],
+                'rejected': self._counters.rejected,
+                'retries': self._counters.retries,
+                'dropped': self._counters.dropped
+            }
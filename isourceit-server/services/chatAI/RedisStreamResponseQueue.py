@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import socket
+import zlib
+from collections import deque
+from queue import Empty
+from time import monotonic, sleep
+from typing import Deque, Dict, List, Optional, Tuple
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+__all__ = ['RedisStreamResponseQueue', 'RedisStreamShardConsumer']
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_STREAM_PREFIX = 'isourceit:chat-responses:'
+DEFAULT_GROUP_NAME = 'answer-relay'
+DEFAULT_MAX_LEN = 10000
+DEFAULT_LEASE_SECONDS = 30
+DEFAULT_READ_COUNT = 100
+
+# extend the shard lease only if still held by the consumer
+_REFRESH_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisStreamShardConsumer:
+    """
+    Consumer of a shard stream, with the get/task_done interface of a joinable queue so that a relay worker can use it
+    in place of its multiprocessing queue.
+    To keep the responses of a prompt ordered, a shard is consumed by a single consumer at a time: the one holding the
+    shard lease. Other consumers of the shard (eg.: relay workers of other server replicas) stand by, and take the
+    lease over when it expires, claiming the entries the previous holder did not acknowledge.
+    A response is acknowledged on task_done, once relayed.
+    """
+
+    def __init__(self, redis_client: Redis, stream_key: str, group_name: str, lease_seconds: float,
+                 read_count: int = DEFAULT_READ_COUNT):
+        self._redis = redis_client
+        self._stream_key = stream_key
+        self._group_name = group_name
+        self._lease_key = stream_key + ':lease'
+        self._lease_ms = int(lease_seconds * 1000)
+        self._read_count = read_count
+        self._consumer_name: Optional[str] = None
+        self._group_created = False
+        self._lease_deadline: float = 0.0
+        self._refresh_lease = self._redis.register_script(_REFRESH_LEASE_SCRIPT)
+        self._entries: Deque[Tuple[str, Dict]] = deque()
+        self._delivered_ids: Deque[str] = deque()
+
+    @property
+    def consumer_name(self) -> str:
+        # computed lazily: the consumer is created by the parent process, but used by the relay worker process
+        if self._consumer_name is None:
+            self._consumer_name = '{}-{}'.format(socket.gethostname(), os.getpid())
+        return self._consumer_name
+
+    def _ensure_group(self) -> None:
+        if self._group_created:
+            return
+        try:
+            self._redis.xgroup_create(self._stream_key, self._group_name, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_created = True
+
+    def _hold_lease(self) -> bool:
+        """
+        Acquire or extend the shard lease. On acquisition, claim the entries left unacknowledged by the previous holder.
+        :return: True if the consumer holds the lease
+        """
+        if monotonic() < self._lease_deadline - self._lease_ms / 3000:
+            return True
+        if self._lease_deadline > 0 and self._refresh_lease(keys=[self._lease_key],
+                                                            args=[self.consumer_name, self._lease_ms]):
+            self._lease_deadline = monotonic() + self._lease_ms / 1000
+            return True
+        if not self._redis.set(self._lease_key, self.consumer_name, nx=True, px=self._lease_ms):
+            self._lease_deadline = 0.0
+            return False
+        self._lease_deadline = monotonic() + self._lease_ms / 1000
+        self._claim_pending_entries()
+        return True
+
+    def _claim_pending_entries(self) -> None:
+        self._entries.clear()
+        start_id = '0-0'
+        while True:
+            claim_result = self._redis.xautoclaim(self._stream_key, self._group_name, self.consumer_name,
+                                                  min_idle_time=0, start_id=start_id, count=self._read_count)
+            next_start_id, entries = claim_result[0], claim_result[1]
+            self._buffer_entries(entries)
+            next_start_id = next_start_id.decode() if isinstance(next_start_id, bytes) else next_start_id
+            if next_start_id == '0-0':
+                break
+            start_id = next_start_id
+        if self._entries:
+            LOG.info("Claim %d unacknowledged chat responses of stream %s", len(self._entries), self._stream_key)
+
+    def _buffer_entries(self, entries: List) -> None:
+        for entry_id, fields in entries:
+            if fields is None:
+                # entry deleted (trimmed) while pending: nothing to relay
+                continue
+            entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+            self._entries.append((entry_id, json.loads(fields[b'response'])))
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Dict:
+        deadline = monotonic() + timeout if timeout is not None else None
+        self._ensure_group()
+        while True:
+            if not self._hold_lease():
+                # another consumer relays this shard: stand by
+                self._entries.clear()
+                if not block or (deadline is not None and monotonic() >= deadline):
+                    raise Empty()
+                remaining = self._lease_ms / 3000 if deadline is None else deadline - monotonic()
+                sleep(max(0.0, min(remaining, self._lease_ms / 3000)))
+                continue
+            if self._entries:
+                entry_id, response = self._entries.popleft()
+                self._delivered_ids.append(entry_id)
+                return response
+            # wait for new entries, but wake up in time to extend the lease
+            block_ms = int(self._lease_ms / 3)
+            if not block:
+                block_ms = None
+            elif deadline is not None:
+                block_ms = min(block_ms, max(1, int((deadline - monotonic()) * 1000)))
+            read_result = self._redis.xreadgroup(self._group_name, self.consumer_name, {self._stream_key: '>'},
+                                                 count=self._read_count, block=block_ms)
+            for _, entries in read_result:
+                self._buffer_entries(entries)
+            if not self._entries and (not block or (deadline is not None and monotonic() >= deadline)):
+                raise Empty()
+
+    def task_done(self) -> None:
+        if not self._delivered_ids:
+            raise ValueError('task_done() called too many times')
+        self._redis.xack(self._stream_key, self._group_name, self._delivered_ids.popleft())
+
+    def qsize(self) -> int:
+        """
+        :return: the number of responses not relayed yet: not delivered to the group, or delivered but not acknowledged
+        """
+        self._ensure_group()
+        for group_info in self._redis.xinfo_groups(self._stream_key):
+            name = group_info['name']
+            if (name.decode() if isinstance(name, bytes) else name) == self._group_name:
+                lag = group_info.get('lag')
+                if lag is None:
+                    raise NotImplementedError('Redis server does not report consumer group lag')
+                return lag + group_info['pending']
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class RedisStreamResponseQueue:
+    """
+    Queue of the chat AI handler responses, as Redis streams, so that handlers of any server replica can publish
+    responses that relay workers of any replica consume.
+    Responses are split into one stream per relay worker by a hash of their action id, as the sharded response queue.
+    The number of shards must be the same on every replica.
+    """
+
+    def __init__(self, redis_client: Redis, nb_shards: int = 1, stream_prefix: str = DEFAULT_STREAM_PREFIX,
+                 group_name: str = DEFAULT_GROUP_NAME, max_len: int = DEFAULT_MAX_LEN,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS):
+        if nb_shards <= 0:
+            raise Exception('Number of response queue shards must be strictly positive')
+        self._redis = redis_client
+        self._max_len = max_len
+        self._stream_keys: List[str] = [stream_prefix + str(idx) for idx in range(nb_shards)]
+        self._shards: List[RedisStreamShardConsumer] = [
+            RedisStreamShardConsumer(redis_client, stream_key, group_name, lease_seconds)
+            for stream_key in self._stream_keys]
+
+    @staticmethod
+    def from_config(config: Dict) -> 'RedisStreamResponseQueue':
+        return RedisStreamResponseQueue(Redis.from_url(config.get('REDIS_URL', 'redis://')),
+                                        nb_shards=config.get('CHATAI_RELAY_WORKERS', 1),
+                                        max_len=config.get('CHATAI_RESPONSE_STREAM_MAX_LEN', DEFAULT_MAX_LEN),
+                                        lease_seconds=config.get('CHATAI_RESPONSE_STREAM_LEASE_SECONDS',
+                                                                 DEFAULT_LEASE_SECONDS))
+
+    @property
+    def nb_shards(self) -> int:
+        return len(self._shards)
+
+    def shard(self, shard_idx: int) -> RedisStreamShardConsumer:
+        return self._shards[shard_idx]
+
+    def shard_index(self, response: Dict) -> int:
+        action_id = response.get('action_id')
+        if action_id is None or len(self._shards) == 1:
+            return 0
+        return zlib.crc32(action_id.encode()) % len(self._shards)
+
+    def put(self, response: Dict) -> None:
+        self._redis.xadd(self._stream_keys[self.shard_index(response)], {'response': json.dumps(response)},
+                         maxlen=self._max_len, approximate=True)
+
+    def depth(self, shard_idx: int) -> int:
+        try:
+            return self._shards[shard_idx].qsize()
+        except NotImplementedError:
+            return -1
+
+    def overflows(self, shard_idx: int) -> int:
+        # streams are trimmed to about max len entries instead of rejecting responses
+        return 0
+
+    def close(self) -> None:
+        self._redis.close()
@@ -0,0 +1,125 @@
+import logging
+import zlib
+from multiprocessing import JoinableQueue
+from queue import Full
+from threading import Lock
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Set
+
+__all__ = ['ShardedResponseQueue']
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_PUT_TIMEOUT = 1
+PUT_RETRY_INTERVAL = 0.01
+
+
+class ShardedResponseQueue:
+    """
+    Queue of the chat AI handler responses, split into one joinable queue per relay worker.
+    Responses are routed by a hash of their action id, so that the responses of a prompt are relayed in order by the
+    same worker. Responses without action id (eg.: model discovery) go to the first worker.
+    Each shard holds at most max_size responses: when a shard is full, put waits for its relay worker for at most
+    put_timeout seconds, then drops the answer chunk, counted as an overflow. The following chunks of the prompt are
+    dropped too, so that its answer is kept as received so far, and its end is marked as truncated.
+    Other responses (prompt ends, model discovery, queue positions) are never dropped: put waits until they are queued.
+    """
+    __slots__ = ['_shards', '_put_timeout', '_overflows', '_truncated_actions', '_lock']
+
+    def __init__(self, nb_shards: int = 1, max_size: int = DEFAULT_MAX_SIZE, put_timeout: float = DEFAULT_PUT_TIMEOUT):
+        if nb_shards <= 0:
+            raise Exception('Number of response queue shards must be strictly positive')
+        self._shards: List[JoinableQueue] = [JoinableQueue(max_size) for _ in range(nb_shards)]
+        self._put_timeout = put_timeout
+        self._overflows: List[int] = [0] * nb_shards
+        # action ids of the prompts whose answer chunks are dropped
+        self._truncated_actions: Set[str] = set()
+        self._lock = Lock()
+
+    @staticmethod
+    def from_config(config: Dict) -> 'ShardedResponseQueue':
+        return ShardedResponseQueue(config.get('CHATAI_RELAY_WORKERS', 1),
+                                    max_size=config.get('CHATAI_RELAY_QUEUE_MAX_SIZE', DEFAULT_MAX_SIZE),
+                                    put_timeout=config.get('CHATAI_RELAY_QUEUE_PUT_TIMEOUT_SECONDS',
+                                                           DEFAULT_PUT_TIMEOUT))
+
+    @property
+    def nb_shards(self) -> int:
+        return len(self._shards)
+
+    def shard(self, shard_idx: int) -> JoinableQueue:
+        return self._shards[shard_idx]
+
+    def shard_index(self, response: Dict) -> int:
+        action_id = response.get('action_id')
+        if action_id is None or len(self._shards) == 1:
+            return 0
+        # stable hash: the routing must not depend on the process hash seed
+        return zlib.crc32(action_id.encode()) % len(self._shards)
+
+    @staticmethod
+    def _is_answer_chunk(response: Dict) -> bool:
+        return response.get('request_type') == 'prompt' and response.get('ended') is not True \
+            and response.get('answer') is not None
+
+    def put(self, response: Dict) -> None:
+        shard_idx = self.shard_index(response)
+        action_id = response.get('action_id')
+        if self._is_answer_chunk(response):
+            with self._lock:
+                truncated = action_id in self._truncated_actions
+            # once a chunk dropped, the rest of the answer is dropped too
+            if truncated or not self._put(shard_idx, response, self._put_timeout):
+                with self._lock:
+                    self._truncated_actions.add(action_id)
+                self._drop(shard_idx, response)
+            return
+        if response.get('ended') is True and action_id is not None:
+            with self._lock:
+                truncated = action_id in self._truncated_actions
+                self._truncated_actions.discard(action_id)
+            if truncated:
+                response = dict(response, truncated=True)
+        self._put(shard_idx, response, None)
+
+    def _put(self, shard_idx: int, response: Dict, timeout: Optional[float]) -> bool:
+        """
+        :param timeout: seconds to wait for room in the shard, None to wait until queued
+        :return: False if the shard stayed full until the timeout
+        """
+        shard = self._shards[shard_idx]
+        # a blocking put would wait on a process semaphore, freezing every green thread of the server: poll instead
+        deadline = monotonic() + timeout if timeout is not None else None
+        while True:
+            try:
+                shard.put(response, block=False)
+                return True
+            except Full:
+                if deadline is not None and monotonic() >= deadline:
+                    return False
+                sleep(PUT_RETRY_INTERVAL)
+
+    def _drop(self, shard_idx: int, response: Dict) -> None:
+        self._overflows[shard_idx] += 1
+        LOG.warning('Chat response queue %d full, answer chunk of action %s dropped (%d overflows)', shard_idx,
+                    response.get('action_id'), self._overflows[shard_idx])
+
+    def depth(self, shard_idx: int) -> int:
+        """
+        :return: the approximate number of responses waiting in a shard, or -1 if the platform cannot tell
+        """
+        try:
+            return self._shards[shard_idx].qsize()
+        except NotImplementedError:
+            return -1
+
+    def overflows(self, shard_idx: int) -> int:
+        """
+        :return: the number of answer chunks dropped as a shard was full
+        """
+        return self._overflows[shard_idx]
+
+    def close(self) -> None:
+        for shard in self._shards:
+            shard.close()
@@ -0,0 +1,86 @@
+import json
+import logging
+from threading import Thread
+from time import sleep
+from typing import Callable, Optional, Tuple
+from uuid import uuid4
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+__all__ = ['TranscriptInvalidations']
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'isourceit:transcript-invalidation'
+RESUBSCRIBE_DELAY_SECONDS = 1
+
+
+class TranscriptInvalidations:
+    """
+    Invalidation of the conversation transcripts cached by the server processes, through a redis channel.
+    A process publishes the key of a conversation when it handles a prompt of it: the other processes drop their
+    transcript of this conversation, as it is continued elsewhere.
+    Once invalidations may have been missed (redis connection lost), every transcript has to be dropped.
+    """
+    __slots__ = ['_redis', '_channel', '_origin', '_listener']
+
+    def __init__(self, redis_client: Redis, channel: str = DEFAULT_CHANNEL):
+        self._redis = redis_client
+        self._channel = channel
+        # identify the invalidations of this process, which keeps its own transcript
+        self._origin = uuid4().hex
+        self._listener: Optional[Thread] = None
+
+    @staticmethod
+    def from_url(redis_url: str) -> 'TranscriptInvalidations':
+        return TranscriptInvalidations(Redis.from_url(redis_url))
+
+    def start(self, on_invalidate: Callable[[Optional[Tuple]], None]) -> None:
+        """
+        Listen to the invalidations published by the other processes
+        :param on_invalidate: called with the key of the invalidated transcript, or None if every transcript is
+        """
+        if self._listener is not None:
+            LOG.warning('Transcript invalidations already listening.')
+            return
+        pubsub = self._subscribe()
+        self._listener = Thread(target=self._listen, args=(pubsub, on_invalidate),
+                                name='transcript-invalidation-listener', daemon=True)
+        self._listener.start()
+
+    def publish(self, transcript_key: Tuple) -> None:
+        try:
+            self._redis.publish(self._channel, json.dumps(dict(origin=self._origin, key=list(transcript_key))))
+        except RedisError as e:
+            LOG.warning('Cannot publish transcript invalidation: %s', repr(e))
+
+    def _subscribe(self):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._channel)
+        return pubsub
+
+    def _listen(self, pubsub, on_invalidate: Callable[[Optional[Tuple]], None]) -> None:
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe()
+                for message in pubsub.listen():
+                    self._apply(message.get('data'), on_invalidate)
+            except RedisError as e:
+                LOG.warning('Transcript invalidation subscription lost, resubscribe: %s', repr(e))
+                # invalidations may have been missed meanwhile
+                on_invalidate(None)
+                pubsub = None
+                sleep(RESUBSCRIBE_DELAY_SECONDS)
+
+    def _apply(self, data, on_invalidate: Callable[[Optional[Tuple]], None]) -> None:
+        try:
+            invalidation = json.loads(data)
+            origin = invalidation['origin']
+            transcript_key = tuple(invalidation['key'])
+        except (TypeError, ValueError, KeyError):
+            LOG.warning('Invalid transcript invalidation: %s', data)
+            return
+        if origin != self._origin:
+            on_invalidate(transcript_key)
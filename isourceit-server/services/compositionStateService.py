@@ -0,0 +1,237 @@
+import logging
+from typing import Optional, Mapping, Any, Dict, List, Tuple
+
+from bson import ObjectId
+
+from mongoDAO import compositionStateRepository, studentActionRepository
+from mongoDAO.MongoDAO import MongoDAO
+from mongoModel.CompositionState import CompositionState, CompositionQuestionState, CompositionChatTurn, \
+    CompositionResource
+from mongoModel.StudentAction import StudentAction, START_EXAM_TYPE, WROTE_INITIAL_ANSWER_TYPE, ASK_CHAT_AI_TYPE, \
+    EXTERNAL_RESOURCE_TYPE, WROTE_FINAL_ANSWER_TYPE, SUBMIT_EXAM_TYPE, CHANGED_QUESTION_TYPE
+from services.ChatAIManager import ChatAIManager
+
+__all__ = ['record_composition_action', 'remove_composition_resource', 'find_composition_state',
+           'fill_composition_questions']
+
+LOG = logging.getLogger(__name__)
+
+# maximal number of rebuilds of a built state, while actions keep being saved meanwhile
+MAX_STATE_REBUILDS = 3
+
+
+def __new_composition_state(exam_id: str, username: str, nb_questions: int) -> CompositionState:
+    return CompositionState(exam_id=exam_id, student_username=username, started=False, started_timestamp=None,
+                            ended=False, current_question_idx=None, last_action_timestamp=None,
+                            questions=[CompositionQuestionState(init_answer=None, final_answer=None, chat_turns=[],
+                                                                resources=[]) for _ in range(nb_questions)])
+
+
+def __create_chat_turn(action: Mapping, action_id: str) -> CompositionChatTurn:
+    turn = CompositionChatTurn(id=action_id, chat_id=action['chat_id'], prompt=action.get('prompt'),
+                               answer=action.get('answer'), achieved=action.get('achieved', False) is True,
+                               timestamp=action['timestamp'])
+    if action.get('truncated') is True:
+        turn['truncated'] = True
+    return turn
+
+
+def __create_resource(action: Mapping, action_id: str) -> CompositionResource:
+    return CompositionResource(id=action_id, title=action['title'], description=action['description'],
+                               rsc_type=action.get('rsc_type'), timestamp=action['timestamp'])
+
+
+def __apply_action(state: CompositionState, action: StudentAction) -> None:
+    # any action means the composition has been started
+    state['started'] = True
+    action_type = action['action_type']
+    if action_type == START_EXAM_TYPE:
+        if state['started_timestamp'] is None:
+            state['started_timestamp'] = action['timestamp']
+        return
+    if action_type == SUBMIT_EXAM_TYPE:
+        state['ended'] = True
+        return
+    if action_type == CHANGED_QUESTION_TYPE:
+        state['current_question_idx'] = action.get('next_question_idx')
+        return
+
+    question_idx = action.get('question_idx')
+    if action_type not in (WROTE_INITIAL_ANSWER_TYPE, ASK_CHAT_AI_TYPE, EXTERNAL_RESOURCE_TYPE,
+                           WROTE_FINAL_ANSWER_TYPE):
+        # Other action (eg.: LOST_FOCUS_TYPE) do not matter here
+        return
+    if question_idx is None or question_idx < 0 or question_idx >= len(state['questions']):
+        LOG.warning('Got question trace for unexisting exam question')
+        return
+    question = state['questions'][question_idx]
+    if action_type == WROTE_INITIAL_ANSWER_TYPE:
+        question['init_answer'] = action['text']
+    elif action_type == WROTE_FINAL_ANSWER_TYPE:
+        question['final_answer'] = action['text']
+    elif action_type == ASK_CHAT_AI_TYPE:
+        question['chat_turns'].append(__create_chat_turn(action, str(action['_id'])))
+    elif action_type == EXTERNAL_RESOURCE_TYPE and action.get('removed') is None:
+        question['resources'].append(__create_resource(action, str(action['_id'])))
+
+
+def __compute_action_update(action: StudentAction, action_id: str, nb_questions: int) -> Optional[Mapping]:
+    action_type = action['action_type']
+    if action_type == SUBMIT_EXAM_TYPE:
+        return {'$set': {'ended': True}}
+    if action_type == CHANGED_QUESTION_TYPE:
+        return {'$set': {'current_question_idx': action.get('next_question_idx')}}
+
+    question_idx = action.get('question_idx')
+    if question_idx is None or question_idx < 0 or question_idx >= nb_questions:
+        return None
+    question_path = 'questions.{}'.format(question_idx)
+    if action_type == WROTE_INITIAL_ANSWER_TYPE:
+        return {'$set': {question_path + '.init_answer': action['text']}}
+    if action_type == WROTE_FINAL_ANSWER_TYPE:
+        return {'$set': {question_path + '.final_answer': action['text']}}
+    if action_type == ASK_CHAT_AI_TYPE:
+        return {'$push': {question_path + '.chat_turns': __create_chat_turn(action, action_id)}}
+    if action_type == EXTERNAL_RESOURCE_TYPE:
+        return {'$push': {question_path + '.resources': __create_resource(action, action_id)}}
+    # Other action (eg.: LOST_FOCUS_TYPE) do not matter here
+    return None
+
+
+def record_composition_action(mongo_dao: MongoDAO, action: StudentAction, action_id: str, nb_questions: int) -> None:
+    """
+    Apply a saved student action to the composition state of the student
+    :param mongo_dao: the dao
+    :param action: the student action
+    :param action_id: the id of the saved action
+    :param nb_questions: the number of questions of the exam
+    """
+    if action['action_type'] == START_EXAM_TYPE:
+        state = __new_composition_state(action['exam_id'], action['student_username'], nb_questions)
+        state['started'] = True
+        state['started_timestamp'] = action['timestamp']
+        state['last_action_timestamp'] = action['timestamp']
+        compositionStateRepository.start_composition_state(mongo_dao, state)
+        return
+    update = __compute_action_update(action, action_id, nb_questions)
+    if update is not None and not compositionStateRepository.update_composition_state(
+            mongo_dao, action['exam_id'], action['student_username'], update, timestamp=action['timestamp']):
+        # actions may arrive out of order (batches, websocket): once a later action has been applied, the state
+        # would differ from the replay of the actions in timestamp order. It is built again on next read
+        compositionStateRepository.delete_composition_state(mongo_dao, action['exam_id'],
+                                                            action['student_username'],
+                                                            applied_after=action['timestamp'])
+
+
+def remove_composition_resource(mongo_dao: MongoDAO, action: StudentAction, action_id: str) -> None:
+    compositionStateRepository.remove_composition_resource(mongo_dao, action['exam_id'], action['student_username'],
+                                                           action['question_idx'], action_id)
+
+
+def __replay_actions(exam_id: str, username: str, nb_questions: int,
+                     student_actions: List[StudentAction]) -> CompositionState:
+    state = __new_composition_state(exam_id, username, nb_questions)
+    for action in student_actions:
+        __apply_action(state, action)
+    if student_actions:
+        # actions are sorted by timestamp
+        state['last_action_timestamp'] = student_actions[-1]['timestamp']
+    return state
+
+
+def __actions_signature(student_actions: List[StudentAction]) -> List[Tuple[str, bool]]:
+    # the actions that change a built state: saved actions, and removed resources
+    return [(str(action['_id']), action.get('removed') is not None) for action in student_actions]
+
+
+def __build_composition_state(mongo_dao: MongoDAO, exam_id: str, username: str,
+                              nb_questions: int) -> Optional[CompositionState]:
+    # replay the student's exam trace
+    student_actions = studentActionRepository.get_actions_for_student_for_exam(mongo_dao, username, exam_id)
+    if not student_actions:
+        return None
+    state = __replay_actions(exam_id, username, nb_questions, student_actions)
+    # store the built state, unless another request did it meanwhile
+    if not compositionStateRepository.create_composition_state(mongo_dao, state):
+        return compositionStateRepository.find_composition_state(mongo_dao, exam_id, username)
+    # actions saved while the state was built did not update it (not stored yet): rebuild it until no action is missed.
+    # A state replaced after the update of a new action is rebuilt again, as the action is saved before its update
+    for _ in range(MAX_STATE_REBUILDS):
+        latest_actions = studentActionRepository.get_actions_for_student_for_exam(mongo_dao, username, exam_id)
+        if __actions_signature(latest_actions) == __actions_signature(student_actions):
+            return state
+        student_actions = latest_actions
+        state = __replay_actions(exam_id, username, nb_questions, student_actions)
+        compositionStateRepository.replace_composition_state(mongo_dao, state)
+    # the stored state might still miss an action: built again on next read
+    LOG.warning('Composition state of student %s for exam %s rebuilt %d times, actions still being saved', username,
+                exam_id, MAX_STATE_REBUILDS)
+    compositionStateRepository.delete_composition_state(mongo_dao, exam_id, username)
+    return state
+
+
+def __hydrate_pending_chat_turns(mongo_dao: MongoDAO, state: CompositionState) -> None:
+    # answers being produced are only stored in their action (and the relay partial answers) until achieved
+    pending_turns = dict((turn['id'], turn) for question in state['questions'] for turn in question['chat_turns']
+                         if not turn['achieved'])
+    if not pending_turns:
+        return
+    result = mongo_dao.student_action_col.find(
+        filter={'_id': {'$in': [ObjectId(turn_id) for turn_id in pending_turns.keys()]}},
+        projection={'answer': 1, 'achieved': 1, 'truncated': 1})
+    for action in result:
+        turn = pending_turns[str(action['_id'])]
+        turn['answer'] = action.get('answer')
+        turn['achieved'] = action.get('achieved', False) is True
+        if action.get('truncated') is True:
+            turn['truncated'] = True
+    # the partial answer of the relay is more recent than the last checkpoint of an answer still streamed
+    partial_answer_store = ChatAIManager().partial_answer_store
+    if partial_answer_store is not None:
+        streamed_turn_ids = [turn_id for turn_id, turn in pending_turns.items() if not turn['achieved']]
+        for turn_id, partial_answer in partial_answer_store.get_many(streamed_turn_ids).items():
+            pending_turns[turn_id]['answer'] = partial_answer
+
+
+def find_composition_state(mongo_dao: MongoDAO, exam_id: str, username: str,
+                           nb_questions: int) -> Optional[CompositionState]:
+    """
+    Retrieve the composition state of a student. A missing state is built from the student actions, then stored.
+    :param mongo_dao: the dao
+    :param exam_id: the exam id
+    :param username: the student username
+    :param nb_questions: the number of questions of the exam
+    :return: the composition state, or None if the student has not done any action
+    """
+    state = compositionStateRepository.find_composition_state(mongo_dao, exam_id, username)
+    if state is None:
+        state = __build_composition_state(mongo_dao, exam_id, username, nb_questions)
+        if state is None:
+            return None
+    __hydrate_pending_chat_turns(mongo_dao, state)
+    return state
+
+
+def fill_composition_questions(composition_questions: Dict[int, Any], state: CompositionState) -> None:
+    """
+    Fill the questions of a composition model with the composition state
+    :param composition_questions: the questions of the composition model, by question idx
+    :param state: the composition state
+    """
+    for question_idx, question_state in enumerate(state['questions']):
+        question = composition_questions.get(question_idx)
+        if not question:
+            LOG.warning('Got question trace for unexisting exam question')
+            continue
+        question['init_answer'] = question_state['init_answer']
+        question['final_answer'] = question_state['final_answer']
+        for turn in question_state['chat_turns']:
+            chat = question['chat_actions'].get(turn['chat_id'])
+            if chat is None:
+                LOG.warning('Got question trace for unexisting exam question')
+                continue
+            chat.append(dict(id=turn['id'], prompt=turn['prompt'], answer=turn['answer'],
+                             timestamp=turn['timestamp']))
+        question['resources'].extend(dict(id=resource['id'], title=resource['title'],
+                                          description=resource['description'], rsc_type=resource['rsc_type'],
+                                          timestamp=resource['timestamp']) for resource in question_state['resources'])
@@ -2,15 +2,14 @@ import logging
 from datetime import datetime, timedelta
 from typing import Mapping, cast, Optional, Union, Any, Dict
 
-import pydantic
 from werkzeug.exceptions import BadRequest, Unauthorized, NotFound
 
 from mongoDAO import examRepository, studentActionRepository
 from mongoDAO.MongoDAO import MongoDAO
 from mongoModel.Exam import Exam
-from mongoModel.StudentAction import START_EXAM_TYPE, WROTE_INITIAL_ANSWER_TYPE, ASK_CHAT_AI_TYPE, \
-    EXTERNAL_RESOURCE_TYPE, WROTE_FINAL_ANSWER_TYPE, SUBMIT_EXAM_TYPE, CHANGED_QUESTION_TYPE
+from mongoModel.modelValidators import validate_model
 from services.ChatAIManager import ChatAIManager
+from services.compositionStateService import find_composition_state, fill_composition_questions
 from services.securityService import decrypt_exam_chat_api_keys, encrypt_exam_chat_api_keys
 from services.studentAuthUrlService import generate_auth_generation_url
 from sessions.sessionManagement import session_username, session_exam_id
@@ -88,7 +87,7 @@ def create_exam(exam_data: Dict) -> Exam:
     username = session_username()
     exam_data['owner_username'] = username
 
-    exam_to_create = cast(Exam, pydantic.create_model_from_typeddict(Exam)(**exam_data).dict())
+    exam_to_create = cast(Exam, validate_model(Exam, exam_data))
     # remove potential id
     exam_to_create.pop('id', None)
 
@@ -122,7 +121,7 @@ def update_exam(exam_id: str, exam_data: dict) -> Exam:
     exam_data['owner_username'] = username
     exam_data['created'] = datetime.utcnow()
     exam_data['exam_type'] = 'exam'
-    exam_to_update = cast(Exam, pydantic.create_model_from_typeddict(Exam)(**exam_data).dict())
+    exam_to_update = cast(Exam, validate_model(Exam, exam_data))
 
     if exam_to_update['id'] != exam_id:
         raise BadRequest("Exam id mismatch between data and url")
@@ -144,12 +143,15 @@ def update_exam(exam_id: str, exam_data: dict) -> Exam:
     if studentActionRepository.has_exam_been_started(mongo_dao, exam_id):
         raise BadRequest("Exam already started")
 
-    # update in local basic informations: name, description, questions, duration_minutes, selected_chats
+    # update in local basic informations: name, description, questions, duration_minutes, selected_chats,
+    # chat context token budget
     exam['name'] = exam_to_update['name']
     exam['description'] = exam_to_update['description']
     exam['questions'] = exam_to_update['questions']
     exam['duration_minutes'] = exam_to_update['duration_minutes']
     exam['selected_chats'] = exam_to_update['selected_chats']
+    if 'chat_context_token_budget' in exam_to_update:
+        exam['chat_context_token_budget'] = exam_to_update['chat_context_token_budget']
 
     # encrypt potential exam chat api keys
     exam = encrypt_exam_chat_api_keys(exam)
@@ -194,9 +196,8 @@ def find_composition_exam_by_id(exam_id: str) -> Optional[Union[Exam, Mapping]]:
     if exam is None:
         raise NotFound("Exam not found")
 
-    # retrieve the student's exam trace
-    students_exam_actions = studentActionRepository.get_actions_for_student_for_exam(mongo_dao, session_username(),
-                                                                                     exam_id)
+    # retrieve the student's composition state
+    state = find_composition_state(mongo_dao, exam_id, session_username(), len(exam['questions']))
 
     # Compute the full composition model
     chat_ai_mgr = ChatAIManager()
@@ -209,7 +210,7 @@ def find_composition_exam_by_id(exam_id: str) -> Optional[Union[Exam, Mapping]]:
         'duration_minutes': exam['duration_minutes'],
         'timeout': None,
         'chat_choices': chat_choices,
-        'started': len(students_exam_actions) > 0,
+        'started': state is not None and state['started'],
         'ended': False,
         'current_question_idx': None,
         'nb_questions': len(exam['questions']),
@@ -228,86 +229,26 @@ def find_composition_exam_by_id(exam_id: str) -> Optional[Union[Exam, Mapping]]:
         composition_exam.pop('questions', None)
         return composition_exam
 
-    # the first trace should be the start exam action, but we might have sorting error, so we handle code flexibility
-    first_trace_processed = False
-    if students_exam_actions[0]['action_type'] == START_EXAM_TYPE:
+    if state['started_timestamp'] is not None:
         # compute timeout : start timestamp + duration
-        timeout = students_exam_actions[0]['timestamp'] + timedelta(minutes=exam['duration_minutes'])
+        timeout = state['started_timestamp'] + timedelta(minutes=exam['duration_minutes'])
         composition_exam['timeout'] = timeout
         # if timeout < now : mark exam as ended and stop here
         if timeout <= now:
             composition_exam['ended'] = True
             return composition_exam
-        first_trace_processed = True
 
-    # the last trace might be an exam submit. In the case, no need to go further in trace processing
-    if students_exam_actions[-1]['action_type'] == SUBMIT_EXAM_TYPE:
-        # mark the exam as ended and return it
+    # if the exam has been submitted, mark the exam as ended and return it
+    if state['ended']:
         composition_exam['ended'] = True
         return composition_exam
 
-    # fulfill the model with actions
-    actions_to_process = students_exam_actions[1:] if first_trace_processed else students_exam_actions
-    for action in actions_to_process:
-        if action['action_type'] == START_EXAM_TYPE:
-            # compute timeout : start timestamp + duration
-            timeout = action['timestamp'] + timedelta(minutes=exam['duration_minutes'])
-            composition_exam['timeout'] = timeout
-            # if timeout < now : mark exam as ended and stop here
-            if timeout <= now:
-                composition_exam['ended'] = True
-                break
-
-        elif action['action_type'] == WROTE_INITIAL_ANSWER_TYPE:
-            question = composition_exam['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            question['init_answer'] = action['text']
-
-        elif action['action_type'] == ASK_CHAT_AI_TYPE:
-            question = composition_exam['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            chat = question['chat_actions'].get(action['chat_id'])
-            if chat is None:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            chat.append(dict(id=str(action['_id']), prompt=action['prompt'], answer=action['answer'],
-                             timestamp=action['timestamp']))
-
-        elif action['action_type'] == EXTERNAL_RESOURCE_TYPE:
-            if action['removed'] is not None:
-                continue
-            question = composition_exam['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            question['resources'].append(dict(id=str(action['_id']), title=action['title'],
-                                              description=action['description'],
-                                              rsc_type=action['rsc_type'], timestamp=action['timestamp']))
-
-        elif action['action_type'] == WROTE_FINAL_ANSWER_TYPE:
-            question = composition_exam['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            question['final_answer'] = action['text']
-
-        elif action['action_type'] == SUBMIT_EXAM_TYPE:
-            # mark the exam as ended and return it
-            composition_exam['ended'] = True
-
-        elif action['action_type'] == CHANGED_QUESTION_TYPE:
-            # mark the exam current question
-            composition_exam['current_question_idx'] = action['next_question_idx']
-
-        # Other action (eg.: LOST_FOCUS_TYPE) do not matter here
+    # fulfill the model with the composition state
+    fill_composition_questions(composition_exam['questions'], state)
+    composition_exam['current_question_idx'] = state['current_question_idx']
 
     # If the exam was started, not end and no current question, set the current question indicator on first question
-    if composition_exam['started'] and not composition_exam['ended'] \
-            and composition_exam['current_question_idx'] is None:
+    if composition_exam['current_question_idx'] is None:
         composition_exam['current_question_idx'] = 0
 
     return composition_exam
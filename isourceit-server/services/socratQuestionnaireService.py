@@ -2,25 +2,34 @@ import logging
 from datetime import datetime
 from typing import Mapping, cast, Optional, Union, Any, Dict
 
-import pydantic
+from flask import current_app
 from werkzeug.exceptions import BadRequest, Unauthorized, NotFound
 
 from mongoDAO import studentActionRepository, socratRepository
 from mongoDAO.MongoDAO import MongoDAO
 from mongoModel.SocratQuestionnaire import SocratQuestionnaire
-from mongoModel.StudentAction import START_EXAM_TYPE, WROTE_INITIAL_ANSWER_TYPE, ASK_CHAT_AI_TYPE, \
-    EXTERNAL_RESOURCE_TYPE, WROTE_FINAL_ANSWER_TYPE, SUBMIT_EXAM_TYPE, CHANGED_QUESTION_TYPE
+from mongoModel.modelValidators import validate_model
 from services.ChatAIManager import ChatAIManager
-from services.securityService import encrypt_socrat_chat_api_keys, decrypt_socrat_chat_api_keys
+from services.compositionStateService import find_composition_state, fill_composition_questions
+from services.securityService import encrypt_socrat_chat_api_keys, decrypt_socrat_chat_api_keys, \
+    decrypt_chat_api_key
 from services.studentAuthUrlService import generate_auth_generation_url
 from sessions.sessionManagement import session_username, session_exam_id
 
 __all__ = ['find_admin_socrats_summary', 'find_admin_socrat_by_id', 'create_socrat', 'update_socrat',
-           'find_composition_socrat_by_id']
+           'find_composition_socrat_by_id', 'forge_init_socrat_prompt', 'warm_socrat_opening_turns']
 
 LOG = logging.getLogger(__name__)
 
 
+def forge_init_socrat_prompt(socrat_question: dict):
+    return "The question is: %s%s\n\nFinal Answer is: %s%s" % (
+        socrat_question['question'],
+        '' if socrat_question['question'].endswith('.') or socrat_question['question'].endswith('?') else '.',
+        socrat_question['answer'],
+        '' if socrat_question['answer'].endswith('.') or socrat_question['answer'].endswith('?') else '.')
+
+
 def find_admin_socrats_summary() -> Any:
     username = session_username()
     mongo_dao = MongoDAO()
@@ -86,8 +95,7 @@ def create_socrat(socrat_data: Dict) -> SocratQuestionnaire:
     username = session_username()
     socrat_data['owner_username'] = username
 
-    socrat_to_create = cast(SocratQuestionnaire,
-                            pydantic.create_model_from_typeddict(SocratQuestionnaire)(**socrat_data).dict())
+    socrat_to_create = cast(SocratQuestionnaire, validate_model(SocratQuestionnaire, socrat_data))
     # remove potential id
     socrat_to_create.pop('id', None)
 
@@ -134,8 +142,7 @@ def update_socrat(socrat_id: str, socrat_data: dict) -> SocratQuestionnaire:
     socrat_data['owner_username'] = username
     socrat_data['created'] = datetime.utcnow()
     socrat_data['exam_type'] = 'socrat'
-    socrat_to_update = cast(SocratQuestionnaire,
-                            pydantic.create_model_from_typeddict(SocratQuestionnaire)(**socrat_data).dict())
+    socrat_to_update = cast(SocratQuestionnaire, validate_model(SocratQuestionnaire, socrat_data))
 
     if socrat_to_update['id'] != socrat_id:
         raise BadRequest("Exam id mismatch between data and url")
@@ -167,11 +174,14 @@ def update_socrat(socrat_id: str, socrat_data: dict) -> SocratQuestionnaire:
     if studentActionRepository.has_exam_been_started(mongo_dao, socrat_id):
         raise BadRequest("Exam already started")
 
-    # update in local basic informations: name, description, questions, duration_minutes, selected_chats
+    # update in local basic informations: name, description, questions, duration_minutes, selected_chats,
+    # chat context token budget
     socrat['name'] = socrat_to_update['name']
     socrat['description'] = socrat_to_update['description']
     socrat['questions'] = socrat_to_update['questions']
     socrat['selected_chat'] = socrat_to_update['selected_chat']
+    if 'chat_context_token_budget' in socrat_to_update:
+        socrat['chat_context_token_budget'] = socrat_to_update['chat_context_token_budget']
 
     # encrypt potential exam chat api keys
     socrat = encrypt_socrat_chat_api_keys(socrat)
@@ -200,6 +210,33 @@ def update_socrat(socrat_id: str, socrat_data: dict) -> SocratQuestionnaire:
     return socrat
 
 
+def warm_socrat_opening_turns(socrat_id: str) -> Dict:
+    username = session_username()
+    mongo_dao = MongoDAO()
+    socrat = socratRepository.find_socrat_by_id(mongo_dao, socrat_id)
+    if socrat is None:
+        raise NotFound('Exam not found')
+    if not any(a.get('username') == username for a in socrat.get('authors', [])):
+        raise Unauthorized("Only authors might warm their exam")
+
+    chat_ai_mgr = ChatAIManager()
+    chat_info = next((c for c in chat_ai_mgr.available_chats if c['id'] == socrat['selected_chat'].get('id')), None)
+    if chat_info is None:
+        raise BadRequest('No available chat selected')
+    private_key = decrypt_chat_api_key(socrat['selected_chat'].get('api_key', None))
+    custom_temperature = current_app.config.get('DEFAULT_SOCRAT_CHAT_TEMPERATURE', 0.2)
+    # request the opening turn of each question, as sent for the first prompt of a student
+    nb_warmed = 0
+    for question in socrat['questions']:
+        custom_init_prompt = question.get('init_prompt', current_app.config.get('DEFAULT_SOCRAT_INIT_PROMPT'))
+        if chat_ai_mgr.warm_opening_turn(chat_info['chat_key'], chat_info['model_key'],
+                                         forge_init_socrat_prompt(question), private_key=private_key,
+                                         custom_init_prompt=custom_init_prompt,
+                                         custom_temperature=custom_temperature, username=username):
+            nb_warmed += 1
+    return {'nb_questions': len(socrat['questions']), 'nb_warmed': nb_warmed}
+
+
 def find_composition_socrat_by_id(socrat_id: str) -> Optional[Union[SocratQuestionnaire, Mapping]]:
     if socrat_id != session_exam_id():
         raise Unauthorized('Unallowed to access this composition Socrat questionnaire')
@@ -215,20 +252,18 @@ def find_composition_socrat_by_id(socrat_id: str) -> Optional[Union[SocratQuesti
     if socrat is None:
         raise NotFound("Socrat questionnaire not found")
 
-    # retrieve the student's exam trace
-    students_socrat_actions = studentActionRepository.get_actions_for_student_for_exam(mongo_dao, session_username(),
-                                                                                       socrat_id)
+    # retrieve the student's composition state
+    state = find_composition_state(mongo_dao, socrat_id, session_username(), len(socrat['questions']))
 
     # Compute the full composition model
     chat_ai_mgr = ChatAIManager()
     chat_choices = chat_ai_mgr.compute_student_choice_from_socrat(socrat)
-    now = datetime.utcnow()
     composition_socrat = {
         'id': str(socrat['_id']),
         'name': socrat['name'],
         'description': socrat['description'],
         'chat_choices': chat_choices,
-        'started': len(students_socrat_actions) > 0,
+        'started': state is not None and state['started'],
         'ended': False,
         'current_question_idx': None,
         'nb_questions': len(socrat['questions']),
@@ -247,75 +282,17 @@ def find_composition_socrat_by_id(socrat_id: str) -> Optional[Union[SocratQuesti
         composition_socrat.pop('questions', None)
         return composition_socrat
 
-    # the first trace should be the start exam action, but we might have sorting error, so we handle code flexibility
-    first_trace_processed = False
-    if students_socrat_actions[0]['action_type'] == START_EXAM_TYPE:
-        # do nothing else than marking the action
-        first_trace_processed = True
-
-    # the last trace might be an exam submit. In the case, no need to go further in trace processing
-    if students_socrat_actions[-1]['action_type'] == SUBMIT_EXAM_TYPE:
-        # mark the exam as ended and return it
+    # if the questionnaire has been submitted, mark it as ended and return it
+    if state['ended']:
         composition_socrat['ended'] = True
         return composition_socrat
 
-    # fulfill the model with actions
-    actions_to_process = students_socrat_actions[1:] if first_trace_processed else students_socrat_actions
-    for action in actions_to_process:
-        if action['action_type'] == START_EXAM_TYPE:
-            # do nothing
-            pass
-
-        elif action['action_type'] == WROTE_INITIAL_ANSWER_TYPE:
-            question = composition_socrat['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            question['init_answer'] = action['text']
-
-        elif action['action_type'] == ASK_CHAT_AI_TYPE:
-            question = composition_socrat['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            chat = question['chat_actions'].get(action['chat_id'])
-            if chat is None:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            chat.append(dict(id=str(action['_id']), prompt=action.get('prompt'), answer=action['answer'],
-                             timestamp=action['timestamp']))
-
-        elif action['action_type'] == EXTERNAL_RESOURCE_TYPE:
-            if action['removed'] is not None:
-                continue
-            question = composition_socrat['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            question['resources'].append(dict(id=str(action['_id']), title=action['title'],
-                                              description=action['description'],
-                                              rsc_type=action['rsc_type'], timestamp=action['timestamp']))
-
-        elif action['action_type'] == WROTE_FINAL_ANSWER_TYPE:
-            question = composition_socrat['questions'].get(action['question_idx'])
-            if not question:
-                LOG.warning('Got question trace for unexisting exam question')
-                continue
-            question['final_answer'] = action['text']
-
-        elif action['action_type'] == SUBMIT_EXAM_TYPE:
-            # mark the exam as ended and return it
-            composition_socrat['ended'] = True
-
-        elif action['action_type'] == CHANGED_QUESTION_TYPE:
-            # mark the exam current question
-            composition_socrat['current_question_idx'] = action['next_question_idx']
-
-        # Other action (eg.: LOST_FOCUS_TYPE) do not matter here
+    # fulfill the model with the composition state
+    fill_composition_questions(composition_socrat['questions'], state)
+    composition_socrat['current_question_idx'] = state['current_question_idx']
 
     # If the exam was started, not end and no current question, set the current question indicator on first question
-    if composition_socrat['started'] and not composition_socrat['ended'] \
-            and composition_socrat['current_question_idx'] is None:
+    if composition_socrat['current_question_idx'] is None:
         composition_socrat['current_question_idx'] = 0
 
     return composition_socrat
@@ -1,33 +1,34 @@
 import logging
 from datetime import datetime, timedelta
-from typing import Mapping, cast, Dict, Iterable, Any
+from typing import Mapping, cast, Dict, Iterable, Any, List, Optional, Tuple, Callable
 
-import pydantic
 from flask import current_app
-from werkzeug.exceptions import Unauthorized, BadRequest
+from pydantic import ValidationError
+from werkzeug.exceptions import Unauthorized, BadRequest, HTTPException
 
 from mongoDAO import studentActionRepository, examRepository, socratRepository
 from mongoDAO.MongoDAO import MongoDAO
 from mongoModel.Exam import Exam
 from mongoModel.SocratQuestionnaire import SocratQuestionnaire
-from mongoModel.StudentAction import STUDENT_ACTION_TYPE_MAPPING, EXTERNAL_RESOURCE_TYPE, \
+from mongoModel.StudentAction import STUDENT_ACTION_TYPE_MAPPING, EXTERNAL_RESOURCE_TYPE, ASK_CHAT_AI_TYPE, \
     AskChatAI, StartExam, SubmitExam, ExternalResource, \
-    WroteInitialAnswer, WroteFinalAnswer, StudentAction, ChangedQuestion, LostFocus
+    WroteInitialAnswer, WroteFinalAnswer, StudentAction, ChangedQuestion, LostFocus, START_EXAM_TYPE, SUBMIT_EXAM_TYPE
+from mongoModel.modelValidators import validate_model
 from services import ChatAIManager
 from services.ChatAIManager import ChatAIManager
+from services.compositionStateService import record_composition_action, remove_composition_resource
 from services.securityService import decrypt_chat_api_key
+from services.socratQuestionnaireService import forge_init_socrat_prompt
 from sessions.sessionManagement import session_username, update_session_student_info, \
-    is_exam_ended, is_exam_started, session_exam_id, get_ws_sid, session_exam_type
+    is_exam_ended, is_exam_started, session_exam_id, get_ws_sid, session_exam_type, session_is_stateless, \
+    session_timeout
 
 LOG = logging.getLogger(__name__)
 
 
-def __forge_init_socrat_prompt(socrat_question: dict):
-    return "The question is: %s%s\n\nFinal Answer is: %s%s" % (
-        socrat_question['question'],
-        '' if socrat_question['question'].endswith('.') or socrat_question['question'].endswith('?') else '.',
-        socrat_question['answer'],
-        '' if socrat_question['answer'].endswith('.') or socrat_question['answer'].endswith('?') else '.')
+def __get_chat_context_token_budget(exam: Mapping) -> int:
+    # budget of the exam if set, the default one otherwise
+    return exam.get('chat_context_token_budget', current_app.config.get('CHATAI_CONTEXT_TOKEN_BUDGET', 3000))
 
 
 def __prepare_action(action_data: Dict, action_class: Any) -> Any:
@@ -37,50 +38,73 @@ def __prepare_action(action_data: Dict, action_class: Any) -> Any:
     action_data['exam_id'] = session_exam_id()
     action_data['student_username'] = session_username()
 
-    action = cast(action_class, pydantic.create_model_from_typeddict(action_class)(**action_data).dict())
+    action = cast(action_class, validate_model(action_class, action_data))
     # remove action id and _id
     action.pop('id', None)
     action.pop('_id', None)
     return action
 
 
-def __handle_exam_action(action_data: Dict, action_class: Any, exam: Exam, mongo_dao: MongoDAO) -> Mapping:
-    # Clean action_data and creation action instance
-    action = __prepare_action(action_data, action_class)
+class _CompositionState:
+    """
+    Composition lifecycle of the student, updated by the checked actions before they are persisted, so that the
+    actions of a batch are checked as if they were handled one by one
+    """
+    __slots__ = ['started', 'ended', 'timeout', 'asked_chats']
+
+    def __init__(self, started: bool, timeout: Optional[datetime]):
+        self.started = started
+        self.ended = False
+        self.timeout = timeout
+        # (question_idx, chat_id) of the chats asked by checked actions
+        self.asked_chats = set()
+
+
+def __load_composition_state(mongo_dao: MongoDAO, duration_minutes: Optional[int]) -> _CompositionState:
+    """
+    Load the composition lifecycle of the student, and check the composition is not ended
+    :param mongo_dao: the dao
+    :param duration_minutes: the duration of the exam, if timed
+    """
+    if not session_is_stateless():
+        return _CompositionState(bool(is_exam_started()), session_timeout())
+    # a stateless session may be replayed from an older cookie: rely on the stored start/submit actions
+    lifecycle_actions = studentActionRepository.find_exam_action_for_student_for_exam(
+        mongo_dao, session_username(), session_exam_id())
+    if any(action['action_type'] == SUBMIT_EXAM_TYPE for action in lifecycle_actions):
+        raise Unauthorized('Exam must not be ended')
+    start_action = next((action for action in lifecycle_actions if action['action_type'] == START_EXAM_TYPE), None)
+    timeout = None
+    if start_action is not None and duration_minutes is not None:
+        timeout = start_action['timestamp'] + timedelta(minutes=duration_minutes)
+        if timeout < datetime.utcnow():
+            raise Unauthorized('Exam must not be ended')
+    return _CompositionState(start_action is not None, timeout)
 
-    # if action type is START_EXAM_TYPE: assert exam is not started, then update session
+
+def __check_lifecycle_action(action_class: Any, state: _CompositionState) -> None:
+    if state.ended:
+        raise Unauthorized('Exam must not be ended')
+    # if action type is START_EXAM_TYPE: assert exam is not started
     if action_class == StartExam:
-        if is_exam_started():
+        if state.started:
             raise BadRequest('Cannot handle Start exam action; exam already started')
-        # create action
-        action_id = studentActionRepository.create_student_action(mongo_dao, action)
-        # update session with exam started marker and timeout
-        timeout = action_data['timestamp'] + timedelta(minutes=exam['duration_minutes'])
-        update_session_student_info(exam_started=True, timeout=timeout)
-        return {
-            'timestamp': action['timestamp'],
-            'id': action_id,
-            'exam_started': True,
-            'timeout': timeout
-        }
-
-    # if action type is SUBMIT_EXAM_TYPE: assert exam is started, then update session
-    if action_class == SubmitExam:
-        if not is_exam_started():
+        state.started = True
+    # if action type is SUBMIT_EXAM_TYPE: assert exam is started
+    elif action_class == SubmitExam:
+        if not state.started:
             raise BadRequest('Cannot handle Submit exam action; exam not started')
-        # create action
-        action_id = studentActionRepository.create_student_action(mongo_dao, action)
-        update_session_student_info(exam_ended=True)
-        return {
-            'timestamp': action['timestamp'],
-            'id': action_id,
-            'exam_ended': True
-        }
-
+        state.ended = True
     # otherwise action is relative to a question. Exam should be started
-    if not is_exam_started():
+    elif not state.started:
         raise BadRequest('Cannot handle Submit exam action; exam not started')
 
+
+def __check_exam_action(action: Any, action_class: Any, exam: Exam, state: _CompositionState) -> None:
+    __check_lifecycle_action(action_class, state)
+    if action_class in (StartExam, SubmitExam):
+        return
+
     # Check action question idx is given and relative to an existing question
     if action.get('question_idx') is None or action['question_idx'] < 0 or action['question_idx'] > len(
             exam['questions']):
@@ -92,12 +116,43 @@ def __handle_exam_action(action_data: Dict, action_class: Any, exam: Exam, mongo
             raise BadRequest("Bad chat key")
         if not action['prompt']:
             raise BadRequest("Missing prompt")
+        if exam['selected_chats'].get(action['chat_id']) is None:
+            LOG.warning('no exam chat sttings for chat_id {}'.format(action['chat_id']))
+            raise BadRequest('Bad chat_id')
 
-    # save action into db
-    action_id = studentActionRepository.create_student_action(mongo_dao, action)
+
+def __complete_exam_action(action: Any, action_id: str, action_class: Any, exam: Exam, state: _CompositionState,
+                           mongo_dao: MongoDAO) -> Mapping:
+    # keep the composition state of the student up to date
+    record_composition_action(mongo_dao, action, action_id, len(exam['questions']))
+
+    # update session with exam started marker and timeout
+    if action_class == StartExam:
+        timeout = action['timestamp'] + timedelta(minutes=exam['duration_minutes'])
+        update_session_student_info(exam_started=True, timeout=timeout)
+        return {
+            'timestamp': action['timestamp'],
+            'id': action_id,
+            'exam_started': True,
+            'timeout': timeout
+        }
+
+    # update session with exam ended marker
+    if action_class == SubmitExam:
+        update_session_student_info(exam_ended=True)
+        # answers still streamed are not needed anymore
+        ChatAIManager().cancel_student_prompts(action['exam_id'], action['student_username'])
+        return {
+            'timestamp': action['timestamp'],
+            'id': action_id,
+            'exam_ended': True
+        }
 
     # process response and specific handling of action
     if action_class == ChangedQuestion:
+        # prompts of the left question still waiting for a chat are abandoned
+        if action['next_question_idx'] != action['question_idx']:
+            ChatAIManager().abandon_prompts(action['exam_id'], action['student_username'], action['question_idx'])
         return {
             'timestamp': action['timestamp'],
             'question_idx': action['question_idx'],
@@ -115,9 +170,6 @@ def __handle_exam_action(action_data: Dict, action_class: Any, exam: Exam, mongo
         }
     elif action_class == AskChatAI:
         exam_chat_settings = exam['selected_chats'].get(action['chat_id'])
-        if exam_chat_settings is None:
-            LOG.warning('no exam chat sttings for chat_id {}'.format(action['chat_id']))
-            raise BadRequest('Bad chat_id')
         private_key = decrypt_chat_api_key(exam_chat_settings.get('api_key', None))
         chat_ai_mgr = ChatAIManager()
         ws_sid = get_ws_sid()
@@ -130,7 +182,10 @@ def __handle_exam_action(action_data: Dict, action_class: Any, exam: Exam, mongo
             'prompt': action['prompt'],
         }
         if ws_sid is not None:
-            chat_ai_mgr.process_prompt(action_id, action, ws_sid, private_key=private_key)
+            # the answer is cancelled once the exam has timed out (set in session if started by the same batch)
+            deadline = state.timeout if state.timeout is not None else session_timeout()
+            chat_ai_mgr.process_prompt(action_id, action, ws_sid, private_key=private_key, deadline=deadline,
+                                       context_token_budget=__get_chat_context_token_budget(exam))
         else:
             LOG.warning('No ws id, will not be able to return reponse!')
             result['achieved'] = True
@@ -162,18 +217,39 @@ def __handle_exam_action(action_data: Dict, action_class: Any, exam: Exam, mongo
         }
 
 
-def __handle_socrat_action(action_data: Dict, action_class: Any, socrat: SocratQuestionnaire,
-                           mongo_dao: MongoDAO) -> Mapping:
-    # Clean action_data and creation action instance
-    action = __prepare_action(action_data, action_class)
+def __check_socrat_action(action: Any, action_class: Any, socrat: SocratQuestionnaire, state: _CompositionState,
+                          mongo_dao: MongoDAO) -> None:
+    __check_lifecycle_action(action_class, state)
+    if action_class in (StartExam, SubmitExam):
+        return
+
+    # Check action question idx is given and relative to an existing question
+    if action.get('question_idx') is None or action['question_idx'] < 0 or action['question_idx'] > len(
+            socrat['questions']):
+        raise BadRequest('Bad question idx')
+
+    # if action is asking to a chat: check the chat key is allowed, then check if its the first time or not
+    if action_class == AskChatAI:
+        if action['chat_id'] != socrat['selected_chat'].get('id'):
+            raise BadRequest("Bad chat key")
+        asked_chat = (action['question_idx'], action['chat_id'])
+        if asked_chat not in state.asked_chats and not studentActionRepository.has_chat_ai_model_interaction(
+                mongo_dao, session_username(), session_exam_id(), action['question_idx'], action['chat_id']):
+            # remove any prompt and set hidden prompt with the question init prompt
+            action['prompt'] = None
+            action['hidden_prompt'] = forge_init_socrat_prompt(socrat['questions'][action['question_idx']])
+        elif not action['prompt']:
+            raise BadRequest("Missing prompt")
+        state.asked_chats.add(asked_chat)
+
 
-    # if action type is START_EXAM_TYPE: assert exam is not started, then update session
+def __complete_socrat_action(action: Any, action_id: str, action_class: Any, socrat: SocratQuestionnaire,
+                             mongo_dao: MongoDAO) -> Mapping:
+    # keep the composition state of the student up to date
+    record_composition_action(mongo_dao, action, action_id, len(socrat['questions']))
+
+    # update session with exam started marker
     if action_class == StartExam:
-        if is_exam_started():
-            raise BadRequest('Cannot handle Start exam action; exam already started')
-        # create action
-        action_id = studentActionRepository.create_student_action(mongo_dao, action)
-        # update session with exam started marker and timeout
         update_session_student_info(exam_started=True)
         return {
             'timestamp': action['timestamp'],
@@ -181,45 +257,22 @@ def __handle_socrat_action(action_data: Dict, action_class: Any, socrat: SocratQ
             'exam_started': True
         }
 
-    # if action type is SUBMIT_EXAM_TYPE: assert exam is started, then update session
+    # update session with exam ended marker
     if action_class == SubmitExam:
-        if not is_exam_started():
-            raise BadRequest('Cannot handle Submit exam action; exam not started')
-        # create action
-        action_id = studentActionRepository.create_student_action(mongo_dao, action)
         update_session_student_info(exam_ended=True)
+        # answers still streamed are not needed anymore
+        ChatAIManager().cancel_student_prompts(action['exam_id'], action['student_username'])
         return {
             'timestamp': action['timestamp'],
             'id': action_id,
             'exam_ended': True
         }
 
-    # otherwise action is relative to a question. Exam should be started
-    if not is_exam_started():
-        raise BadRequest('Cannot handle Submit exam action; exam not started')
-
-    # Check action question idx is given and relative to an existing question
-    if action.get('question_idx') is None or action['question_idx'] < 0 or action['question_idx'] > len(
-            socrat['questions']):
-        raise BadRequest('Bad question idx')
-
-    # if action is asking to a chat: check the chat key is allowed, then check if its the first time or not
-    if action_class == AskChatAI:
-        if action['chat_id'] != socrat['selected_chat'].get('id'):
-            raise BadRequest("Bad chat key")
-        if not studentActionRepository.has_chat_ai_model_interaction(mongo_dao, session_username(), session_exam_id(),
-                                                                     action['question_idx'], action['chat_id']):
-            # remove any prompt and set hidden prompt with the question init prompt
-            action['prompt'] = None
-            action['hidden_prompt'] = __forge_init_socrat_prompt(socrat['questions'][action['question_idx']])
-        elif not action['prompt']:
-            raise BadRequest("Missing prompt")
-
-    # save action into db
-    action_id = studentActionRepository.create_student_action(mongo_dao, action)
-
     # process response and specific handling of action
     if action_class == ChangedQuestion:
+        # prompts of the left question still waiting for a chat are abandoned
+        if action['next_question_idx'] != action['question_idx']:
+            ChatAIManager().abandon_prompts(action['exam_id'], action['student_username'], action['question_idx'])
         return {
             'timestamp': action['timestamp'],
             'question_idx': action['question_idx'],
@@ -236,8 +289,6 @@ def __handle_socrat_action(action_data: Dict, action_class: Any, socrat: SocratQ
             'page_hidden': action['page_hidden'],
         }
     elif action_class == AskChatAI:
-        if action['chat_id'] != socrat['selected_chat'].get('id'):
-            raise BadRequest("Bad chat key")
         private_key = decrypt_chat_api_key(socrat['selected_chat'].get('api_key', None))
         chat_ai_mgr = ChatAIManager()
         ws_sid = get_ws_sid()
@@ -254,7 +305,8 @@ def __handle_socrat_action(action_data: Dict, action_class: Any, socrat: SocratQ
         custom_temperature = current_app.config.get('DEFAULT_SOCRAT_CHAT_TEMPERATURE', 0.2)
         if ws_sid is not None:
             chat_ai_mgr.process_prompt(action_id, action, ws_sid, private_key=private_key,
-                                       custom_init_prompt=custom_init_prompt, custom_temperature=custom_temperature)
+                                       custom_init_prompt=custom_init_prompt, custom_temperature=custom_temperature,
+                                       context_token_budget=__get_chat_context_token_budget(socrat))
         else:
             LOG.warning('No ws id, will not be able to return reponse!')
             result['achieved'] = True
@@ -286,48 +338,125 @@ def __handle_socrat_action(action_data: Dict, action_class: Any, socrat: SocratQ
         }
 
 
-def handle_action(action_data: Dict) -> Mapping:
-    # In any case check exam is not finished
-    if is_exam_ended():
-        raise Unauthorized('Exam must not be ended')
-
+def __get_action_class(action_data: Dict) -> Any:
     # check that action_data has at least a proper type
-    if 'action_type' not in action_data:
+    if not isinstance(action_data, dict) or 'action_type' not in action_data:
         raise BadRequest("Missing action type")
     # cast action according to action type
     action_class = STUDENT_ACTION_TYPE_MAPPING.get(action_data['action_type'], None)
     if action_class is None:
         raise BadRequest("Bad action type")
+    return action_class
+
 
+def __find_composition_handlers(mongo_dao: MongoDAO) -> Tuple[Callable, Callable, Callable]:
+    """
+    Retrieve the exam or socrat questionnaire of the session, and provide its composition state loader and its check
+    and completion action handlers
+    :param mongo_dao: the dao
+    :return: the composition state loader, the check handler (action, action_class, state) and the completion handler
+    (action, action_id, action_class, state) of actions
+    """
     # According to the exam type, retrieve the proper exam object and call the proper treatment
-    mongo_dao = MongoDAO()
     if session_exam_type() == 'exam':
         # retrieve exam Info: duration_minutes, questions
         exam = examRepository.find_exam_by_id(mongo_dao, session_exam_id(),
                                               projection={'duration_minutes': 1,
                                                           'questions': 1,
-                                                          'selected_chats': 1})
+                                                          'selected_chats': 1,
+                                                          'chat_context_token_budget': 1})
         if exam is None:
             raise BadRequest("No exam matching session exam id")
-        return __handle_exam_action(action_data, action_class, exam, mongo_dao)
+        return (lambda: __load_composition_state(mongo_dao, exam['duration_minutes']),
+                lambda action, action_class, state: __check_exam_action(action, action_class, exam, state),
+                lambda action, action_id, action_class, state: __complete_exam_action(action, action_id,
+                                                                                      action_class, exam, state,
+                                                                                      mongo_dao))
     elif session_exam_type() == 'socrat':
         # retrieve exam Info: questions
         socrat = socratRepository.find_socrat_by_id(mongo_dao, session_exam_id(),
-                                                    projection={'questions': 1, 'selected_chat': 1})
+                                                    projection={'questions': 1, 'selected_chat': 1,
+                                                                'chat_context_token_budget': 1})
         if socrat is None:
             raise BadRequest("No Socrat questionnary matching session socrat id")
-        return __handle_socrat_action(action_data, action_class, socrat, mongo_dao)
+        return (lambda: __load_composition_state(mongo_dao, None),
+                lambda action, action_class, state: __check_socrat_action(action, action_class, socrat, state,
+                                                                          mongo_dao),
+                lambda action, action_id, action_class, state: __complete_socrat_action(action, action_id,
+                                                                                        action_class, socrat,
+                                                                                        mongo_dao))
     else:
         raise Unauthorized('Unproper session exam type (' + session_exam_type() + ')')
 
 
+def handle_action(action_data: Dict) -> Mapping:
+    # In any case check exam is not finished
+    if is_exam_ended():
+        raise Unauthorized('Exam must not be ended')
+
+    action_class = __get_action_class(action_data)
+    mongo_dao = MongoDAO()
+    load_state, check_action, complete_action = __find_composition_handlers(mongo_dao)
+    state = load_state()
+    # Clean action_data and creation action instance, check it, then save it into db
+    action = __prepare_action(action_data, action_class)
+    check_action(action, action_class, state)
+    action_id = studentActionRepository.create_student_action(mongo_dao, action)
+    return complete_action(action, action_id, action_class, state)
+
+
+def handle_actions_batch(actions_data: List[Dict]) -> List[Mapping]:
+    """
+    Handle an ordered list of actions, checked with the rules of handle_action as if they were sent one by one,
+    then saved at once. A rejected action does not prevent the others to be handled.
+    :param actions_data: the actions
+    :return: for each action, in the same order, either its result or its error
+    """
+    # In any case check exam is not finished
+    if is_exam_ended():
+        raise Unauthorized('Exam must not be ended')
+    if not isinstance(actions_data, list):
+        raise BadRequest("A list of actions is required")
+    max_batch_size = current_app.config.get('COMPOSITION_ACTION_BATCH_MAX_SIZE', 100)
+    if len(actions_data) > max_batch_size:
+        raise BadRequest("Too many actions (max {})".format(max_batch_size))
+
+    mongo_dao = MongoDAO()
+    load_state, check_action, complete_action = __find_composition_handlers(mongo_dao)
+    state = load_state()
+    # check every action: keep the valid ones, in order, and the error of the others
+    results: List[Optional[Mapping]] = [None] * len(actions_data)
+    checked_actions = []
+    for idx, action_data in enumerate(actions_data):
+        try:
+            action_class = __get_action_class(action_data)
+            action = __prepare_action(action_data, action_class)
+            check_action(action, action_class, state)
+            checked_actions.append((idx, action, action_class))
+        except ValidationError as e:
+            results[idx] = {'error': 'bad request', 'details': str(e), 'code': 400}
+        except HTTPException as e:
+            results[idx] = {'error': e.description, 'details': str(e), 'code': e.code}
+
+    # save the valid actions at once, then process them in order
+    action_ids = studentActionRepository.create_student_actions(
+        mongo_dao, [action for _, action, _ in checked_actions])
+    for (idx, action, action_class), action_id in zip(checked_actions, action_ids):
+        results[idx] = complete_action(action, action_id, action_class, state)
+    return results
+
+
 def mark_external_resource_removed(action_id) -> None:
     # check exam is started but not finished
     if not is_exam_started() or is_exam_ended():
         raise Unauthorized('Exam must be started and not ended')
 
-    # Get action
     mongo_dao = MongoDAO()
+    if session_is_stateless():
+        # check the stored lifecycle, the session may be replayed from an older cookie
+        load_state, _, _ = __find_composition_handlers(mongo_dao)
+        load_state()
+    # Get action
     action = studentActionRepository.find_action_by_id(mongo_dao, action_id)
     # check action properties with session info: exam_id, question_idx, student_username,
     # check action_type is EXTERNAL_RESOURCE_TYPE
@@ -340,6 +469,29 @@ def mark_external_resource_removed(action_id) -> None:
         raise BadRequest("Action already removed")
     # mak action as removed
     studentActionRepository.mark_external_resource_removed(mongo_dao, action_id, datetime.now())
+    remove_composition_resource(mongo_dao, action, action_id)
+
+
+def cancel_chat_prompt(action_id) -> Mapping:
+    # check exam is started but not finished
+    if not is_exam_started() or is_exam_ended():
+        raise Unauthorized('Exam must be started and not ended')
+
+    # Get action
+    mongo_dao = MongoDAO()
+    action = studentActionRepository.find_action_by_id(mongo_dao, action_id)
+    # check action properties with session info: exam_id, student_username, check action_type is ASK_CHAT_AI_TYPE
+    if action is None:
+        raise BadRequest("Unknown action")
+    if action['exam_id'] != session_exam_id() \
+            or action['student_username'] != session_username() \
+            or action['action_type'] != ASK_CHAT_AI_TYPE:
+        raise Unauthorized("Unauthorized action cancellation")
+    # the prompt is ended by its handler, with the answer received so far
+    return {
+        'id': action_id,
+        'cancelled': ChatAIManager().cancel_prompt(action_id)
+    }
 
 
 def get_exam_student_actions(exam_id: str, student_username: str) -> Iterable[StudentAction]:
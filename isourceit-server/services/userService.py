@@ -1,15 +1,15 @@
 from typing import Mapping, Optional, cast
-import pydantic
 import werkzeug
 from mongoDAO import userRepository
 from mongoDAO.MongoDAO import MongoDAO
 from mongoModel.User import User
+from mongoModel.modelValidators import validate_model
 from services.securityService import hash_password
 
 
 def create_user(user_data: Mapping) -> User:
     mongo_dao = MongoDAO()
-    user_to_create = cast(User, pydantic.create_model_from_typeddict(User)(**user_data).dict())
+    user_to_create = cast(User, validate_model(User, user_data))
     user_to_create['password'] = hash_password(user_to_create['password'])
     user_id = userRepository.create_user(mongo_dao, user_to_create)
     return userRepository.find_user_by_user_id(mongo_dao, user_id)
@@ -22,7 +22,7 @@ def find_user_by_username(username: str) -> Optional[User]:
 
 def update_user(user_id: str, user_data: Mapping) -> User:
     mongo_dao = MongoDAO()
-    user_to_update = cast(User, pydantic.create_model_from_typeddict(User)(**user_data).dict())
+    user_to_update = cast(User, validate_model(User, user_data))
     if user_to_update['id'] != user_id:
         raise werkzeug.exceptions.BadRequest("Exam id mismatch between data and url")
     user_to_update['password'] = hash_password(user_to_update['password'])
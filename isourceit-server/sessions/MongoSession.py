@@ -1,99 +1,161 @@
+import logging
 import pickle
 from pickle import PickleError
-from typing import Optional, Union
-from bson import ObjectId
+from typing import Optional, Dict, Any, NamedTuple, Mapping, Tuple
+from bson import ObjectId, Binary
+from bson.binary import USER_DEFINED_SUBTYPE
 from flask import Flask, Request, Response
-from flask.sessions import SessionMixin, SessionInterface
-from itsdangerous import Signer, BadSignature, want_bytes
+from flask.sessions import SessionMixin
+from itsdangerous import want_bytes
+from pymongo import ReturnDocument
 from pymongo.collection import Collection
-from werkzeug.datastructures import CallbackDict
 from datetime import datetime, timedelta
 from flask import current_app
 
+from sessions.SignedSessionInterface import ServerSideSession, SignedSessionInterface
+from utils.LRUCache import LRUCache
 
-class MongoSession(CallbackDict, SessionMixin):
-    """
-    CallbackDict: each time something is changed, self.modified set to true
-    """
-    def __init__(self, initial=None, sid=None, permanent: bool = None):
+LOG = logging.getLogger(__name__)
+
+# Session keys (see sessions/sessionManagement.py) stored as native document fields. Other keys are stored in the
+# extra field
+NATIVE_SESSION_KEYS = ('username', 'role', 'session_type', 'exam_type', 'exam_id', 'exam_started', 'exam_ended',
+                       'timeout', 'ws_sid')
+EXTRA_FIELD = 'extra'
+# Field of the session data in legacy documents (pickled blob, or pickled value per key)
+LEGACY_DATA_FIELD = 'data'
+NATIVE_VALUE_TYPES = (str, bool, int, float, datetime, type(None))
+
+
+class MongoSession(ServerSideSession):
+    def __init__(self, initial=None, sid=None, permanent: bool = None, stored_data: Dict[str, Any] = None,
+                 refreshed: datetime = None):
         """
 
         :param initial: initial data
         :param sid: the id of the session
         :param permanent: if permanent an expiration date will be set
+        :param stored_data: fields as stored in db, if any (used to compute changed fields)
+        :param refreshed: last time the expiration (and the cookie) has been refreshed
         """
-        def on_update(self):
-            self.modified = True
-        CallbackDict.__init__(self, initial, on_update)
-        self.sid = sid
-        if permanent:
-            self.permanent = bool(permanent)
-        self.modified = False
+        super().__init__(initial, sid, permanent)
+        self.stored_data = stored_data
+        self.refreshed = refreshed
+
 
+class CachedSession(NamedTuple):
+    version: int
+    data: Dict[str, Any]
+    stored_data: Optional[Dict[str, Any]]
 
-class MongoSessionInterface(SessionInterface):
-    __signer_salt = 'A super salt from France'
-    __signer_key_derivation = 'hmac'
+
+class MongoSessionInterface(SignedSessionInterface):
+    """
+    Session interface storing session data in Mongo.
+    With partial_update, unchanged sessions are not written, changed keys only are updated, and the expiration
+    (and the cookie) is refreshed at most once per refresh_interval.
+    With a cache_size, unserialized sessions are kept in memory and reused as long as the version of their document,
+    incremented on each write, is unchanged.
+    Expired documents are removed by the TTL index on expiration (see MongoDAO.init_indexes). As the TTL monitor runs
+    periodically, expiration is still checked when a session is opened.
+    """
 
     def __init__(self, mongo_collection: Collection, permanent: bool = True,
-                 session_prefix: str = None):
+                 session_prefix: str = None, partial_update: bool = False, refresh_interval: timedelta = None,
+                 cache_size: int = 0):
+        super().__init__(permanent, session_prefix)
         self._mongo_col = mongo_collection
-        self._permanent = permanent
-        self._session_prefix = session_prefix
+        self._partial_update = partial_update
+        self._refresh_interval = refresh_interval
+        self._cache: Optional[LRUCache] = LRUCache(cache_size) if cache_size > 0 else None
 
-    def _unsign_sid(self, app: Flask, sid: str = None) -> Optional[str]:
-        if sid is None:
-            return None
-        secret_key = app.config.get('SECRET_KEY')
-        if not secret_key:
-            return sid
-        signer = Signer(secret_key, salt=self.__signer_salt,
-                        key_derivation=self.__signer_key_derivation)
-        try:
-            sid_as_bytes = signer.unsign(sid)
-            return sid_as_bytes.decode()
-        except BadSignature as e:
-            current_app.logger.warning("Bad signature: %s.", str(e))
-            return None
+    @property
+    def cache(self) -> Optional[LRUCache]:
+        return self._cache
 
-    def _sign_sid(self, app: Flask, sid: str = None) -> Optional[Union[str|bytes]]:
-        if sid is None:
-            return None
-        secret_key = app.config.get('SECRET_KEY')
-        if not secret_key:
-            return sid
-        else:
-            signer = Signer(secret_key, salt=self.__signer_salt,
-                            key_derivation=self.__signer_key_derivation)
-            return signer.sign(want_bytes(sid))
+    @staticmethod
+    def _encode_value(value) -> Any:
+        # values without any native BSON representation are pickled
+        if isinstance(value, NATIVE_VALUE_TYPES):
+            return value
+        return Binary(pickle.dumps(value), USER_DEFINED_SUBTYPE)
 
-    def _remove_sid_prefix(self, sid: str = None) -> Optional[str]:
-        if sid is None:
-            return None
-        if self._session_prefix:
-            return sid[len(self._session_prefix):]
-        else:
-            return sid
+    @staticmethod
+    def _decode_value(value) -> Any:
+        if isinstance(value, Binary) and value.subtype == USER_DEFINED_SUBTYPE:
+            return pickle.loads(value)
+        return value
 
-    def _add_sid_prefix(self, sid: str = None) -> Optional[str]:
-        if sid is None:
-            return None
-        if self._session_prefix:
-            return self._session_prefix + sid
-        else:
-            return sid
+    @staticmethod
+    def _is_storable_key(key: str) -> bool:
+        # a key stored as a document field must be usable in an update path
+        return isinstance(key, str) and key != '' and '.' not in key and not key.startswith('$')
 
     @staticmethod
-    def _unserialize_session_data(data):
+    def _unserialize_legacy_session_data(data):
         if data is None:
             return None
+        if isinstance(data, dict):
+            # data stored as pickled value per key
+            return dict((key, pickle.loads(want_bytes(value))) for key, value in data.items())
         return pickle.loads(want_bytes(data))
 
+    @classmethod
+    def _unserialize_session_data(cls, document: Mapping) -> Dict[str, Any]:
+        if LEGACY_DATA_FIELD in document:
+            return cls._unserialize_legacy_session_data(document[LEGACY_DATA_FIELD])
+        data = dict((key, cls._decode_value(document[key])) for key in NATIVE_SESSION_KEYS if key in document)
+        extra = document.get(EXTRA_FIELD)
+        if isinstance(extra, dict):
+            data.update((key, cls._decode_value(value)) for key, value in extra.items())
+        elif extra is not None:
+            data.update(cls._decode_value(extra))
+        return data
+
+    @classmethod
+    def _serialize_session_data(cls, data: Mapping) -> Dict[str, Any]:
+        fields = dict((key, cls._encode_value(data[key])) for key in NATIVE_SESSION_KEYS if key in data)
+        extra = dict((key, value) for key, value in data.items() if key not in NATIVE_SESSION_KEYS)
+        if extra:
+            if all(map(cls._is_storable_key, extra.keys())):
+                fields[EXTRA_FIELD] = dict((key, cls._encode_value(value)) for key, value in extra.items())
+            else:
+                # keys cannot be used as field names: keep the whole extra data pickled
+                fields[EXTRA_FIELD] = Binary(pickle.dumps(extra), USER_DEFINED_SUBTYPE)
+        return fields
+
     @staticmethod
-    def _serialize_session_data(data):
-        if data is None:
-            return None
-        return pickle.dumps(data)
+    def _compute_field_changes(old_fields: Mapping, new_fields: Mapping) -> Tuple[Dict, Dict]:
+        set_fields = dict()
+        unset_fields = dict()
+        for key in NATIVE_SESSION_KEYS:
+            if key in new_fields:
+                if key not in old_fields or old_fields[key] != new_fields[key]:
+                    set_fields[key] = new_fields[key]
+            elif key in old_fields:
+                unset_fields[key] = ''
+        old_extra = old_fields.get(EXTRA_FIELD)
+        new_extra = new_fields.get(EXTRA_FIELD)
+        if isinstance(old_extra, dict) and isinstance(new_extra, dict):
+            for key, value in new_extra.items():
+                if key not in old_extra or old_extra[key] != value:
+                    set_fields[EXTRA_FIELD + '.' + key] = value
+            for key in old_extra.keys():
+                if key not in new_extra:
+                    unset_fields[EXTRA_FIELD + '.' + key] = ''
+        elif new_extra is not None:
+            if old_extra != new_extra:
+                set_fields[EXTRA_FIELD] = new_extra
+        elif old_extra is not None:
+            unset_fields[EXTRA_FIELD] = ''
+        return set_fields, unset_fields
+
+    @staticmethod
+    def _compute_absent_fields(fields: Mapping) -> Dict:
+        # fields to remove when the whole document is written
+        absent_fields = dict((key, '') for key in NATIVE_SESSION_KEYS + (EXTRA_FIELD,) if key not in fields)
+        absent_fields[LEGACY_DATA_FIELD] = ''
+        return absent_fields
 
     def open_session(
             self, app: Flask, request: Request
@@ -108,109 +170,167 @@ class MongoSessionInterface(SessionInterface):
         #       unserialized docment data create MongoSession(data, sid=generate sid from document._id)
 
         # Get session cookie value, decode sid, remove prefix, if required for all cases
-        doc_id = self._remove_sid_prefix(
-            self._unsign_sid(app, request.cookies.get(app.config.get('SESSION_COOKIE_NAME'))))
+        doc_id = self._extract_sid(app, request.cookies.get(app.config.get('SESSION_COOKIE_NAME')))
+        # if sid and cached session, probe the document version to reuse the cached session if still current
+        if doc_id and self._cache is not None:
+            cached_session: CachedSession = self._cache.get(doc_id)
+            if cached_session is not None:
+                document = self._find_current_document(doc_id, projection={'version': 1, 'expiration': 1,
+                                                                            'refreshed': 1})
+                if document is not None and document.get('version') == cached_session.version:
+                    return MongoSession(dict(cached_session.data), sid=doc_id,
+                                        stored_data=None if cached_session.stored_data is None
+                                        else dict(cached_session.stored_data),
+                                        refreshed=document.get('refreshed'))
+                self._cache.pop(doc_id)
         # if sid, retrieve the document from mongo
         if doc_id:
-            document = self._mongo_col.find_one({'_id': ObjectId(doc_id)})
-            if document:
-                # remove doc if session expired
-                expiration = document.get('expiration')
-                if expiration is not None and expiration <= datetime.utcnow():
-                    self._mongo_col.delete_one({'_id': ObjectId(doc_id)})
-                    document = None
+            document = self._find_current_document(doc_id)
             if document:
                 # document retrieved and session not expired : unser session data
                 try:
-                    session_data = self._unserialize_session_data(document.get('data'))
+                    session_data = self._unserialize_session_data(document)
+                    # a document in a legacy format has to be fully rewritten
+                    stored_data = None if LEGACY_DATA_FIELD in document \
+                        else self._serialize_session_data(session_data)
+                    self._cache_session(doc_id, document.get('version'), session_data, stored_data)
                     # permanent marker is included in session_data, no need to add it
-                    return MongoSession(session_data, sid=doc_id)
+                    return MongoSession(session_data, sid=doc_id, stored_data=stored_data,
+                                        refreshed=document.get('refreshed'))
                 except PickleError as e:
                     current_app.logger.warning("Open session: got error while unserializing data: %s.", str(e))
                     pass
         # In any other case, return a new fresh session
         return MongoSession(permanent=self._permanent)
 
+    def _find_current_document(self, doc_id: str, projection: Dict[str, int] = None) -> Optional[Dict]:
+        document = self._mongo_col.find_one({'_id': ObjectId(doc_id)}, projection=projection)
+        if document:
+            # remove doc if session expired
+            expiration = document.get('expiration')
+            if expiration is not None and expiration <= datetime.utcnow():
+                self._mongo_col.delete_one({'_id': ObjectId(doc_id)})
+                document = None
+        return document
+
+    def _cache_session(self, sid: str, version: Optional[int], data: Dict[str, Any],
+                       stored_data: Optional[Dict[str, Any]]) -> None:
+        if self._cache is None:
+            return
+        if version is None:
+            # unversioned document (or document removed while updated): cannot be validated later
+            self._cache.pop(sid)
+        else:
+            self._cache.put(sid, CachedSession(version, dict(data), None if stored_data is None
+                                               else dict(stored_data)))
+
+    def _insert_document(self, document: Dict) -> str:
+        document['version'] = 1
+        result = self._mongo_col.insert_one(document)
+        return str(result.inserted_id)
+
+    def _update_document(self, sid: str, update: Dict) -> Optional[int]:
+        # every update increments the document version. Return the new version
+        update['$inc'] = {'version': 1}
+        document = self._mongo_col.find_one_and_update({'_id': ObjectId(sid)}, update, projection={'version': 1},
+                                                       return_document=ReturnDocument.AFTER)
+        return document.get('version') if document else None
+
     def save_session(
             self, app: Flask, session: MongoSession, response: Response
     ) -> None:
-        # get cookie information: cookie name, domain, path (required to delete it)
-        cookie_name = self.get_cookie_name(app)
-        cookie_domain = self.get_cookie_domain(app)
-        cookie_path = self.get_cookie_path(app)
-
         # if session is empty (not session => not attribte, and not permanent) and modified
         # remove session, delete cookie and stop here
         if not session and session.modified:
             if session.sid is not None:
                 self._mongo_col.delete_one({'_id': ObjectId(session.sid)})
-            response.delete_cookie(cookie_name, domain=cookie_domain, path=cookie_path)
+                if self._cache is not None:
+                    self._cache.pop(session.sid)
+            self._delete_session_cookie(app, response)
             return
 
+        if self._partial_update:
+            self._save_partial_session(app, session, response)
+        else:
+            self._save_full_session(app, session, response)
+
+    def _write_whole_document(self, session: MongoSession, fields: Dict[str, Any], expiration: Optional[datetime],
+                              refreshed: Optional[datetime] = None) -> Optional[int]:
         # if session has not sid : insert it from db then set its sid (generate from document._id)
-        # else replace it
-        document = {
-            'data': self._serialize_session_data(dict(session)),
-            'expiration': self.get_expiration_time(app, session)
-        }
+        # else replace all its fields. Return the new version
+        document = dict(fields)
+        document['expiration'] = expiration
+        if refreshed is not None:
+            document['refreshed'] = refreshed
         if session.sid is None:
-            result = self._mongo_col.insert_one(document)
-            session.sid = str(result.inserted_id)
-        else:
-            self._mongo_col.replace_one({'_id': ObjectId(session.sid)}, document)
+            session.sid = self._insert_document(document)
+            return 1
+        return self._update_document(session.sid, {'$set': document,
+                                                   '$unset': self._compute_absent_fields(fields)})
+
+    def _save_full_session(self, app: Flask, session: MongoSession, response: Response) -> None:
+        fields = self._serialize_session_data(session)
+        expiration = self.get_expiration_time(app, session)
+        version = self._write_whole_document(session, fields, expiration)
+        session.stored_data = fields
+        self._cache_session(session.sid, version, session, fields)
 
         # if should_set_cookie:
         if self.should_set_cookie(app, session):
-            # compute cookie_value: add prefix then sign session sid if required or
-            cookie_value = self._sign_sid(app, self._add_sid_prefix(session.sid))
-            # get extra cookie information: expires, httponly, secure, samesite
-            cookie_params = dict(domain=cookie_domain, path=cookie_path,
-                                 expires=document['expiration'], httponly=self.get_cookie_httponly(app),
-                                 secure=self.get_cookie_secure(app))
-            same_site = self.get_cookie_samesite(app)
-            if same_site:
-                cookie_params['samesite'] = same_site
-            # set cookie
-            response.set_cookie(cookie_name, cookie_value, **cookie_params)
-
-
-class AutoCleanMongoSession(MongoSessionInterface):
-    def __init__(self, mongo_collection: Collection, permanent: bool = True,
-                 session_prefix: str = None, threshold_cleaner: Union[int, timedelta] = 1000):
-        super().__init__(mongo_collection, permanent, session_prefix)
-        self._threshold_cleaner: Union[int, timedelta] = threshold_cleaner
-        self._clearner_cpt = 0
-        self._clearner_last_access = datetime.utcnow()
-        self._clearner_use_last_access = True if self._threshold_cleaner is None or isinstance(self._threshold_cleaner,
-                                                                                               timedelta) else False
-
-    def _cleanup(self) -> None:
-        # remove all session whose expiration is before now - 4H
-        now_minus_4_hours = datetime.now() - timedelta(hours=4)
-        result = self._mongo_col.delete_many({
-            'expiration': {
-                '$lt': now_minus_4_hours
-            }
-        })
-        current_app.logger.info("MONGO SESSION CLEANUP: %d session removed.", result.deleted_count)
-
-    def _handle_cleaner(self) -> None:
-        if self._threshold_cleaner is None:
+            self._set_session_cookie(app, session.sid, expiration, response)
+
+    def _save_partial_session(self, app: Flask, session: MongoSession, response: Response) -> None:
+        now = datetime.utcnow()
+        refresh_due = session.sid is None or session.refreshed is None or self._refresh_interval is None \
+            or session.refreshed + self._refresh_interval <= now
+        # unchanged session, with an expiration recently refreshed: nothing to write
+        if not session.modified and not refresh_due:
             return
-        if self._clearner_use_last_access:
-            if (self._clearner_last_access + self._threshold_cleaner) < datetime.utcnow():
-                self._cleanup()
-                self._clearner_last_access = datetime.utcnow()
+
+        fields = self._serialize_session_data(session)
+        expiration = self.get_expiration_time(app, session)
+        if session.sid is None or session.stored_data is None:
+            # new session or session stored in a legacy format: write the whole document
+            version = self._write_whole_document(session, fields, expiration, refreshed=now)
         else:
-            self._clearner_cpt += 1
-            if self._clearner_cpt > self._threshold_cleaner:
-                self._cleanup()
-                self._clearner_cpt = 0
+            # compute changed and removed fields
+            set_fields, unset_fields = self._compute_field_changes(session.stored_data, fields)
+            if not set_fields and not unset_fields and not refresh_due:
+                return
+            if refresh_due:
+                set_fields['expiration'] = expiration
+                set_fields['refreshed'] = now
+            update = {}
+            if set_fields:
+                update['$set'] = set_fields
+            if unset_fields:
+                update['$unset'] = unset_fields
+            version = self._update_document(session.sid, update)
+        session.stored_data = fields
+        self._cache_session(session.sid, version, session, fields)
+        if refresh_due:
+            session.refreshed = now
+            # cookie expiration follows the stored expiration
+            self._set_session_cookie(app, session.sid, expiration, response)
 
-    def save_session(
-            self, app: Flask, session: MongoSession, response: Response
-    ) -> None:
-        try:
-            super().save_session(app, session, response)
-        finally:
-            self._handle_cleaner()
\ No newline at end of file
+    def migrate_legacy_sessions(self) -> int:
+        """
+        Rewrite the sessions stored in a legacy format (pickled data) with native fields. Scans the whole collection:
+        run once by migrate-sessions.py. Meanwhile, legacy sessions are rewritten when saved
+        :return: the number of migrated sessions
+        """
+        nb_migrated = 0
+        for document in self._mongo_col.find({LEGACY_DATA_FIELD: {'$exists': True}}):
+            try:
+                fields = self._serialize_session_data(self._unserialize_session_data(document))
+            except PickleError as e:
+                LOG.warning("Session migration: got error while unserializing data: %s.", str(e))
+                continue
+            # the version guard avoids overwriting a session saved in the meantime
+            result = self._mongo_col.update_one({'_id': document['_id'], 'version': document.get('version')}, {
+                '$set': fields,
+                '$unset': self._compute_absent_fields(fields),
+                '$inc': {'version': 1}
+            })
+            nb_migrated += result.modified_count
+        return nb_migrated
@@ -0,0 +1,97 @@
+import pickle
+from datetime import datetime, timezone
+from pickle import PickleError
+from typing import Optional
+from uuid import uuid4
+from flask import Flask, Request, Response
+from flask.sessions import SessionMixin
+from itsdangerous import want_bytes
+from redis import Redis
+from flask import current_app
+
+from sessions.SignedSessionInterface import ServerSideSession, SignedSessionInterface
+
+__all__ = ['RedisSessionInterface']
+
+DEFAULT_KEY_PREFIX = 'isourceit:session:'
+
+
+class RedisSessionInterface(SignedSessionInterface):
+    """
+    Session interface storing session data in Redis. Expiration is delegated to native redis key TTL, so no cleanup
+    of expired sessions is required.
+    """
+
+    def __init__(self, redis_client: Redis, permanent: bool = True,
+                 session_prefix: str = None, key_prefix: str = DEFAULT_KEY_PREFIX):
+        super().__init__(permanent, session_prefix)
+        self._redis = redis_client
+        self._key_prefix = key_prefix
+
+    def _redis_key(self, sid: str) -> str:
+        return self._key_prefix + sid
+
+    @staticmethod
+    def _compute_ttl(app: Flask, expiration: Optional[datetime]) -> int:
+        # a non-permanent session has no expiration for the cookie, but the stored data still need a lifetime
+        if expiration is None:
+            return max(1, int(app.permanent_session_lifetime.total_seconds()))
+        return max(1, int((expiration - datetime.now(timezone.utc)).total_seconds()))
+
+    @staticmethod
+    def _unserialize_session_data(data):
+        if data is None:
+            return None
+        return pickle.loads(want_bytes(data))
+
+    @staticmethod
+    def _serialize_session_data(data):
+        if data is None:
+            return None
+        return pickle.dumps(data)
+
+    def open_session(
+            self, app: Flask, request: Request
+    ) -> Optional[SessionMixin]:
+        # Get session cookie value, decode sid, remove prefix, if required for all cases
+        sid = self._extract_sid(app, request.cookies.get(app.config.get('SESSION_COOKIE_NAME')))
+        # if sid, retrieve the data from redis. An expired session has already been evicted by redis
+        if sid:
+            data = self._redis.get(self._redis_key(sid))
+            if data is not None:
+                try:
+                    session_data = self._unserialize_session_data(data)
+                    # permanent marker is included in session_data, no need to add it
+                    return ServerSideSession(session_data, sid=sid)
+                except PickleError as e:
+                    current_app.logger.warning("Open session: got error while unserializing data: %s.", str(e))
+                    pass
+        # In any other case, return a new fresh session
+        return ServerSideSession(permanent=self._permanent)
+
+    def save_session(
+            self, app: Flask, session: ServerSideSession, response: Response
+    ) -> None:
+        # if session is empty (not session => not attribte, and not permanent) and modified
+        # remove session, delete cookie and stop here
+        if not session and session.modified:
+            if session.sid is not None:
+                self._redis.delete(self._redis_key(session.sid))
+            self._delete_session_cookie(app, response)
+            return
+
+        expiration = self.get_expiration_time(app, session)
+        ttl = self._compute_ttl(app, expiration)
+        should_set_cookie = self.should_set_cookie(app, session)
+        # if session has no sid : generate a new one and store the data
+        # else store data if modified, or only refresh the key TTL if the cookie is refreshed
+        if session.sid is None:
+            session.sid = uuid4().hex
+            self._redis.set(self._redis_key(session.sid), self._serialize_session_data(dict(session)), ex=ttl)
+        elif session.modified:
+            self._redis.set(self._redis_key(session.sid), self._serialize_session_data(dict(session)), ex=ttl)
+        elif should_set_cookie:
+            self._redis.expire(self._redis_key(session.sid), ttl)
+
+        if should_set_cookie:
+            self._set_session_cookie(app, session.sid, expiration, response)
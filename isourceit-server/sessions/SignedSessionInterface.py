@@ -0,0 +1,105 @@
+from datetime import datetime
+from typing import Optional, Union
+from flask import Flask, Response, current_app
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature, want_bytes
+from werkzeug.datastructures import CallbackDict
+
+__all__ = ['ServerSideSession', 'SignedSessionInterface']
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """
+    CallbackDict: each time something is changed, self.modified set to true
+    """
+    def __init__(self, initial=None, sid=None, permanent: bool = None):
+        """
+
+        :param initial: initial data
+        :param sid: the id of the session
+        :param permanent: if permanent an expiration date will be set
+        """
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        if permanent:
+            self.permanent = bool(permanent)
+        self.modified = False
+
+
+class SignedSessionInterface(SessionInterface):
+    """
+    Base of server-side session interfaces: the cookie only holds the (prefixed and signed) session id,
+    session data being kept by the store implemented by subclasses.
+    """
+    __signer_salt = 'A super salt from France'
+    __signer_key_derivation = 'hmac'
+
+    def __init__(self, permanent: bool = True, session_prefix: str = None):
+        self._permanent = permanent
+        self._session_prefix = session_prefix
+
+    def _unsign_sid(self, app: Flask, sid: str = None) -> Optional[str]:
+        if sid is None:
+            return None
+        secret_key = app.config.get('SECRET_KEY')
+        if not secret_key:
+            return sid
+        signer = Signer(secret_key, salt=self.__signer_salt,
+                        key_derivation=self.__signer_key_derivation)
+        try:
+            sid_as_bytes = signer.unsign(sid)
+            return sid_as_bytes.decode()
+        except BadSignature as e:
+            current_app.logger.warning("Bad signature: %s.", str(e))
+            return None
+
+    def _sign_sid(self, app: Flask, sid: str = None) -> Optional[Union[str|bytes]]:
+        if sid is None:
+            return None
+        secret_key = app.config.get('SECRET_KEY')
+        if not secret_key:
+            return sid
+        else:
+            signer = Signer(secret_key, salt=self.__signer_salt,
+                            key_derivation=self.__signer_key_derivation)
+            return signer.sign(want_bytes(sid))
+
+    def _remove_sid_prefix(self, sid: str = None) -> Optional[str]:
+        if sid is None:
+            return None
+        if self._session_prefix:
+            return sid[len(self._session_prefix):]
+        else:
+            return sid
+
+    def _add_sid_prefix(self, sid: str = None) -> Optional[str]:
+        if sid is None:
+            return None
+        if self._session_prefix:
+            return self._session_prefix + sid
+        else:
+            return sid
+
+    def _extract_sid(self, app: Flask, cookie_value: str = None) -> Optional[str]:
+        # decode sid, remove prefix, if required for all cases
+        return self._remove_sid_prefix(self._unsign_sid(app, cookie_value))
+
+    def _delete_session_cookie(self, app: Flask, response: Response) -> None:
+        response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                               path=self.get_cookie_path(app))
+
+    def _set_session_cookie(self, app: Flask, sid: str, expiration: Optional[datetime],
+                            response: Response) -> None:
+        # compute cookie_value: add prefix then sign session sid if required or
+        cookie_value = self._sign_sid(app, self._add_sid_prefix(sid))
+        # get extra cookie information: expires, httponly, secure, samesite
+        cookie_params = dict(domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                             expires=expiration, httponly=self.get_cookie_httponly(app),
+                             secure=self.get_cookie_secure(app))
+        same_site = self.get_cookie_samesite(app)
+        if same_site:
+            cookie_params['samesite'] = same_site
+        # set cookie
+        response.set_cookie(self.get_cookie_name(app), cookie_value, **cookie_params)
@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from flask import Flask, Request, Response
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionMixin, SessionInterface
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+from sessions.SignedSessionInterface import SignedSessionInterface
+from sessions.sessionManagement import STUDENT_ROLE
+
+__all__ = ['StatelessSession', 'StatelessStudentSessionInterface']
+
+
+class StatelessSession(CallbackDict, SessionMixin):
+    """
+    Session whose data is entirely held by a signed cookie.
+    CallbackDict: each time something is changed, self.modified set to true
+    """
+    stateless = True
+
+    def __init__(self, initial=None, issued: datetime = None):
+        """
+
+        :param initial: initial data
+        :param issued: date the cookie has been issued
+        """
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.issued = issued
+        self.modified = False
+
+
+class StatelessStudentSessionInterface(SessionInterface):
+    """
+    Session interface keeping student sessions in a signed cookie, without any store round-trip. The cookie is
+    rotated when the session changes, or when it is older than refresh_interval to keep a sliding expiration.
+    Other sessions (teachers, admins, or not logged users) are handled by the store session interface.
+    """
+    __serializer_salt = 'isourceit-student-session'
+
+    def __init__(self, store_interface: SignedSessionInterface, refresh_interval: timedelta = None):
+        self._store_interface = store_interface
+        self._refresh_interval = refresh_interval
+        self._serializer = TaggedJSONSerializer()
+
+    def _get_signing_serializer(self, app: Flask) -> Optional[URLSafeTimedSerializer]:
+        if not app.secret_key:
+            return None
+        return URLSafeTimedSerializer(app.secret_key, salt=self.__serializer_salt, serializer=self._serializer)
+
+    @staticmethod
+    def _to_naive_utc_datetimes(data: dict) -> dict:
+        # the json serializer restores datetime as aware ones, while the app handles naive utc datetime
+        return {key: value.astimezone(timezone.utc).replace(tzinfo=None)
+                if isinstance(value, datetime) and value.tzinfo is not None else value
+                for key, value in data.items()}
+
+    def open_session(
+            self, app: Flask, request: Request
+    ) -> Optional[SessionMixin]:
+        signing_serializer = self._get_signing_serializer(app)
+        cookie_value = request.cookies.get(self.get_cookie_name(app))
+        if signing_serializer is not None and cookie_value:
+            try:
+                data, issued = signing_serializer.loads(cookie_value,
+                                                        max_age=int(app.permanent_session_lifetime.total_seconds()),
+                                                        return_timestamp=True)
+                return StatelessSession(self._to_naive_utc_datetimes(data), issued=issued)
+            except BadSignature:
+                # Not a student session cookie (or an expired one): let the store handle it
+                pass
+        return self._store_interface.open_session(app, request)
+
+    def save_session(
+            self, app: Flask, session: SessionMixin, response: Response
+    ) -> None:
+        if not isinstance(session, StatelessSession):
+            if session.get('role') != STUDENT_ROLE:
+                self._store_interface.save_session(app, session, response)
+                return
+            # student session just initiated: from now on, it is held by the cookie only
+            session = StatelessSession(dict(session))
+            session.modified = True
+
+        # if session is empty and modified, delete cookie and stop here
+        if not session:
+            if session.modified:
+                response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app))
+            return
+
+        now = datetime.now(timezone.utc)
+        refresh_due = session.issued is None or self._refresh_interval is None \
+            or session.issued + self._refresh_interval <= now
+        if not session.modified and not refresh_due:
+            return
+
+        signing_serializer = self._get_signing_serializer(app)
+        if signing_serializer is None:
+            return
+        cookie_params = dict(domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                             expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                             secure=self.get_cookie_secure(app))
+        same_site = self.get_cookie_samesite(app)
+        if same_site:
+            cookie_params['samesite'] = same_site
+        response.set_cookie(self.get_cookie_name(app), signing_serializer.dumps(dict(session)), **cookie_params)
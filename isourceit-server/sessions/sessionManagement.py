@@ -7,9 +7,9 @@ from flask import session
 __all__ = ['STUDENT_ROLE', 'TEACHER_ROLE', 'ADMIN_ROLE',
            'clear_session', 'has_logged_session', 'build_user_context_from_session',
            'session_is_student', 'session_is_teacher_or_admin', 'session_exam_type', 'session_username',
-           'update_session_student_info', 'session_exam_id', 'is_exam_started', 'is_exam_ended',
+           'update_session_student_info', 'session_exam_id', 'is_exam_started', 'is_exam_ended', 'session_timeout',
            'init_exam_composition_session', 'init_socrat_composition_session', 'init_admin_session',
-           'get_ws_sid', 'update_session_ws_sid']
+           'session_is_stateless', 'get_student_ws_room', 'get_ws_sid', 'update_session_ws_sid']
 
 LOG = logging.getLogger(__name__)
 
@@ -115,6 +115,10 @@ def is_exam_ended() -> bool:
     return False
 
 
+def session_timeout() -> Optional[datetime]:
+    return session.get('timeout')
+
+
 def update_session_student_info(exam_id: str = None, exam_started: bool = None, exam_ended: bool = None,
                                 timeout: datetime = None):
     if session_type() != SESSION_TYPE_COMPOSITION:
@@ -129,8 +133,22 @@ def update_session_student_info(exam_id: str = None, exam_started: bool = None,
         session['timeout'] = timeout
 
 
+def session_is_stateless() -> bool:
+    return getattr(session, 'stateless', False)
+
+
+def get_student_ws_room() -> Optional[str]:
+    if 'username' not in session:
+        return None
+    return 'student:{}:{}'.format(session_exam_id(), session_username())
+
+
 def get_ws_sid():
-    return session.get('ws_sid')
+    ws_sid = session.get('ws_sid')
+    if ws_sid is None and session_is_stateless():
+        # a stateless session cannot record the websocket id on connection: address the student room instead
+        return get_student_ws_room()
+    return ws_sid
 
 
 def update_session_ws_sid(sid: str):
@@ -1,11 +1,11 @@
 import json
 from argparse import ArgumentParser
 from json import JSONDecodeError
-from typing import Optional, List, Dict, TypedDict, Iterable, Tuple, Union
+from typing import Optional, List, TypedDict, Iterable, Tuple, Union, TextIO
 import requests
 import sseclient
 
-OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_BASE_URL = "https://api.openai.com/v1"
 NAME_MODEL_DICT = {
     'gpt-3.5-turbo': 'Most capable GPT-3.5 model.',
     'gpt-4': 'GPT 4'
@@ -26,7 +26,8 @@ class ChatFragment(TypedDict):
 def handle_prompt(prompt: str, username: str, private_key: str,
                   previous_interactions: List[ChatInteraction],
                   init_system_prompt: Optional[str],
-                  model_id: str, open_ai_temperature: int) -> Iterable[Tuple[str, Union[ChatFragment, ChatInteraction]]]:
+                  model_id: str, open_ai_temperature: int, base_url: str = OPENAI_BASE_URL,
+                  record_file: Optional[TextIO] = None) -> Iterable[Tuple[str, Union[ChatFragment, ChatInteraction]]]:
     model = NAME_MODEL_DICT.get(model_id)
     if not model:
         raise Exception('Unknown model')
@@ -50,7 +51,7 @@ def handle_prompt(prompt: str, username: str, private_key: str,
                   "Content-Type": "application/json"}
 
     try:
-        http_response = requests.post(OPENAI_CHAT_URL, data=json.dumps(rq_body), headers=rq_headers, stream=True)
+        http_response = requests.post(base_url + '/chat/completions', data=json.dumps(rq_body), headers=rq_headers, stream=True)
         http_response.raise_for_status()
     except requests.exceptions.Timeout as e:
         print('>INFO: timeout exception: {}'.format(repr(e)))
@@ -66,8 +67,11 @@ def handle_prompt(prompt: str, username: str, private_key: str,
         raise e
     else:
         complete_content = []
+        # raw event data, recorded to be replayed by mock-openai-server.py
+        recorded_events = []
         client = sseclient.SSEClient(http_response)
         for event in client.events():
+            recorded_events.append(event.data)
             if event.data == '[DONE]':
                 # end marker received. stop here
                 break
@@ -98,11 +102,14 @@ def handle_prompt(prompt: str, username: str, private_key: str,
                     complete_content.append(delta['content'])
                     # prepare a response
                     yield 'fragment', ChatFragment(content=delta['content'])
+        if record_file is not None:
+            record_file.write(json.dumps(recorded_events) + '\n')
         yield 'interaction', ChatInteraction(content=''.join(complete_content), role='assistant')
 
 
 def handle_interaction(username: str, private_key: str, first_prompt: Optional[str],
-                       init_system_prompt: Optional[str], model_id: str, open_ai_temperature: int):
+                       init_system_prompt: Optional[str], model_id: str, open_ai_temperature: int,
+                       base_url: str = OPENAI_BASE_URL, record_file: Optional[TextIO] = None):
     previous_interactions: List[ChatInteraction] = []
     current_prompt: str = first_prompt
 
@@ -118,7 +125,8 @@ def handle_interaction(username: str, private_key: str, first_prompt: Optional[s
 
         interaction_received = False
         for res_type, result in handle_prompt(current_prompt, username, private_key, previous_interactions,
-                                              init_system_prompt, model_id, open_ai_temperature):
+                                              init_system_prompt, model_id, open_ai_temperature, base_url,
+                                              record_file):
             if interaction_received:
                 print(">INFO: received result of type %s while interaction received" % str(res_type))
             if res_type == 'fragment':
@@ -143,6 +151,11 @@ def setup_argument_parser() -> ArgumentParser:
     parser.add_argument('-m', '--model', help='AI Model', type=str, default='gpt-3.5-turbo',
                         choices=NAME_MODEL_DICT.keys())
     parser.add_argument('-t', '--temperature', help='temperature', type=float, default=OPENAI_TEMPERATURE)
+    parser.add_argument('--url', help='OpenAI-compatible API base url (default: %s)' % OPENAI_BASE_URL, type=str,
+                        default=OPENAI_BASE_URL)
+    parser.add_argument('-r', '--record', help='File to append the received answer streams to, one JSON list of '
+                                               'event data per line, to be replayed by mock-openai-server.py',
+                        type=str, required=False)
     return parser
 
 
@@ -155,8 +168,15 @@ def main(args):
     elif args.system_prompt:
         system_prompt = args.system_prompt
 
-    handle_interaction(username=args.user, private_key=args.key, first_prompt=first_prompt,
-                       init_system_prompt=system_prompt, model_id=args.model, open_ai_temperature=args.temperature)
+    record_file = open(args.record, 'a') if args.record else None
+    try:
+        handle_interaction(username=args.user, private_key=args.key, first_prompt=first_prompt,
+                           init_system_prompt=system_prompt, model_id=args.model,
+                           open_ai_temperature=args.temperature, base_url=args.url.rstrip('/'),
+                           record_file=record_file)
+    finally:
+        if record_file is not None:
+            record_file.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,68 @@
+import unittest
+
+from services.chatAI.PromptScheduler import PromptScheduler, PromptOutcome
+
+
+class PromptSchedulerTest(unittest.TestCase):
+
+    def test_prompt_rejected_past_max_retries_is_dropped(self):
+        scheduler = PromptScheduler(max_retries=2, backoff_seconds=0)
+        attempts = []
+        dropped = []
+
+        def start(on_completed):
+            attempts.append(1)
+            on_completed(PromptOutcome(retry=True))
+
+        scheduler.submit('exam', 'student', 'key', start, job_id='action', on_dropped=lambda: dropped.append(1))
+
+        self.assertEqual(3, len(attempts))
+        self.assertEqual(1, len(dropped))
+        metrics = scheduler.metrics()
+        self.assertEqual(3, metrics['rejected'])
+        self.assertEqual(2, metrics['retries'])
+        self.assertEqual(1, metrics['dropped'])
+        # the exam and the key have no more prompts
+        self.assertEqual(dict(), metrics['exams'])
+        self.assertEqual([], metrics['keys'])
+        # the dropped prompt is no longer queued
+        self.assertFalse(scheduler.cancel('action'))
+
+    def test_prompt_answered_after_retry_is_not_dropped(self):
+        scheduler = PromptScheduler(max_retries=2, backoff_seconds=0)
+        outcomes = [PromptOutcome(retry=True), PromptOutcome()]
+        dropped = []
+
+        scheduler.submit('exam', 'student', 'key', lambda on_completed: on_completed(outcomes.pop(0)),
+                         on_dropped=lambda: dropped.append(1))
+
+        self.assertEqual([], outcomes)
+        self.assertEqual([], dropped)
+        self.assertEqual(0, scheduler.metrics()['dropped'])
+
+    def test_exams_and_keys_without_prompts_are_forgotten(self):
+        scheduler = PromptScheduler(exam_concurrency=1)
+        completions = []
+
+        for exam_id in ('exam-1', 'exam-2'):
+            scheduler.submit(exam_id, 'student', exam_id + '-key', completions.append, job_id=exam_id + '-a')
+            scheduler.submit(exam_id, 'student', exam_id + '-key', completions.append, job_id=exam_id + '-b')
+        self.assertEqual(['exam-1', 'exam-2'], sorted(scheduler.metrics()['exams'].keys()))
+
+        # exam-1: second prompt cancelled, first prompt answered
+        self.assertTrue(scheduler.cancel('exam-1-b'))
+        completions.pop(0)(PromptOutcome())
+        metrics = scheduler.metrics()
+        self.assertEqual(['exam-2'], list(metrics['exams'].keys()))
+        self.assertEqual(1, len(metrics['keys']))
+
+        # exam-2: both prompts answered in turn
+        completions.pop(0)(PromptOutcome())
+        completions.pop(0)(PromptOutcome())
+        metrics = scheduler.metrics()
+        self.assertEqual(dict(), metrics['exams'])
+        self.assertEqual([], metrics['keys'])
+
+
+if __name__ == '__main__':
+    unittest.main()
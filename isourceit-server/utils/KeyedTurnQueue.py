@@ -0,0 +1,53 @@
+from collections import deque
+from threading import Event, Lock
+from typing import Any, Callable, Deque, Dict, Hashable
+
+__all__ = ['KeyedTurnQueue']
+
+
+class KeyedTurnQueue:
+    """
+    Run functions one at a time per key, in the order they are submitted (unlike a lock, which does not guarantee the
+    order in which waiting threads acquire it).
+    A key is forgotten once it has no pending function.
+    """
+    __slots__ = ['_turns_by_key', '_lock']
+
+    def __init__(self):
+        self._turns_by_key: Dict[Hashable, Deque[Event]] = dict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._turns_by_key)
+
+    def run(self, key: Hashable, func: Callable, *args: Any) -> Any:
+        """
+        Wait for the functions previously submitted for the key, then run the function
+        :return: the result of the function
+        """
+        turn = Event()
+        with self._lock:
+            turns = self._turns_by_key.get(key)
+            if turns is None:
+                turns = deque()
+                self._turns_by_key[key] = turns
+            turns.append(turn)
+            if len(turns) == 1:
+                turn.set()
+        turn.wait()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                turns.popleft()
+                if turns:
+                    turns[0].set()
+                elif self._turns_by_key.get(key) is turns:
+                    del self._turns_by_key[key]
+
+    def forget(self, key: Hashable) -> None:
+        """
+        Forget a key whose functions will not be run anymore. Functions already submitted are still run in turn
+        """
+        with self._lock:
+            self._turns_by_key.pop(key, None)